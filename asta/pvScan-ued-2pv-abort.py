@@ -3,7 +3,6 @@
 # mdunning 1/7/16
 
 import os
-import signal
 import sys
 from time import sleep
 from epics import PV
@@ -35,7 +34,8 @@ def abortRoutine():
     "This is the abort routine"
     # Kill scan routine process
     pvscan.printMsg('Killing process %d...' % (pid))
-    os.kill(pid, signal.SIGKILL)
+    # Scans run in-process by pvScan-multiScan.py are stopped with SIGTERM, so they can clean up
+    pvscan.stopScanProcess(pid)
     # Stop the wrapper script
     pvscan.printMsg('Stopping wrapper script')
     runFlagPv.put(0)
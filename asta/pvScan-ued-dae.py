@@ -5,6 +5,7 @@
 from epics import PV
 from time import sleep
 import datetime,os,sys,math
+import numpy as np
 
 
 # PV prefix for pvScan IOC; should be passed as an argument to this script.
@@ -142,20 +143,32 @@ def motorScan(motor1,motor2,motor3,grabObject='',radius=0,radius2=0,resetMotorPv
     else:
         nsteps = motor1.nsteps
 
+    # Compute motor positions for all steps up front
+    angles=motor1.start + inc*np.arange(nsteps)
+    positions1=angles + motor1.offset
+    positions2=motor2.offset + radius*np.cos(np.radians(angles)) - radius2*np.sin(np.radians(angles))
+    positions3=motor3.offset + radius*np.sin(np.radians(angles)) + radius2*(1-np.cos(np.radians(angles)))
+    # Check all positions against soft limits before the first move
+    if exp1.scanflag:
+        trajectory=pvscan.Trajectory()
+        trajectory.addAxis('x1',positions1,motor1)
+        trajectory.addAxis('x2',positions2,motor2)
+        trajectory.addAxis('x3',positions3,motor3)
+        trajectory.validate()
+
     for i in range(nsteps):
 
         if exp1.scanflag:
             # Move motor 1
-            newPos0=motor1.start + i*inc
-            newPos1=newPos0 + motor1.offset
+            newPos1=positions1[i]
             pvscan.printMsg('Moving %s to %f' % (motor1.pvname,newPos1))
             motor1.move(newPos1,timeout=30)
             # Move motor 2
-            newPos2=motor2.offset + radius*math.cos(newPos0*math.pi/180) - radius2*math.sin(newPos0*math.pi/180)
+            newPos2=positions2[i]
             pvscan.printMsg('Moving %s to %f' % (motor2.pvname,newPos2))
             motor2.move(newPos2)
             # Move motor 3
-            newPos3=motor3.offset + radius*math.sin(newPos0*math.pi/180) + radius2*(1-math.cos(newPos0*math.pi/180))
+            newPos3=positions3[i]
             pvscan.printMsg('Moving %s to %f' % (motor3.pvname,newPos3))
             motor3.move(newPos3)
             pvscan.printSleep(motor1.settletime,'Settling')
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Benchmark the batched elog run-param fetch against the serial one, on the simulated IOC
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+from time import time
+
+modulesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules')
+sys.path.insert(0, modulesPath)
+
+#################################################################################################################
+#
+# For each PV list length, elog.getParamsSerial (a PV object and a get per name)
+# and elog.getParams (one batch) fetch the same PVs, each with fresh channels.
+# Connects cost one simulated CA latency each, unless their searches overlap.
+#
+#     elog-params-benchmark.py --latency 0.002 --npvs 10 100 500
+#
+#################################################################################################################
+
+
+def run(ioc, elog, nPvs, repeat):
+    """Time both fetches of nPvs PVs; return a dict of results."""
+    result = {'nPvs': nPvs}
+    for name, function in (('serial', elog.getParamsSerial), ('batched', elog.getParams)):
+        times = []
+        for i in range(repeat):
+            # New PV names each time, so no channel is reused
+            pvnames = ['SIM:ELOG:%s%d:PV%04d' % (name, i, n) for n in range(nPvs)]
+            for n, pvname in enumerate(pvnames):
+                ioc.addRecord(pvname, 'value %d' % (n) if n % 2 else float(n))
+            counts0 = dict(ioc.counts)
+            t0 = time()
+            function(pvnames)
+            times.append(time() - t0)
+        result[name] = min(times)
+        result[name + 'Connects'] = ioc.counts['connect'] - counts0.get('connect', 0)
+    result['speedup'] = result['serial']/result['batched'] if result['batched'] else None
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark batched vs serial elog run-param fetch.')
+    parser.add_argument('--npvs', type=int, nargs='+', default=[10, 50, 100, 500], help='PV list lengths')
+    parser.add_argument('--latency', type=float, default=0.002, help='Simulated CA round-trip latency (s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case (the fastest is kept)')
+    parser.add_argument('--output', help='Save results to this JSON file')
+    args = parser.parse_args()
+    import simioc
+    ioc = simioc.install(latency=args.latency)
+    import elog
+    results = [run(ioc, elog, nPvs, args.repeat) for nPvs in args.npvs]
+    print('%8s %12s %12s %8s' % ('PVs', 'serial [s]', 'batched [s]', 'speedup'))
+    for result in results:
+        print('%8d %12.4f %12.4f %7.1fx' % (result['nPvs'], result['serial'], result['batched'],
+                result['speedup'] or 0))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'latency': args.latency, 'results': results}, fh, indent=2)
+        print('Results saved to %s' % (args.output))
+
+
+### End ##########################################################################
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Benchmark scan overhead against the simulated IOC (modules/simioc.py)
+
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+
+modulesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules')
+sys.path.insert(0, modulesPath)
+
+#################################################################################################################
+#
+# Each configuration runs in its own process, so start-up time includes importing
+# pvscan.  Results (JSON) can be saved with --output and compared with --compare:
+#
+#     pvScan-benchmark.py --output results-R3.2.json
+#     pvScan-benchmark.py --compare results-R3.2.json
+#
+# Scans run with the step timer (TIMING:ENABLE).  Per-step overhead is the mean
+# step time outside the move, settle and pause phases, i.e. the time pvScan spends
+# capturing, handling files, putting messages, etc.; the mean time of each phase
+# is saved too.  The pre-flight estimate (SCAN:EST_DURATION) is saved for
+# comparison with the scan time.  Round trips are channel connects, non-monitored
+# gets, puts with wait and batched-get polls.  A configuration that doesn't finish
+# within --timeout is killed and counted as failed.
+#
+#################################################################################################################
+
+# Settings common to all scan configurations
+BASE = {':TIMING:ENABLE': 1, ':SCAN:MODE': 1, ':GRABIMAGES:ENABLE': 1, ':GRABIMAGES:CAMERA': 'SIM:CAM1', ':GRABIMAGES:N': 2,
+        ':ACQ:FIXED': 1, ':SCANPV1:PVNAME': 'SIM:MOTR1', ':SCANPV1:PVTYPE': 1, ':SCANPV1:NSTEPS': 10,
+        ':SCANPV1:START': 0.0, ':SCANPV1:STOP': 1.0, ':SCANPV2:PVNAME': 'SIM:MOTR2',
+        ':SCANPV2:PVTYPE': 1, ':SCANPV2:NSTEPS': 4, ':SCANPV2:START': 0.0, ':SCANPV2:STOP': 1.0}
+PUMPPROBE = {':ACQ:FIXED': 0, ':ACQ:PUMP_PROBE': 1, ':ACQ:STATIC': 1, ':ACQ:PUMP_BG': 1,
+        ':ACQ:DARK_CURRENT': 1, ':SHUTTER1:PVNAME': 'SIM:SHUTTER1', ':SHUTTER1:TYPE': 1,
+        ':SHUTTER2:PVNAME': 'SIM:SHUTTER2', ':SHUTTER2:TYPE': 1,
+        ':SHUTTER3:PVNAME': 'SIM:SHUTTER3', ':SHUTTER3:TYPE': 1}
+
+CONFIGS = [
+    ('scan-1d', 'scan', dict(BASE)),
+    ('scan-2d', 'scan', dict(BASE, **{':SCAN:MODE': 2})),
+    ('scan-nograb', 'scan', dict(BASE, **{':GRABIMAGES:ENABLE': 0})),
+]
+CONFIGS += [('capture-%d' % (mode), 'scan', dict(BASE, **{':GRABIMAGES:CAPTUREMODE': mode}))
+        for mode in range(6)]
+CONFIGS += [('pumpprobe-4acq', 'scan', dict(BASE, **PUMPPROBE))]
+CONFIGS += [('datalogger-%dpv-%dhz' % (nPvs, rate), 'datalogger', {'nPvs': nPvs, ':DATA:INT': 1.0/rate})
+        for nPvs, rate in ((10, 10), (100, 10), (10, 100), (100, 100))]
+
+
+def runOne(name, args):
+    """Run one configuration in this process and return its results."""
+    import simioc
+    kind, settings = [(kind, settings) for name0, kind, settings in CONFIGS if name0 == name][0]
+    tmpdir = tempfile.mkdtemp(prefix='pvscan-benchmark-')
+    os.environ['NFSHOME'] = tmpdir
+    t0 = time()
+    ioc = simioc.install(filepath=tmpdir + '/data/', speed=args.speed, latency=args.latency)
+    ioc.addMotor('SIM:MOTR1', velo=100.0, llm=-10.0, hlm=10.0)
+    ioc.addMotor('SIM:MOTR2', velo=100.0, llm=-10.0, hlm=10.0)
+    ioc.addCamera('SIM:CAM1', acquireTime=0.005, acquirePeriod=0.01)
+    for i in range(3):
+        ioc.addShutter('SIM:SHUTTER%d' % (i+1))
+    ioc.configure(dict((key, value) for key, value in settings.items() if key.startswith(':')))
+    import pvscan
+    result = {'importTime': time() - t0}
+    if kind == 'scan':
+        exp = pvscan.Experiment(npvs=2, nshutters=3, log=False)
+        result['startupTime'] = time() - t0
+        counts0 = dict(ioc.counts)
+        roundTrips0 = ioc.roundTrips()
+        t1 = time()
+        pvscan.pvNDScan(exp, exp.scanpvs[:exp.scanmode], exp.grabber, exp.shutters)
+        scanTime = time() - t1
+        nSteps = 1
+        for pv in exp.scanpvs[:exp.scanmode]:
+            nSteps *= len(pv.scanPos)
+        timer = pvscan.stepTimer
+        phases = dict((phase, total/max(1, timer.nSteps)) for phase, total in timer.totals.items())
+        result.update(nSteps=nSteps, scanTime=scanTime, phases=phases,
+                estimate=ioc.get(ioc.pvPrefix + ':SCAN:EST_DURATION'),
+                overheadPerStep=phases['step'] - phases['move'] - phases['settle'] - phases['pause'],
+                roundTripsPerStep=float(ioc.roundTrips() - roundTrips0)/nSteps,
+                counts=dict((key, value - counts0.get(key, 0)) for key, value in ioc.counts.items()))
+    elif kind == 'datalogger':
+        pvnames = ['SIM:LOG:PV%03d' % (i) for i in range(settings['nPvs'])]
+        for pvname in pvnames:
+            ioc.addRecord(pvname, 0.0)
+        dataLog = pvscan.DataLogger(filepath=tmpdir + '/', pvlist=[pvscan.getPV(pvname) for pvname in pvnames])
+        result['startupTime'] = time() - t0
+        roundTrips0 = ioc.roundTrips()
+        dataLog.start()
+        sleep(args.logTime)
+        dataLog.stop()
+        dataLog.join()
+        with open(dataLog.dataFilename) as fh:
+            nSamples = len([line for line in fh if line[:2].isdigit()])
+        result.update(nSamples=nSamples, targetRate=1.0/settings[':DATA:INT'],
+                rate=nSamples/args.logTime,
+                roundTripsPerSample=float(ioc.roundTrips() - roundTrips0)/max(1, nSamples))
+    ioc.shutdown()
+    return result
+
+
+def runAll(names, args):
+    """Run configurations, each in a subprocess; return {name: results}."""
+    results = {}
+    for name in names:
+        resultFile = tempfile.mktemp(suffix='.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', name, '--result-file', resultFile,
+                '--speed', str(args.speed), '--latency', str(args.latency), '--log-time', str(args.logTime)]
+        print('Running %s...' % (name))
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(cmd, stdout=devnull if not args.verbose else None)
+            deadline = time() + args.timeout
+            while process.poll() is None and time() < deadline:
+                sleep(0.1)
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+                print('  %s timed out after %g s' % (name, args.timeout))
+                results[name] = {'failed': True}
+                continue
+        status = process.returncode
+        if status or not os.path.isfile(resultFile):
+            print('  %s failed (exit status %s)' % (name, status))
+            results[name] = {'failed': True}
+            continue
+        with open(resultFile) as fh:
+            results[name] = json.load(fh)
+        os.remove(resultFile)
+        print('  ' + summary(results[name]))
+        phases = results[name].get('phases')
+        if phases:
+            print('  s/step: ' + ', '.join(['%s %.3f' % (phase, phases[phase]) for phase in 
+                    ('step', 'move', 'settle', 'pause', 'capture', 'other') if phase in phases]))
+    return results
+
+
+def summary(result):
+    """One-line summary of a result."""
+    keys = ('startupTime', 'overheadPerStep', 'roundTripsPerStep', 'rate', 'roundTripsPerSample')
+    return ', '.join(['%s=%.4g' % (key, result[key]) for key in keys if key in result])
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each metric from the baseline; return the number of regressions
+       (metrics more than threshold (fraction) worse; for rate, lower is worse)."""
+    nRegressions = 0
+    print('%-24s %-20s %12s %12s %8s' % ('Configuration', 'Metric', 'Baseline', 'Current', 'Change'))
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base or result.get('failed') or base.get('failed'):
+            continue
+        for key in ('startupTime', 'overheadPerStep', 'roundTripsPerStep', 'rate', 'roundTripsPerSample'):
+            if key not in result or key not in base:
+                continue
+            change = (result[key] - base[key])/abs(base[key]) if base[key] else 0.0
+            worse = -change if key == 'rate' else change
+            flag = ''
+            if worse > threshold:
+                flag = ' REGRESSION'
+                nRegressions += 1
+            print('%-24s %-20s %12.4g %12.4g %+7.1f%%%s' % (name, key, base[key], result[key], 100*change, flag))
+    return nRegressions
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark pvScan overhead against the simulated IOC.')
+    parser.add_argument('configs', nargs='*', help='Configurations to run (default: all): %s'
+            % (', '.join([name for name, kind, settings in CONFIGS])))
+    parser.add_argument('--output', help='Save results to this JSON file')
+    parser.add_argument('--compare', help='Compare results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help='Relative change counted as a regression (default 0.1)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Simulation speed-up factor')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated CA round-trip latency (s)')
+    parser.add_argument('--log-time', dest='logTime', type=float, default=2.0,
+            help='DataLogger run time per configuration (s)')
+    parser.add_argument('--timeout', type=float, default=600.0,
+            help='Time limit per configuration (s, default 600)')
+    parser.add_argument('--verbose', action='store_true', help='Show scan output')
+    parser.add_argument('--run-one', dest='runOne', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', dest='resultFile', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.runOne:
+        result = runOne(args.runOne, args)
+        with open(args.resultFile, 'w') as fh:
+            json.dump(result, fh)
+        sys.exit(0)
+    names = args.configs or [name for name, kind, settings in CONFIGS]
+    unknown = [name for name in names if name not in [name0 for name0, kind, settings in CONFIGS]]
+    if unknown:
+        parser.error('Unknown configuration(s): %s' % (', '.join(unknown)))
+    results = runAll(names, args)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'revision': gitRevision(), 'python': platform.python_version(),
+                    'speed': args.speed, 'latency': args.latency, 'results': results}, fh, indent=2)
+        print('Results saved to %s' % (args.output))
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
+
+
+### End ##########################################################################
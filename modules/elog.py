@@ -3,107 +3,473 @@
 
 from __future__ import print_function
 import argparse
+import collections
+import fcntl
 import json
 import logging
 import os
 import requests
+import signal
+import subprocess
 import sys
-from time import sleep
-from epics import PV, ca, caget, caput
+from threading import Thread, Lock, Condition
+from time import gmtime, sleep, strftime, time
+from epics import PV, ca, caget, caput, dbr
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 #################################################################################################################
 
+def getParams(pvnames, timeout=2.0):
+    """Get PV values as strings in one batch: create all channels (sending all the 
+       searches), connect, send all the gets, poll once, then collect the replies, so
+       the time taken hardly grows with the number of PVs.  Enums are fetched as 
+       DBR_STRING, to get their state names.  Returns ({pvname: value}, disconnected),
+       where PVs that did not connect (or reply) within timeout have the value None
+       and are listed in disconnected."""
+    chids = collections.OrderedDict()
+    for pvname in pvnames:
+        if pvname and pvname not in chids:
+            chids[pvname] = ca.create_channel(pvname, connect=False, auto_cb=False)
+    deadline = time() + timeout
+    ftypes = {}
+    for pvname, chid in chids.items():
+        if ca.connect_channel(chid, timeout=max(0.001, deadline - time())):
+            ftypes[pvname] = dbr.STRING if ca.field_type(chid) == dbr.ENUM else None
+            ca.get(chid, ftype=ftypes[pvname], wait=False)
+    ca.poll()
+    values = {}
+    for pvname, chid in chids.items():
+        values[pvname] = None
+        if pvname in ftypes:
+            values[pvname] = ca.get_complete(chid, ftype=ftypes[pvname], as_string=True, 
+                    timeout=max(0.001, deadline - time()))
+    disconnected = [pvname for pvname, value in values.items() if value is None]
+    if disconnected:
+        logging.warning('getParams: %d of %d PVs did not connect: %s' 
+                % (len(disconnected), len(chids), ', '.join(disconnected)))
+    return values, disconnected
+
+
+def getParamsSerial(pvnames):
+    """Get PV values as strings one at a time, with a PV object each (for comparison 
+       with getParams)."""
+    pvdata = {}
+    for name in pvnames:
+        pv = PV(name)
+        pvdata[pv.pvname] = pv.get(as_string=True)
+    return pvdata
+
+
+def getExpInfo(session, url, timeout=10.0):
+    """Look up the active experiment at the elog server url; return (experiment name,
+       sample name), or None if the server can't be reached or gives no answer."""
+    try:
+        resp = session.get('{0}lgbk/ws/activeexperiments'.format(url), timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logging.warning('getExpInfo: Failed to get experiment name: {0}'.format(e))
+        return None
+    if resp.status_code != requests.codes.ok:
+        logging.warning('getExpInfo: Failed to get experiment name, response={0}'.format(resp))
+        return None
+    try:
+        value = resp.json()['value'][0]
+        return (value['name'], value['current_sample'])
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        logging.warning('getExpInfo: Invalid experiment info: {0}'.format(e))
+        return None
+
+
+def postOnce(session, url, data=None, timeout=10.0, t=None):
+    """Post once; t (the time the post was made, e.g. from the journal) is sent as the
+       time parameter (UTC, ISO 8601).  Returns (status, error), status being 'done', 
+       'failed' (client error, not worth retrying), or None (connection or server error,
+       to be retried)."""
+    params = {'time': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(t))} if t is not None else None
+    try:
+        resp = session.post(url, json=data, params=params, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        return None, e
+    if resp.status_code == requests.codes.ok:
+        return 'done', None
+    return ('failed' if resp.status_code < 500 else None), 'response={0}'.format(resp)
+
+
+class ElogSpool():
+    """Append-only journal (JSON lines) of elog posts, and a thread sending them in order.
+       Each post is journaled as {"op": "post", "id": ..., "base": ..., "exp": ..., 
+       "endpoint": ..., "data": ..., "time": ...} before it is sent, then 
+       {"op": "done", "id": ...} once the server has taken it ("failed" if the server 
+       rejects it), so posts still pending when the process ends are sent, in order, by
+       the next ElogSpool on the same file (at least once).  Posts journaled without an 
+       experiment (the lookup failed) go to the experiment active when they are sent.
+       Sends that fail with a connection or server error are retried, at increasing 
+       intervals up to maxDelay, until they go through.  Only one ElogSpool uses a 
+       journal at a time (a lock on <filename>.lock, holding the PID of its process, 
+       as "replay:<pid>" for a replayer); opening one stops a background replayer (see 
+       startReplayer) still sending from it, but waits for any other holder, failing 
+       with IOError after lockTimeout.  If nothing is pending when the spool is 
+       opened, the journal is started afresh."""
+    def __init__(self, filename, session, timeout=10.0, retryDelay=0.5, maxDelay=60.0, lockTimeout=10.0,
+            replayer=False):
+        self.filename = filename
+        self.session = session
+        self.timeout = timeout
+        self.retryDelay = retryDelay
+        self.maxDelay = maxDelay
+        self.failed = []  # URLs of posts rejected by the server
+        self.pending = collections.deque()
+        self._expnames = {}  # Server URL --> active experiment, for posts journaled without one
+        self._nextId = 1
+        self._stop = False
+        self._wake = Condition(Lock())
+        if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self._lock(lockTimeout, replayer)
+        self._load()
+        self._file = open(filename, 'a')
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _lock(self, timeout, replayer=False):
+        """Lock the journal, stopping a replayer that holds it."""
+        self._lockFile = open(self.filename + '.lock', 'a+')
+        t0 = time()
+        stopped = False
+        while True:
+            try:
+                fcntl.flock(self._lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if time() - t0 > timeout:
+                    self._lockFile.close()
+                    raise IOError('ElogSpool: {0} is in use'.format(self.filename))
+            if not stopped:
+                self._lockFile.seek(0)
+                pid = self._replayerPid(self._lockFile.read().strip())
+                if pid is not None:
+                    logging.info('ElogSpool: stopping replayer (pid {0}) of {1}'.format(pid, self.filename))
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                stopped = True
+            sleep(0.05)
+        self._lockFile.seek(0)
+        self._lockFile.truncate()
+        self._lockFile.write(('replay:' if replayer else '') + str(os.getpid()))
+        self._lockFile.flush()
+
+    @staticmethod
+    def _replayerPid(holder):
+        """PID of the replayer holding the lock (lock file contents holder), or None if
+           the holder is not a replayer.  Where /proc is available, the PID must still 
+           be an elog.py --replay process (PIDs get reused)."""
+        if not holder.startswith('replay:') or not holder[len('replay:'):].isdigit():
+            return None
+        pid = int(holder[len('replay:'):])
+        if os.path.isdir('/proc'):
+            try:
+                with open('/proc/{0}/cmdline'.format(pid), 'rb') as fh:
+                    cmdline = fh.read().split(b'\0')
+            except (IOError, OSError):
+                return None
+            if b'--replay' not in cmdline or not any(arg.endswith(b'elog.py') for arg in cmdline):
+                return None
+        return pid
+
+    def _load(self):
+        """Read the posts still pending from the journal."""
+        if not os.path.isfile(self.filename):
+            return
+        records = collections.OrderedDict()
+        with open(self.filename, 'r') as fh:
+            lines = fh.readlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:  # e.g. a line cut short by a crash
+                continue
+            self._nextId = max(self._nextId, record['id'] + 1)
+            if record['op'] == 'post':
+                records[record['id']] = record
+            else:
+                records.pop(record['id'], None)
+        self.pending.extend(records.values())
+        if self.pending:
+            logging.warning('ElogSpool: %d elog posts pending in %s, sending them first' 
+                    % (len(self.pending), self.filename))
+            if lines and not lines[-1].endswith('\n'):
+                with open(self.filename, 'a') as fh:
+                    fh.write('\n')  # Don't append to a line cut short
+        else:
+            open(self.filename, 'w').close()
+
+    def _write(self, record, sync=False):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def append(self, url, expname, endpoint, data=None, t=None):
+        """Journal a post to endpoint of experiment expname (None: the active experiment
+           when it is sent) at server url, made at time t (default: now), and queue it."""
+        with self._wake:
+            record = {'op': 'post', 'id': self._nextId, 'base': url, 'exp': expname, 
+                    'endpoint': endpoint, 'data': data, 'time': time() if t is None else t}
+            self._nextId += 1
+            self._write(record, sync=True)
+            self.pending.append(record)
+            self._wake.notify_all()
+
+    def _url(self, record):
+        """URL of a post, or None if its experiment can't be looked up now."""
+        if 'endpoint' not in record:
+            return record['url']
+        expname = record['exp'] or self._expnames.get(record['base'])
+        if expname is None:
+            info = getExpInfo(self.session, record['base'], self.timeout)
+            if info is None:
+                return None
+            expname = self._expnames[record['base']] = info[0]
+            logging.info('ElogSpool: sending posts without an experiment to %s' % (expname))
+        return '{0}run_control/{1}/ws/{2}'.format(record['base'], expname, record['endpoint'])
+
+    def _run(self):
+        """Send pending posts in order."""
+        delay = self.retryDelay
+        while True:
+            with self._wake:
+                while not self.pending and not self._stop:
+                    self._wake.wait()
+                if self._stop:
+                    return
+                record = self.pending[0]
+            url = self._url(record)
+            if url is None:
+                status, error = None, 'experiment unknown'
+            else:
+                status, error = postOnce(self.session, url, record['data'], self.timeout, record.get('time'))
+            with self._wake:
+                if self._file.closed:  # Closed while sending; the post stays pending
+                    return
+                if status is None:
+                    logging.info('ElogSpool: %s failed (%s), retrying in %g s' % (url, error, delay))
+                    self._wake.wait(delay)
+                    delay = min(2*delay, self.maxDelay)
+                    continue
+                if status == 'failed':
+                    logging.warning('ElogSpool: %s rejected, %s' % (url, error))
+                    self.failed.append(url)
+                delay = self.retryDelay
+                self.pending.popleft()
+                self._write({'op': status, 'id': record['id']})
+                self._wake.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all pending posts have been sent (or timeout); return True if done."""
+        t0 = time()
+        with self._wake:
+            while self.pending and (timeout is None or time() - t0 < timeout):
+                self._wake.wait(None if timeout is None else timeout - (time() - t0))
+            return not self.pending
+
+    def close(self):
+        """Stop sending and unlock the journal; pending posts stay in the journal."""
+        with self._wake:
+            self._stop = True
+            self._wake.notify_all()
+        self._thread.join(self.timeout)
+        with self._wake:
+            if self.pending:
+                logging.warning('ElogSpool: %d elog posts left in %s' % (len(self.pending), self.filename))
+            self._file.close()
+        fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+        self._lockFile.close()
+
+
+def startReplayer(filename, user, password, maxTime=86400.0):
+    """Start a background process (elog.py --replay) that sends the posts pending in the
+       spool journal filename, for up to maxTime seconds, after this process ends.  
+       Its output goes to <filename>.log.  The password is passed in ELOG_PASSWORD.
+       Returns the Popen."""
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    env = dict(os.environ, ELOG_PASSWORD=password)
+    with open(filename + '.log', 'a') as log:
+        return subprocess.Popen([sys.executable, script, '--replay', '--spool', filename, '--user', user,
+                '--max-time', str(maxTime)], env=env, stdin=open(os.devnull), stdout=log, 
+                stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
+
 class Elog():
-    """Post an elog..."""
-    def __init__(self, expname, user, password, url, samplename=None):
+    """Post an elog...
+       All requests go through one requests.Session (one authenticated keep-alive 
+       connection).  With background=True (the default), start, add_params and end 
+       only queue their posts, which a background thread sends in order, retrying 
+       failed posts (connection errors and server errors) with increasing delays; 
+       so they never hold up the scan.  Call close() at the end to wait for the posts.
+       Only the experiment lookup (expname=None) and the run param fetch are done 
+       right away.
+       If the experiment lookup fails (within lookupTimeout), expname is TestExp0, 
+       but posts go to the experiment active when they are sent.  Each post carries
+       the time it was made.
+       With spool (a filename), posts are journaled in an ElogSpool instead, and sent
+       from there until the server takes them, so none are lost when the server is
+       slow or unreachable; posts not sent by close() are left to a background
+       replayer (if replay is set)."""
+    def __init__(self, expname, user, password, url, samplename=None, background=True, 
+            retries=3, retryDelay=0.5, timeout=10.0, caTimeout=2.0, spool=None, 
+            lookupTimeout=2.0, replay=True):
         self.className = self.__class__.__name__
         functionName = '__init__'
         logging.debug('%s.%s' % (self.className, functionName))
+        self._url = url + '/' if not url.endswith('/') else url
+        self._session = requests.Session()
+        self._session.auth = requests.auth.HTTPBasicAuth(user, password)
         self._user = user
         self._password = password
-        self._url = url + '/' if not url.endswith('/') else url
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.timeout = timeout
+        self.caTimeout = caTimeout
+        self.lookupTimeout = lookupTimeout
+        self.replay = replay
+        self.replayer = None  # Background replayer, if started by close()
+        self.disconnected = []  # Run param PVs that did not connect
+        self.failed = []  # Endpoints of posts that failed after all retries
+        self._postExpname = expname  # Experiment to post to; None until looked up
         if expname is None:
             expname, samplename = self._get_exp_info()
         self.expname = expname
         self.samplename = samplename
-        self._serverURLPrefix = '{0}run_control/{1}/ws/'.format(self._url, self.expname)
+        self._spool = ElogSpool(spool, self._session, timeout, retryDelay) if spool else None
+        self._queue = None
+        if background:
+            self._queue = queue.Queue()
+            self._thread = Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
 
     def _get_exp_info(self):
-        functionName = '_get_exp_info'
-        resp = requests.get('{0}lgbk/ws/activeexperiments'.format(self._url), 
-                auth=requests.auth.HTTPBasicAuth(self._user, self._password))
-        if resp.status_code != requests.codes.ok:
-            logging.warning('{0}.{1}: Failed to get experiment name, response={2}'
-                    .format(self.className, functionName, resp))
+        """Look up the active experiment; (TestExp0, TestSample) if that fails."""
+        info = getExpInfo(self._session, self._url, self.lookupTimeout)
+        if info is None:
             return ('TestExp0', 'TestSample')
-        exp_name = resp.json()['value'][0]['name']
-        sample_name = resp.json()['value'][0]['current_sample']
-        return (exp_name, sample_name)
+        self._postExpname = info[0]
+        return info
+
+    def _serverURLPrefix(self):
+        """URL prefix of the experiment's posts, or None if the experiment is unknown."""
+        if self._postExpname is None:
+            info = getExpInfo(self._session, self._url, self.timeout)
+            if info is None:
+                return None
+            self._postExpname = info[0]
+        return '{0}run_control/{1}/ws/'.format(self._url, self._postExpname)
+
+    def _post(self, endpoint, data=None):
+        """Queue a post (or send it now if not in background mode)."""
+        if self._queue is None:
+            return self._send(endpoint, data, time())
+        self._queue.put((endpoint, data, time()))
+        return True
+
+    def _send(self, endpoint, data=None, t=None):
+        """Post, made at time t, with retries (or journal it, if spooling).  Returns True 
+           on success."""
+        functionName = '_send'
+        if self._spool:
+            self._spool.append(self._url, self._postExpname, endpoint, data, t)
+            return True
+        for attempt in range(self.retries + 1):
+            prefix = self._serverURLPrefix()
+            if prefix is None:
+                status, error = None, 'experiment unknown'
+            else:
+                status, error = postOnce(self._session, prefix + endpoint, data, self.timeout, t)
+            if status == 'done':
+                return True
+            if status == 'failed':  # Client error: retrying won't help
+                break
+            if attempt < self.retries:
+                logging.info('{0}.{1}: {2} failed ({3}), retrying'
+                        .format(self.className, functionName, endpoint, error))
+                sleep(self.retryDelay*2**attempt)
+        logging.warning('{0}.{1}: Failed to post {2}, {3}'
+                .format(self.className, functionName, endpoint, error))
+        self.failed.append(endpoint)
+        return False
+
+    def _worker(self):
+        """Send queued posts in order."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._send(*item)
+            except Exception as e:
+                logging.warning('{0}._worker: {1}'.format(self.className, e))
+                self.failed.append(item[0])
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """Wait until all queued posts have been sent (or timeout); return True if done."""
+        t0 = time()
+        if self._queue is not None:
+            while self._queue.unfinished_tasks and (timeout is None or time() - t0 < timeout):
+                sleep(0.01)
+            if self._queue.unfinished_tasks:
+                return False
+        if self._spool:
+            return self._spool.flush(None if timeout is None else max(0.0, timeout - (time() - t0)))
+        return True
+
+    def close(self, timeout=None):
+        """Wait for the queued posts, stop the background thread(s) and close the session.
+           Returns True if all posts succeeded.  Spooled posts not sent by then stay in 
+           the spool, and are sent by a background replayer (if replay is set), the next
+           Elog using the spool, or elog.py --replay."""
+        done = self.flush(timeout)
+        if self._queue is not None:
+            self._queue.put(None)
+            # With a spool, the posts still queued are only journaled, so wait for them
+            if done or self._spool:
+                self._thread.join()
+            self._queue = None
+        if self._spool:
+            self._spool.close()
+            self.failed.extend(self._spool.failed)
+            if self._spool.pending and self.replay:
+                self.replayer = startReplayer(self._spool.filename, self._user, self._password)
+                logging.info('{0}.close: replaying {1} posts from {2} in the background (pid {3})'
+                        .format(self.className, len(self._spool.pending), self._spool.filename, 
+                        self.replayer.pid))
+        self._session.close()
+        return done and not self.failed
 
     def start(self):
         """Start run..."""
-        functionName = 'start'
-        resp = requests.post(self._serverURLPrefix + "start_run",
-                auth=requests.auth.HTTPBasicAuth(self._user, self._password))
-        sleep(0.5)
-        if resp.status_code != requests.codes.ok:
-            logging.warning('{0}.{1}: Failed to start elog entry, response={2}'
-                    .format(self.className, functionName, resp))
-            return False
-        else:
-            return True
+        return self._post('start_run')
 
     def _set_params(self):
         """Set run params..."""
-        functionName = '_set_params'
-        pvdata = {}
-        for name in self._pvnamelist:
-            pv = PV(name)
-            pvdata[pv.pvname] = pv.get(as_string=True)
-        return pvdata
-
-    def _set_params2(self):
-        """Set run params..."""
-        functionName = '_set_params'
-        pvdata = {}
-        for name in self._pvnamelist:
-            chid = ca.create_channel(name, connect=False, auto_cb=False) # note 1
-            pvdata[name] = [chid, None]
-        for name, data in pvdata.items():
-            ca.connect_channel(data[0])
-        ca.poll()
-        for name, data in pvdata.items():
-            ca.get(data[0], wait=False)  # note 2
-        ca.poll()
-        for name, data in pvdata.items():
-            val = ca.get_complete(data[0])
-            pvdata[name][1] = val
-        #return { name: data[1] for name, data in pvdata.items()}
-        ret = dict((name, data[1]) for name, data in pvdata.items())
-        print(ret)
-        return ret
+        params, self.disconnected = getParams(self._pvnamelist, timeout=self.caTimeout)
+        return params
 
     def add_params(self, pvnamelist=None):
-        """Add run params..."""
-        functionName = 'add_params'
+        """Add run params (their values now, only the post is queued)..."""
         if pvnamelist is None: pvnamelist = []
         self._pvnamelist = pvnamelist
-        resp = requests.post(self._serverURLPrefix + "add_run_params", json=self._set_params(), 
-                auth=requests.auth.HTTPBasicAuth(self._user, self._password))
-        sleep(0.5)
-        if resp.status_code != requests.codes.ok:
-            logging.warning('{0}.{1}: Failed to add elog params, response={2}'
-                    .format(self.className, functionName, resp))
+        return self._post('add_run_params', self._set_params())
 
     def end(self):
         """End run..."""
-        functionName = 'end'
-        resp = requests.post(self._serverURLPrefix + "end_run", 
-                auth=requests.auth.HTTPBasicAuth(self._user, self._password))
-        if resp.status_code != requests.codes.ok:
-            logging.warning('{0}.{1}: Failed to end elog entry, response={2}'
-                    .format(self.className, functionName, resp))
-
+        return self._post('end_run')
 
 
 #--- Self-test code -------------
@@ -111,25 +477,48 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     requiredNamed = parser.add_argument_group('Required named arguments')
     requiredNamed.add_argument("--user", help="The operator userid", required=True)
-    requiredNamed.add_argument("--password", help="The operator password", required=True)
+    requiredNamed.add_argument("--password", help="The operator password (default: $ELOG_PASSWORD)", 
+            required='ELOG_PASSWORD' not in os.environ, default=os.environ.get('ELOG_PASSWORD'))
     parser.add_argument("--experiment", help="The name of the experiment")
     parser.add_argument("--url", help="URL to post to; this is only the prefix. \
             For example, https://pswww.slac.stanford.edu/ws-auth/uedlgbk/",
             default="https://pswww.slac.stanford.edu/ws-auth/uedlgbk/")
+    parser.add_argument("--spool", help="Spool posts in this journal file")
+    parser.add_argument("--replay", action="store_true", 
+            help="Only send the posts pending in the --spool journal, then exit")
+    parser.add_argument("--max-time", dest="maxTime", type=float, 
+            help="With --replay, give up after this many seconds (default: retry until sent)")
     args = parser.parse_args()
 
+    if args.replay:
+        if not args.spool:
+            parser.error('--replay needs --spool')
+        logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+        session = requests.Session()
+        session.auth = requests.auth.HTTPBasicAuth(args.user, args.password)
+        spool = ElogSpool(args.spool, session, replayer=True)
+        print('Sending {0} pending posts from {1}...'.format(len(spool.pending), args.spool))
+        sys.stdout.flush()
+        done = spool.flush(args.maxTime)
+        spool.close()
+        print('Done ({0} rejected, {1} left).'.format(len(spool.failed), len(spool.pending)))
+        sys.exit(0 if done and not spool.failed else 1)
+
     pvlist = ['ASTA:PV04:DATE_TIME', 'ASTA:AO:BK05:V0080', 'ASTA:PV04:DATA:FILEPATH']
-    elog = Elog(args.experiment, args.user, args.password, args.url)
+    elog = Elog(args.experiment, args.user, args.password, args.url, spool=args.spool)
     try:
         print('Creating elog entry...')
+        t0 = time()
         elog.start()
         elog.add_params(pvnamelist=pvlist)
+        print('Queued start and params in {0:.3f} s'.format(time() - t0))
         print('Experiment name: {0}, Sample name: {1}'.format(elog.expname, elog.samplename))
         sleep(2.0) # Simulate some work
     finally:
         elog.end()
-        print('Done creating elog entry.')
-    
+        success = elog.close(timeout=30.0)
+        print('Done creating elog entry ({0}).'.format('OK' if success else 'failed: ' + ', '.join(elog.failed)))
+
     sys.exit(0)
     
 
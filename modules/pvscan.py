@@ -2,16 +2,28 @@
 # pvScan module
 
 from __future__ import print_function
+import ast
+import collections
+import contextlib
 import datetime
+import functools
+import itertools
+import json
 import math
 import logging
+import operator
 import os
 import random
 import re
+import signal
 import subprocess
 import sys
 from time import sleep, time
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, current_thread
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
@@ -21,13 +33,253 @@ try:
 except ImportError:
     print('PIL not installed')
 
+class ChannelPool():
+    """Process-wide registry of PV channels, keyed by PV name and monitor flag, so 
+       that each channel is only created (and connected) once.  Optional records 
+       (see OPTIONAL_RECORDS) that don't connect are remembered as missing, so they 
+       only cost one connection timeout per process."""
+    def __init__(self):
+        self._pvs = {}
+        self._lock = Lock()
+        self.created = 0
+        self.reused = 0
+        self.missing = set()
+
+    def get(self, pvname, auto_monitor=None):
+        """Return the PV object for pvname, creating it if needed."""
+        key = (pvname, auto_monitor)
+        with self._lock:
+            pv = self._pvs.get(key)
+            if pv is None:
+                pv = PV(pvname, auto_monitor=auto_monitor)
+                self._pvs[key] = pv
+                self.created += 1
+            else:
+                self.reused += 1
+        return pv
+
+    def connectAll(self, pvnames, timeout=1.0):
+        """Create the channels for pvnames and wait for them to connect, all within 
+           timeout; the ones that don't connect are remembered as missing."""
+        pvs = [(pvname, self.get(pvname)) for pvname in pvnames if pvname not in self.missing]
+        deadline = time() + timeout
+        for pvname, pv in pvs:
+            if not pv.connected and not pv.wait_for_connection(timeout=max(0.001, deadline - time())):
+                self.missing.add(pvname)
+        if self.missing:
+            logging.info('ChannelPool: not connected, skipped: %s' % (', '.join(sorted(self.missing))))
+
+    def optional(self, pvname, timeout=1.0):
+        """Return the PV object for an optional record, or None if it doesn't connect."""
+        if pvname in self.missing:
+            return None
+        pv = self.get(pvname)
+        if not pv.connected and not pv.wait_for_connection(timeout=timeout):
+            logging.info('ChannelPool: %s not connected, skipped' % (pvname))
+            self.missing.add(pvname)
+            return None
+        return pv
+
+    def __str__(self):
+        return '%d channels created, %d reused' % (self.created, self.reused)
+
+
+channelPool = ChannelPool()
+
+
+def getPV(pvname, auto_monitor=None):
+    """Return a shared PV object from the channel pool."""
+    return channelPool.get(pvname, auto_monitor)
+
+
+# pvScan IOC records (after the prefix) that older IOC databases don't have, so 
+# they are read with getOptional and written with putOptional (see README.md)
+OPTIONAL_RECORDS = (':SCAN:RESUME', ':SCAN:EST_DURATION', ':SCAN:EST_FINISH', ':ACQ:OPTIMIZE', 
+        ':ACQ:SEQUENCE:FILE', ':ACQ:SEQUENCE:TABLE', ':ACQ:BGCACHE:ENABLE', ':ACQ:BGCACHE:NSTEPS', 
+        ':ACQ:BGCACHE:INTERVAL', ':GRABIMAGES:ARRAY:ENABLE', ':GRABIMAGES:REDUCE:ENABLE', 
+        ':GRABIMAGES:REDUCE:NOSAVE', ':GRABIMAGES:REDUCE:ROIS', ':GRABIMAGES:REDUCE:PROJ', 
+        ':RUNSCRIPT:ASYNC', ':RUNSCRIPT:MAXJOBS', ':RUNSCRIPT:TIMEOUT', ':RUNSCRIPT:WORKER', 
+        ':TIMING:ENABLE', ':TIMING:WINDOW', ':TIMING:STEP', ':TIMING:MOVE', ':TIMING:SETTLE', 
+        ':TIMING:SHUTTERS', ':TIMING:CAPTURE', ':TIMING:WRITE', ':TIMING:RENAME', ':TIMING:SCRIPT', 
+        ':TIMING:MSG', ':TIMING:PAUSE', ':TIMING:OTHER', ':CACOUNT:ENABLE', ':TRAJ:COUPLED1:PVNAME', 
+        ':TRAJ:COUPLED1:EXPR', ':TRAJ:COUPLED2:PVNAME', ':TRAJ:COUPLED2:EXPR')
+# Optional records of each scan PV (after :SCANPV<n>)
+OPTIONAL_SCANPV_RECORDS = (':FLY', ':ADAPTIVE', ':ADAPTIVE:NPOINTS', ':ADAPTIVE:FOMPV', ':ADAPTIVE:FOMTAG', 
+        ':SETTLE:ADAPTIVE', ':SETTLE:TOL', ':SETTLE:WINDOW', ':SETTLE:PVNAME')
+
+
+def connectOptional(npvs=2, timeout=1.0):
+    """Connect the optional records (of the pvScan IOC and of npvs scan PVs) all at 
+       once, so that missing ones cost one timeout in all."""
+    pvnames = [pvPrefix + name for name in OPTIONAL_RECORDS]
+    for i in range(npvs):
+        pvnames += [pvPrefix + ':SCANPV' + str(i+1) + name for name in OPTIONAL_SCANPV_RECORDS]
+    channelPool.connectAll(pvnames, timeout)
+
+
+def getOptional(pvname, default=None, as_string=False):
+    """Value of an optional record, or default if it doesn't connect (or has no value)."""
+    pv = channelPool.optional(pvname)
+    value = pv.get(as_string=as_string) if pv is not None else None
+    return default if value is None else value
+
+
+def putOptional(pvname, value):
+    """Put to an optional record; skipped if it doesn't connect."""
+    pv = channelPool.optional(pvname)
+    if pv is not None:
+        pv.put(value)
+
+
+def cagetMany(pvnames, as_string=False, timeout=2.0):
+    """Get many PVs in one batch: create all channels, send all the requests, then 
+       collect the replies, instead of one round trip per PV.  Returns a dict
+       {pvname: value}, with None for PVs that did not connect within timeout."""
+    chids = collections.OrderedDict()
+    for pvname in pvnames:
+        if pvname and pvname not in chids:
+            chids[pvname] = ca.create_channel(pvname, connect=False, auto_cb=False)
+    deadline = time() + timeout
+    connected = dict((pvname, ca.connect_channel(chid, timeout=max(0.001, deadline - time())))
+            for pvname, chid in chids.items())
+    for pvname, chid in chids.items():
+        if connected[pvname]:
+            ca.get(chid, as_string=as_string, wait=False)
+    ca.poll()
+    values = {}
+    for pvname, chid in chids.items():
+        values[pvname] = (ca.get_complete(chid, as_string=as_string, timeout=timeout) 
+                if connected[pvname] else None)
+    logging.debug('cagetMany: %d PVs, %d not connected' 
+            % (len(chids), len([x for x in connected.values() if not x])))
+    return values
+
+
+class CACounter():
+    """Opt-in instrumentation of PV get, put and connect: while enabled, the PV class
+       methods are wrapped to count calls and time spent per PV name and per calling
+       function.  Calls that wait for the IOC (gets not served from a monitor, puts
+       with wait, connects of channels not yet connected) are counted as blocking; in debug mode, blocking calls 
+       made inside the step loop are logged (once per PV and caller) and counted.
+       Enabled for one scan with CACOUNT:ENABLE (1 = count, 2 = count and debug), or 
+       for the whole process with the PVSCAN_CACOUNT environment variable (any value, 
+       or 'debug')."""
+    kinds = ('get', 'put', 'connect')
+
+    def __init__(self):
+        self.enabled = False
+        self.debug = False
+        self.inStepLoop = False
+        self._originals = {}
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear the counts."""
+        self.pvs = collections.defaultdict(lambda: [0, 0.0, 0])  # (kind, pvname): [calls, time, blocking]
+        self.callers = collections.defaultdict(lambda: [0, 0.0, 0])  # (kind, caller): [calls, time, blocking]
+        self.flagged = collections.Counter()  # (kind, pvname, caller): blocking calls in the step loop
+
+    def enable(self, debug=False):
+        """Wrap the PV methods (once) and start counting."""
+        self.debug = debug
+        if self.enabled:
+            return
+        for kind in self.kinds:
+            self._originals[kind] = getattr(PV, kind)
+            setattr(PV, kind, self._wrap(kind, self._originals[kind]))
+        self.enabled = True
+
+    def disable(self):
+        """Restore the PV methods."""
+        for kind, original in self._originals.items():
+            setattr(PV, kind, original)
+        self._originals = {}
+        self.enabled = False
+
+    def _wrap(self, kind, original):
+        counter = self
+        @functools.wraps(original)
+        def wrapper(pv, *args, **kws):
+            connected = kind == 'connect' and pv.connected
+            t0 = time()
+            try:
+                return original(pv, *args, **kws)
+            finally:
+                counter._count(kind, pv, time() - t0, args, kws, connected)
+        return wrapper
+
+    @staticmethod
+    def _caller():
+        """Name of the first calling function outside this class and the epics package."""
+        frame = sys._getframe(3)
+        while frame is not None and os.sep + 'epics' + os.sep in frame.f_code.co_filename:
+            frame = frame.f_back
+        if frame is None:
+            return '?'
+        return '%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+    def _count(self, kind, pv, elapsed, args, kws, connected=False):
+        if kind == 'get':
+            blocking = not kws.get('use_monitor', True) or pv.auto_monitor is False
+        elif kind == 'put':
+            blocking = bool(kws.get('wait', args[1] if len(args) > 1 else False))
+        else:
+            blocking = not connected
+        caller = self._caller()
+        with self._lock:
+            for stats in (self.pvs[(kind, pv.pvname)], self.callers[(kind, caller)]):
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += blocking
+            if self.debug and blocking and self.inStepLoop:
+                key = (kind, pv.pvname, caller)
+                self.flagged[key] += 1
+                if self.flagged[key] == 1:
+                    logging.warning('CACounter: blocking %s of %s in the step loop, from %s (%.1f ms)' 
+                            % (kind, pv.pvname, caller, 1e3*elapsed))
+
+    def report(self, filepath=None, n=10):
+        """Print the totals and the n busiest PVs and callers; write all counts to 
+           caCounts-NOW.txt in filepath.  Then reset the counts."""
+        with self._lock:
+            pvs, callers, flagged = dict(self.pvs), dict(self.callers), dict(self.flagged)
+            self.reset()
+        lines = []
+        for kind in self.kinds:
+            stats = [x for key, x in pvs.items() if key[0] == kind]
+            lines.append('CA %s: %d calls (%d blocking), %.3f s' % (kind, sum([x[0] for x in stats]), 
+                    sum([x[2] for x in stats]), sum([x[1] for x in stats])))
+        for title, table in (('PV', pvs), ('caller', callers)):
+            lines.append('Busiest by %s (kind, name, calls, blocking, time [s]):' % (title))
+            for key, x in sorted(table.items(), key=lambda item: -item[1][1])[:n]:
+                lines.append('  %-7s %-50s %7d %7d %9.3f' % (key[0], key[1], x[0], x[2], x[1]))
+        if flagged:
+            lines.append('Blocking calls in the step loop (kind, PV, caller, calls):')
+            for key, count in sorted(flagged.items(), key=lambda item: -item[1]):
+                lines.append('  %-7s %-50s %-30s %7d' % (key + (count,)))
+        for line in lines:
+            print(line)
+        if filepath and os.path.isdir(filepath):
+            with open(filepath + 'caCounts-' + NOW + '.txt', 'a') as outfile:
+                outfile.writelines([line + '\n' for line in lines])
+                outfile.write('All (kind, PV, calls, blocking, time [s]):\n')
+                for key, x in sorted(pvs.items()):
+                    outfile.write('  %-7s %-50s %7d %7d %9.3f\n' % (key[0], key[1], x[0], x[2], x[1]))
+
+
+caCounter = CACounter()
+if os.environ.get('PVSCAN_CACOUNT'):
+    caCounter.enable(debug=os.environ['PVSCAN_CACOUNT'] == 'debug')
+
+
 try:
     # PV prefix of pvScan IOC
     pvPrefix = os.environ['PVSCAN_PVPREFIX']
     # PV for status message
-    msgPv = PV(pvPrefix + ':MSG')
+    msgPv = getPV(pvPrefix + ':MSG')
     # PV for PID (for abort button)
-    pidPV = PV(pvPrefix + ':PID')
+    pidPV = getPV(pvPrefix + ':PID')
 except KeyError:
     print('PVSCAN_PVPREFIX not defined. Continuing...')
     pvPrefix = ''
@@ -35,11 +287,26 @@ except KeyError:
     pidPV = ''
 
 
+def stopScanProcess(pid):
+    """Stop the scan process pid (from the PID PV), for the abort scripts.  A scan script 
+       is killed.  pvScan-multiScan.py running scans in-process publishes its own PID; it
+       is sent SIGTERM instead, which aborts the scan and lets it restore the filepath
+       and RUNFLAG and end the elog entry.  Returns True if the scan was in-process."""
+    try:
+        with open('/proc/%d/cmdline' % (pid)) as fh:
+            cmdline = fh.read().split('\0')
+    except (IOError, OSError):
+        cmdline = []
+    inProcess = 'pvScan-multiScan.py' in [os.path.basename(arg) for arg in cmdline]
+    os.kill(pid, signal.SIGTERM if inProcess else signal.SIGKILL)
+    return inProcess
+
+
 ##################################################################################################################
 
 def loggingConfig():
     """Configure logging."""
-    debugFlag = PV(pvPrefix + ':DEBUG:ENABLE').get()
+    debugFlag = getPV(pvPrefix + ':DEBUG:ENABLE').get()
     logLevel = logging.DEBUG if debugFlag else logging.WARNING
     logging.basicConfig(format='%(levelname)s [%(asctime)s]: %(message)s', datefmt='%I:%M:%S', level=logLevel)
     logging.info('Start')
@@ -63,6 +330,124 @@ def timestamp(format='s'):
 # Global timestamp to be shared between classes
 NOW = timestamp('s')
 
+# Adaptive settling window (s) if SETTLE:WINDOW can't be read
+SETTLE_WINDOW = 0.1
+
+# Readback polling interval (s) while waiting for moves, and pause (s) after each image grab
+MOVE_POLL = 0.2
+GRAB_PAUSE = 0.5
+
+
+class StepTimer():
+    """Per-step timing of the phases of a scan step: moves, settling, shutter transitions, 
+       image capture, waiting for file writing, TIFF renaming, the user script, message 
+       puts and pauses.  Spans are timed exclusively (time in a nested span is not 
+       counted in the enclosing one), and time outside any span is counted as 'other'.
+       Each step is written as a row of stepTiming-NOW.csv in the scan directory, and
+       averages over the last window steps are put to the TIMING:<PHASE> PVs.  Only
+       spans in the thread that started the timer are timed."""
+    phases = ('move', 'settle', 'shutters', 'capture', 'write', 'rename', 'script', 'msg', 'pause')
+
+    def __init__(self):
+        self.running = False
+        self.nSteps = 0
+        self._thread = None
+        self._stack = []
+        self._outfile = None
+
+    def start(self, filepath=None, window=20, publish=True):
+        """Start timing; the first step starts now."""
+        self.stop()
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.totals = dict.fromkeys(self.phases + ('other', 'step'), 0.0)
+        self.rows = collections.deque(maxlen=max(1, int(window or 1)))
+        self.publish = publish
+        self.nSteps = 0
+        self._stack = []
+        self._thread = current_thread()
+        if filepath and os.path.isdir(filepath):
+            self._outfile = open(filepath + 'stepTiming-' + NOW + '.csv', 'a')
+            self._outfile.write(','.join(('step', 'label', 'total') + self.phases + ('other',)) + '\n')
+        self.running = True
+        self._t0 = time()
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        """Context manager timing a span of the given phase."""
+        if not self.running or current_thread() is not self._thread:
+            yield
+            return
+        t = time()
+        if self._stack:
+            parent = self._stack[-1]
+            self.times[parent[0]] += t - parent[1]
+        entry = [phase, t]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            t = time()
+            self._stack.pop()
+            self.times[phase] += t - entry[1]
+            if self._stack:
+                self._stack[-1][1] = t
+
+    def timed(self, phase):
+        """Decorator timing each call of a function as a span of the given phase."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kws):
+                with self.span(phase):
+                    return function(*args, **kws)
+            return wrapper
+        return decorator
+
+    def endStep(self, label=''):
+        """End the current step: write its row, publish averages and start the next step."""
+        if not self.running:
+            return
+        t = time()
+        total = t - self._t0
+        other = max(0.0, total - sum(self.times.values()))
+        row = [self.times[phase] for phase in self.phases] + [other]
+        self.nSteps += 1
+        if self._outfile:
+            self._outfile.write('%d,%s,%.6f,%s\n' % (self.nSteps, label, total, 
+                    ','.join(['%.6f' % (x) for x in row])))
+            self._outfile.flush()
+        for phase, x in zip(self.phases + ('other', 'step'), row + [total]):
+            self.totals[phase] += x
+        self.rows.append([total] + row)
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self._t0 = t
+        if self.publish:
+            self._publish()
+
+    def _publish(self):
+        """Put the averages over the last window steps to the TIMING PVs."""
+        means = np.mean(self.rows, axis=0)
+        putOptional(pvPrefix + ':TIMING:STEP', means[0])
+        for phase, mean in zip(self.phases + ('other',), means[1:]):
+            putOptional(pvPrefix + ':TIMING:' + phase.upper(), mean)
+
+    def stop(self):
+        """Stop timing and print the mean time per step of each phase."""
+        if not self.running:
+            return
+        self.running = False
+        if self._outfile:
+            self._outfile.close()
+            self._outfile = None
+        if self.nSteps:
+            printMsg('Step timing: %d steps, %.3f s/step: %s' % (self.nSteps, 
+                    self.totals['step']/self.nSteps, ', '.join(['%s %.3f' % (phase, 
+                    self.totals[phase]/self.nSteps) for phase in self.phases + ('other',)
+                    if self.totals[phase]])))
+
+
+stepTimer = StepTimer()
+
+
         
 class Experiment:
     """Set experiment name, filepath, and scan mode."""
@@ -73,10 +458,10 @@ class Experiment:
         logging.info('%s.%s' % (self.className, functionName))
         logging.debug('{0}.{1}: abort = {2}'.format(self.className, functionName, abortFlag))
         if expname is None:
-            expname = PV(pvPrefix + ':SCAN:SAMPLE_NAME').get()
+            expname = getPV(pvPrefix + ':SCAN:SAMPLE_NAME').get()
         if ' ' in expname: expname = expname.replace(' ', '_')
         if scanname is None:
-            scanname = PV(pvPrefix + ':SCAN:NAME').get()
+            scanname = getPV(pvPrefix + ':SCAN:NAME').get()
         if ' ' in scanname: scanname = scanname.replace(' ', '_')
         if scanname: scanname = '_' + scanname
         if abortFlag:
@@ -84,52 +469,103 @@ class Experiment:
             createDirs = False
         self.abortFlag = abortFlag
         self.mutex = mutex
-        self.dataFlag = PV(pvPrefix + ':DATA:ENABLE').get()
-        self.logFlag = PV(pvPrefix + ':LOG:ENABLE').get()
-        self.imageFlag = PV(pvPrefix + ':GRABIMAGES:ENABLE').get()
-        self.scanmodePv = PV(pvPrefix + ':SCAN:MODE')
-        self.scanmode = self.scanmodePv.get()
-        self.scantype = PV(pvPrefix + ':SCAN:TYPE').get(as_string=True)
-        self.msgSevrPv = PV(pvPrefix + ':MSG_SEVR')
-        self.scanIDPv = PV(pvPrefix + ':SCAN:ID')
+        self.scanmodePv = getPV(pvPrefix + ':SCAN:MODE')
+        self.msgSevrPv = getPV(pvPrefix + ':MSG_SEVR')
+        self.scanIDPv = getPV(pvPrefix + ':SCAN:ID')
         self.msgSevrPv.put(0)
         self.expname = expname
         self.scanname = scanname
         self.createDirs = createDirs
+        self.log = log
+        connectOptional(npvs or 2)
+        self._read_settings()
         self.filepath = self._set_filepath(filepath) if self.createDirs else None
-        self.scanflag = PV(pvPrefix + ':SCAN:ENABLE').get()
-        self.preScanflag = PV(pvPrefix + ':SCAN:PRESCAN').get()
-        self.acqFixed = PV(pvPrefix + ':ACQ:FIXED').get()
-        self.acqPumpProbe = PV(pvPrefix + ':ACQ:PUMP_PROBE').get()
-        self.acqStatic = PV(pvPrefix + ':ACQ:STATIC').get()
-        self.acqPumpBG = PV(pvPrefix + ':ACQ:PUMP_BG').get()
-        self.acqDarkCurrent = PV(pvPrefix + ':ACQ:DARK_CURRENT').get()
-        self.acqDelay1 = PV(pvPrefix + ':ACQ:DELAY1').get()
-        self.acqDelay2 = PV(pvPrefix + ':ACQ:DELAY2').get()
-        self.acqDelay3 = PV(pvPrefix + ':ACQ:DELAY3').get()
-        self.shutterCheck = PV(pvPrefix + ':SHUTTERS:CHECK').get()
-        self.shutterRestore = PV(pvPrefix + ':SHUTTERS:RESTORE').get()
-        self.runUserScriptFlag = PV(pvPrefix + ':RUNSCRIPT:ENABLE').get()
-        self.scanCorFlag = PV(pvPrefix + ':SCANCOR:ENABLE').get()
+        self.checkpoint = ScanCheckpoint(self.filepath) if self.filepath and os.path.isdir(self.filepath) else None
+        self.userScript = self.create_user_script() if self.runUserScriptFlag and not abortFlag else None
+        if self.caCountMode:
+            caCounter.enable(debug=self.caCountMode == 2)
         # Create objects needed in experiment
         if log: 
             self.logFile = Tee(filepath=self.filepath)
         self.create_scan_pvs(npvs)
+        self.create_coupled_axes()
         self.create_shutters(nshutters)
         self.create_image_grabber()
+        self.create_acq_sequence()
         if log:
-            self.dataLog = DataLogger(filepath=self.filepath, pvlist=self.imagepvs, 
+            self.dataLog = DataLogger(filepath=self.filepath, pvlist=list(self.imagepvs), 
                                   scanpvs=self.scanpvs, shutters=self.shutters, mutex=self.mutex)
         logging.debug('%s.%s: scanmode: %s' % (self.className, functionName, self.scanmode))
 
+    def _read_settings(self):
+        """Read the experiment settings from PVs."""
+        self.dataFlag = getPV(pvPrefix + ':DATA:ENABLE').get()
+        self.logFlag = getPV(pvPrefix + ':LOG:ENABLE').get()
+        self.imageFlag = getPV(pvPrefix + ':GRABIMAGES:ENABLE').get()
+        self.scanmode = self.scanmodePv.get()
+        self.scantype = getPV(pvPrefix + ':SCAN:TYPE').get(as_string=True)
+        self.resumeFlag = getOptional(pvPrefix + ':SCAN:RESUME', 0) if not self.abortFlag else 0  # Resume from checkpoint
+        self.scanflag = getPV(pvPrefix + ':SCAN:ENABLE').get()
+        self.preScanflag = getPV(pvPrefix + ':SCAN:PRESCAN').get()
+        self.acqFixed = getPV(pvPrefix + ':ACQ:FIXED').get()
+        self.acqPumpProbe = getPV(pvPrefix + ':ACQ:PUMP_PROBE').get()
+        self.acqStatic = getPV(pvPrefix + ':ACQ:STATIC').get()
+        self.acqPumpBG = getPV(pvPrefix + ':ACQ:PUMP_BG').get()
+        self.acqDarkCurrent = getPV(pvPrefix + ':ACQ:DARK_CURRENT').get()
+        self.acqDelay1 = getPV(pvPrefix + ':ACQ:DELAY1').get()
+        self.acqDelay2 = getPV(pvPrefix + ':ACQ:DELAY2').get()
+        self.acqDelay3 = getPV(pvPrefix + ':ACQ:DELAY3').get()
+        self.shutterCheck = getPV(pvPrefix + ':SHUTTERS:CHECK').get()
+        self.shutterRestore = getPV(pvPrefix + ':SHUTTERS:RESTORE').get()
+        self.acqOptimize = getOptional(pvPrefix + ':ACQ:OPTIMIZE', 0)  # Reorder acquisitions to minimize shutter moves
+        self.runUserScriptFlag = getPV(pvPrefix + ':RUNSCRIPT:ENABLE').get()
+        self.scanCorFlag = getPV(pvPrefix + ':SCANCOR:ENABLE').get()
+        self.timingFlag = getOptional(pvPrefix + ':TIMING:ENABLE', 0)  # Per-step phase timing
+        self.timingWindow = getOptional(pvPrefix + ':TIMING:WINDOW')
+        self.caCountMode = getOptional(pvPrefix + ':CACOUNT:ENABLE', 0)  # 1 = count CA calls, 2 = and debug
+
+    def new_scan(self, filepath=None):
+        """Set up another scan in the same process, e.g. for multiple scans per run.
+           The settings are read from PVs again, the scan positions rebuilt (and 
+           reshuffled), and the image grabber and acquisition sequence recreated, 
+           with a new filepath and per-scan files (log, data, images, checkpoint).
+           The scan PV and shutter objects, and the CA channels, are kept.
+           The previous scan's DataLogger must have been stopped."""
+        functionName = 'new_scan'
+        logging.info('%s.%s' % (self.className, functionName))
+        self._read_settings()
+        self.filepath = self._set_filepath(filepath)
+        self.checkpoint = ScanCheckpoint(self.filepath) if os.path.isdir(self.filepath) else None
+        if self.caCountMode:
+            caCounter.enable(debug=self.caCountMode == 2)
+        if self.log:
+            self.logFile.close()
+            self.logFile = Tee(filepath=self.filepath)
+        if self.scanpvs:
+            for pv in self.scanpvs:
+                if pv.pvnumber: 
+                    pv.readScanSettings()
+                    pv.stepCountPv.put(0)
+        self.create_coupled_axes()
+        self.create_image_grabber()
+        self.create_acq_sequence()
+        if self.userScript:
+            self.userScript.wait()
+        self.userScript = self.create_user_script() if self.runUserScriptFlag else None
+        if self.log:
+            self.dataLog = DataLogger(filepath=self.filepath, pvlist=list(self.imagepvs), 
+                                  scanpvs=self.scanpvs, shutters=self.shutters, mutex=self.mutex)
+
     def _set_filepath(self, filepath):
         """Create filepath."""
         if filepath is None:
-            filepath = PV(pvPrefix + ':DATA:FILEPATH').get(as_string=True)
+            filepath = getPV(pvPrefix + ':DATA:FILEPATH').get(as_string=True)
             if not filepath.endswith('/'): filepath = filepath + '/'
             if ' ' in filepath: filepath = filepath.replace(' ', '_')
         if self.dataFlag or self.logFlag or self.imageFlag:
-            if os.path.exists(filepath):
+            if self.resumeFlag and os.path.isfile(filepath + ScanCheckpoint.filename):
+                printMsg('Resuming scan in %s' % (filepath))
+            elif os.path.exists(filepath):
                 msgPv.put('Failed: Filepath already exists')
                 self.msgSevrPv.put(2)
                 raise IOError('Filepath already exists')
@@ -148,15 +584,15 @@ class Experiment:
         if npvs is not None:
             scanpvs = []
             for i in range(npvs):
-                pvname = PV(pvPrefix + ':SCANPV' + str(i+1) + ':PVNAME').get()
+                pvname = getPV(pvPrefix + ':SCANPV' + str(i+1) + ':PVNAME').get()
                 if pvname:
-                    pvstatus = PV(pvname).status
+                    pvstatus = getPV(pvname).status
                 else:  # No PV entered
                     continue
                 if pvstatus is None: 
                     logging.error('%s: %s: Invalid PV: %s' % (self.className, functionName, pvname))
                     continue
-                pvtype = PV(pvPrefix + ':SCANPV' + str(i+1) + ':PVTYPE').get(as_string=False)
+                pvtype = getPV(pvPrefix + ':SCANPV' + str(i+1) + ':PVTYPE').get(as_string=False)
                 # Create PV instance
                 if pvtype == 1:
                     scanpvs.append(Motor(pvname, i+1))
@@ -176,22 +612,41 @@ class Experiment:
             scanpvs = None
         self.scanpvs = scanpvs
 
+    def create_coupled_axes(self, ncoupled=2):
+        """Create coupled axis PVs, which follow the scan PVs according to an 
+           expression of x1 (PV #1) and x2 (PV #2), e.g. a Z-lock '0.5*x1 + 1.2'.
+           Enter the .RBV name of a motor to wait for each move."""
+        functionName = 'create_coupled_axes'
+        coupledAxes = []
+        for i in range(ncoupled):
+            pvname = getOptional(pvPrefix + ':TRAJ:COUPLED' + str(i+1) + ':PVNAME', '')
+            expression = getOptional(pvPrefix + ':TRAJ:COUPLED' + str(i+1) + ':EXPR', '', as_string=True)
+            if not pvname or not expression:
+                continue
+            if getPV(pvname).status is None: 
+                logging.error('%s: %s: Invalid PV: %s' % (self.className, functionName, pvname))
+                continue
+            pv = Motor(pvname) if pvname.endswith('.RBV') else BasePv(pvname)
+            coupledAxes.append((pv, expression))
+        logging.debug('%s: %s: coupled axes: %s' % (self.className, functionName, coupledAxes))
+        self.coupledAxes = coupledAxes
+
     def create_shutters(self, nshutters=None):
         """Create shutter instances."""
         functionName = 'create_shutters'
         if nshutters is not None:
             shutters = []
             for i in range(nshutters):
-                pvname = PV(pvPrefix + ':SHUTTER' + str(i+1) + ':PVNAME').get()
+                pvname = getPV(pvPrefix + ':SHUTTER' + str(i+1) + ':PVNAME').get()
                 if pvname:
-                    pvstatus = PV(pvname).status
+                    pvstatus = getPV(pvname).status
                 else:  # No PV entered
                     continue
                 if pvstatus is None: 
                     logging.error('%s: %s: Invalid PV: %s' % (self.className, functionName, pvname))
                     continue
-                shuttertype = PV(pvPrefix + ':SHUTTER' + str(i+1) + ':TYPE').get(as_string=False)
-                rbv = PV(pvPrefix + ':SHUTTER' + str(i+1) + ':RBV').get()
+                shuttertype = getPV(pvPrefix + ':SHUTTER' + str(i+1) + ':TYPE').get(as_string=False)
+                rbv = getPV(pvPrefix + ':SHUTTER' + str(i+1) + ':RBV').get()
                 # Create shutter instance
                 if shuttertype == 1:
                     shutters.append(DummyShutter(pvname, rbv, i+1))
@@ -231,15 +686,57 @@ class Experiment:
     def create_image_grabber(self, cameraPvPrefix=None):
         """Create image grabber instance."""
         if cameraPvPrefix is None:
-            cameraPvPrefix = PV(pvPrefix + ':GRABIMAGES:CAMERA').get(as_string=True)
+            cameraPvPrefix = getPV(pvPrefix + ':GRABIMAGES:CAMERA').get(as_string=True)
         if 'DirectD' in cameraPvPrefix:
             grabber = DDGrabber(cameraPvPrefix, expname=self.expname, abortFlag=self.abortFlag)
+        elif getOptional(pvPrefix + ':GRABIMAGES:ARRAY:ENABLE', 0):
+            grabber = ArrayGrabber(cameraPvPrefix=cameraPvPrefix, filepath=self.filepath, 
+                    nFrames=self._count_frames(), abortFlag=self.abortFlag)
+            if self.createDirs:
+                grabber._create_image_filepath(resume=self.resumeFlag)
         else:
             grabber = ADGrabber(cameraPvPrefix=cameraPvPrefix, filepath=self.filepath, abortFlag=self.abortFlag)
             if self.createDirs:
-                grabber._create_image_filepath()
+                grabber._create_image_filepath(resume=self.resumeFlag)
         self.imagepvs = [grabber.timestampRBVPv, grabber.captureRBVPv]
         self.grabber = grabber
+
+    def create_acq_sequence(self):
+        """Create the acquisition sequence and the background reference cache, if enabled."""
+        self.acqSequence = None
+        if self.shutters and not self.acqFixed and not self.abortFlag:
+            self.acqSequence = AcqSequence.fromExperiment(self, self.shutters)
+        self.bgCache = None
+        if getOptional(pvPrefix + ':ACQ:BGCACHE:ENABLE', 0) and not self.abortFlag:
+            self.bgCache = BackgroundCache(filepath=getattr(self.grabber, 'filepath', None) 
+                    if self.createDirs else None)
+            # References need the grabbed frames: ArrayGrabber keeps them itself, 
+            # file-plugin grabbers need an ArrayMonitor
+            if (isinstance(self.grabber, ADGrabber) and not isinstance(self.grabber, ArrayGrabber) 
+                    and self.grabber.arrayMonitor is None):
+                self.grabber.arrayMonitor = ArrayMonitor(self.grabber.cameraPvPrefix)
+
+    def create_user_script(self):
+        """Create the user script runner: a persistent worker if RUNSCRIPT:WORKER is set."""
+        if getOptional(pvPrefix + ':RUNSCRIPT:WORKER', 0):
+            return UserScriptWorker(self.filepath)
+        return UserScriptRunner(self.filepath)
+
+    def _count_frames(self):
+        """Return the number of images the scan will grab, for preallocating frame stacks."""
+        nImages = getPV(pvPrefix + ':GRABIMAGES:N').get()
+        if getPV(pvPrefix + ':GRABIMAGES:SEQ2ENABLE').get():
+            nImages += getPV(pvPrefix + ':GRABIMAGES:N2').get()
+        if not self.acqFixed:
+            nImages *= max(1, sum([bool(x) for x in (self.acqPumpProbe, self.acqStatic, 
+                    self.acqPumpBG, self.acqDarkCurrent)]))
+        nSteps = 1
+        if self.scanmode in (1, 2) and self.scanpvs:
+            for pv in self.scanpvs[:self.scanmode]:
+                nSteps *= max(len(pv.scanPos), (pv.adaptiveNPoints or 0) if pv.adaptiveFlag else 0)
+            if self.preScanflag:
+                nSteps += self.scanpvs[0].pre_nsteps
+        return nSteps*nImages
     
 
 class Tee(object):
@@ -250,8 +747,8 @@ class Tee(object):
         logFilename = filepath + NOW + '.log'
         if filename is None:
             filename = logFilename
-        PV(pvPrefix + ':LOG:FILENAME').put(filename)
-        logEnable = PV(pvPrefix + ':LOG:ENABLE').get()  # Enable/Disable log file
+        getPV(pvPrefix + ':LOG:FILENAME').put(filename)
+        logEnable = getPV(pvPrefix + ':LOG:ENABLE').get()  # Enable/Disable log file
         if logEnable:
             self.file = open(filename, 'w')
         self.filepath = filepath
@@ -261,8 +758,13 @@ class Tee(object):
         sys.stdout = self
     
     def __del__(self):
-        sys.stdout = self.stdout
-        if self.logEnable:
+        self.close()
+
+    def close(self):
+        """Restore stdout and close log file."""
+        if sys.stdout is self:
+            sys.stdout = self.stdout
+        if self.logEnable and not self.file.closed:
             self.file.close()
     
     def write(self, data):
@@ -284,59 +786,16 @@ class BasePv(PV):
         PV.__init__(self, pvname)
         self.pvnumber = pvnumber
         if rbv is not None:
-            rbv = PV(rbv)
+            rbv = getPV(rbv)
         self.rbv = rbv
         self.abort = None
         if self.pvname and self.pvnumber:
-            self.pvtypePv = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PVTYPE')
-            PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':VAL.INP').put(self.pvname + ' CPP')
+            self.pvtypePv = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PVTYPE')
+            getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':VAL.INP').put(self.pvname + ' CPP')
         if self.rbv and self.pvnumber:
-            PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':RBV.INP').put(self.rbv.pvname + ' CPP')
+            getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':RBV.INP').put(self.rbv.pvname + ' CPP')
         if self.pvnumber:
-            self.desc = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':DESC').get()
-            if ' ' in self.desc: self.desc = self.desc.replace(' ','_')
-            self.start = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':START').get()
-            self.stop = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':STOP').get()
-            self.nsteps = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':NSTEPS').get()
-            self.inc = (self.stop - self.start)/(self.nsteps - 1)
-            self.randomScanflag = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':RANDSCAN').get()
-            self.scanPosModePv = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ScanPosMode')
-            self.scanPosMode = self.scanPosModePv.get()
-            self.ScanPosNumIter = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ScanPosNumIter').get()
-            self.numStepsTotalPv = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':NumStepsTotal')
-            self.filenameWidth = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':FILENAME_WIDTH').get()
-            self.filenamePrec = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':FILENAME_PREC').get()
-            self.t0Enable = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0_ENABLE').get()
-            self.t0 = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0').get()
-            self.t0Direction = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0_DIRECTION').get()
-            t0Sign = -1 if self.t0Direction else 1
-            self.t0DelayUnits = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) 
-                    + ':T0_DELAYUNITS').get(as_string=True)
-            # This dict must match the T0_DELAYUNITS epics record:
-            t0delayOpts = {'us':1e-6, 'ns':1e-9, 'ps':1e-12, 'fs':1e-15, 'as':1e-18}
-            # Build list of scan positions based on scanPosMode
-            if self.scanPosMode:
-                self.scanPosString = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) 
-                        + ':ScanPosString').get(as_string=True)
-                self.scanPos = self._buildScanPositions(self.scanPosMode, self.ScanPosNumIter, 
-                        self.scanPosString)
-            else:
-                self.scanPos = np.linspace(self.start, self.stop, num=self.nsteps)
-            if self.t0Enable:
-                # If T0 enable is yes, then convert user values from time delay back to EGU.
-                # The factor of 2 is for a 2-pass delay stage.
-                # The factor of 1e3 is because the stage units are assumed to be mm.
-                scaleFactor = t0delayOpts[self.t0DelayUnits]*2.9979e8*0.5*1e3
-                self.scanPos = [self.t0 + t0Sign*x*scaleFactor for x in self.scanPos]
-            logging.debug('%s.%s: scanPos: %s' % (className, functionName, self.scanPos))
-            self.numStepsTotalPv.put(len(self.scanPos))
-            self.offset = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':OFFSET').get()
-            self.settletime = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLETIME').get()
-            self.delta = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':DELTA').get()
-            self.pre_start = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_START').get()
-            self.pre_stop = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_STOP').get()
-            self.pre_nsteps = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_NSTEPS').get()
-            self.stepCountPv = PV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':STEPCOUNT')
+            self.readScanSettings()
             if not self.abort: self.stepCountPv.put(0)
         else:
             self.delta = None
@@ -345,11 +804,74 @@ class BasePv(PV):
             printMsg('WARNING: PV {0} invalid'.format(self.pvname))
             logging.warning('Object: {0}, Status: {1}'.format(self, self.status))
 
+    def readScanSettings(self):
+        """Read the scan settings from the SCANPV PVs and build the scan positions 
+           (reshuffled in random/ScanPosMode 2 modes).  Called again for each scan 
+           when scans are run in the same process."""
+        className = self.__class__.__name__
+        functionName = 'readScanSettings'
+        self.desc = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':DESC').get()
+        if ' ' in self.desc: self.desc = self.desc.replace(' ','_')
+        self.start = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':START').get()
+        self.stop = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':STOP').get()
+        self.nsteps = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':NSTEPS').get()
+        self.inc = (self.stop - self.start)/(self.nsteps - 1)
+        self.randomScanflag = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':RANDSCAN').get()
+        self.scanPosModePv = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ScanPosMode')
+        self.scanPosMode = self.scanPosModePv.get()
+        self.ScanPosNumIter = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ScanPosNumIter').get()
+        self.numStepsTotalPv = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':NumStepsTotal')
+        self.filenameWidth = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':FILENAME_WIDTH').get()
+        self.filenamePrec = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':FILENAME_PREC').get()
+        self.adaptiveFlag = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ADAPTIVE', 0)  # Adaptive refinement
+        self.adaptiveNPoints = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':ADAPTIVE:NPOINTS')
+        self.flyFlag = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':FLY', 0)  # Fly scan (Motor only)
+        self.t0Enable = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0_ENABLE').get()
+        self.t0 = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0').get()
+        self.t0Direction = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':T0_DIRECTION').get()
+        t0Sign = -1 if self.t0Direction else 1
+        self.t0DelayUnits = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) 
+                + ':T0_DELAYUNITS').get(as_string=True)
+        # This dict must match the T0_DELAYUNITS epics record:
+        t0delayOpts = {'us':1e-6, 'ns':1e-9, 'ps':1e-12, 'fs':1e-15, 'as':1e-18}
+        # Build list of scan positions based on scanPosMode
+        if self.scanPosMode:
+            self.scanPosString = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) 
+                    + ':ScanPosString').get(as_string=True)
+            self.scanPos = self._buildScanPositions(self.scanPosMode, self.ScanPosNumIter, 
+                    self.scanPosString)
+        else:
+            self.scanPos = np.linspace(self.start, self.stop, num=self.nsteps)
+        if self.t0Enable:
+            # If T0 enable is yes, then convert user values from time delay back to EGU.
+            # The factor of 2 is for a 2-pass delay stage.
+            # The factor of 1e3 is because the stage units are assumed to be mm.
+            scaleFactor = t0delayOpts[self.t0DelayUnits]*2.9979e8*0.5*1e3
+            self.scanPos = self.t0 + t0Sign*scaleFactor*np.asarray(self.scanPos, dtype=float)
+        logging.debug('%s.%s: scanPos: %s' % (className, functionName, self.scanPos))
+        self.numStepsTotalPv.put(len(self.scanPos))
+        self.offset = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':OFFSET').get()
+        self.settletime = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLETIME').get()
+        # Adaptive settling: settletime is the upper bound
+        self.settleAdaptive = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLE:ADAPTIVE', 0)
+        self.settleTol = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLE:TOL')
+        self.settleWindow = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLE:WINDOW')
+        if self.settleWindow is None:
+            self.settleWindow = SETTLE_WINDOW
+        settlePvname = getOptional(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':SETTLE:PVNAME', '')
+        self.settlePv = getPV(settlePvname) if settlePvname else self.rbv
+        self.settleTimes = []
+        self.delta = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':DELTA').get()
+        self.pre_start = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_START').get()
+        self.pre_stop = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_STOP').get()
+        self.pre_nsteps = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':PRE_NSTEPS').get()
+        self.stepCountPv = getPV(pvPrefix + ':SCANPV' + str(self.pvnumber) + ':STEPCOUNT')
+
     def pvWait(self, val, delta=0.005, timeout=180.0):
         """Wait until PV is near readback (or times out) to proceed."""
         try:
             count = 0
-            pause = 0.2
+            pause = MOVE_POLL
             while self.rbv.get() != val and count < timeout/pause:
                 if math.fabs(self.rbv.get() - val) <= delta: break
                 sleep(pause)
@@ -358,6 +880,7 @@ class BasePv(PV):
             print("RBV is invalid for %s, pausing for %f seconds." % (self.pvname,timeout))
             sleep(timeout)
 
+    @stepTimer.timed('move')
     def move(self, val, wait=False, delta=0.005, timeout=300.0):
         """Put with optional wait."""
         PV.put(self,val)
@@ -366,6 +889,45 @@ class BasePv(PV):
                 delta = self.delta
             self.pvWait(val, delta, timeout)
 
+    @stepTimer.timed('settle')
+    def settle(self, string='Settling'):
+        """Wait for the PV to settle.  In adaptive mode, continue as soon as the RBV 
+        (or the SETTLE:PVNAME quality PV) has stayed within SETTLE:TOL for SETTLE:WINDOW 
+        seconds, watching monitor events; SETTLETIME is the upper bound.  Otherwise 
+        sleep for SETTLETIME, also if SETTLE:TOL or the settle PV can't be read.  The 
+        settle time is appended to settleTimes."""
+        adaptive = self.settleAdaptive and self.settlePv and self.settleTol is not None
+        ref = self.settlePv.get() if adaptive else None
+        if adaptive and ref is None:
+            printMsg('WARNING: %s is not readable, settling for %g s' % (self.settlePv.pvname, self.settletime))
+            adaptive = False
+        if not adaptive:
+            printSleep(self.settletime, string, phase='settle')
+            self.settleTimes.append(self.settletime)
+            return self.settletime
+        printMsg('%s (adaptive, %s within %g for %g s, at most %g s)' % (string, 
+                self.settlePv.pvname, self.settleTol, self.settleWindow, self.settletime))
+        t0 = time()
+        state = {'ref': ref, 'since': t0}
+        def onChange(value=None, **kws):
+            if value is None:
+                return
+            if state['ref'] is None or math.fabs(value - state['ref']) > self.settleTol:
+                state['ref'] = value
+                state['since'] = time()
+        index = self.settlePv.add_callback(onChange)
+        try:
+            while time() - t0 < self.settletime:
+                if time() - state['since'] >= self.settleWindow:
+                    break
+                sleep(0.02)
+        finally:
+            self.settlePv.remove_callback(index)
+        settleTime = time() - t0
+        self.settleTimes.append(settleTime)
+        logging.info('%s.settle: %s settled in %.3f s' % (self.__class__.__name__, self.pvname, settleTime))
+        return settleTime
+
     def _buildScanPositions(self, mode, numIter, strng):
         """Build a list of values from a string and optionally
         perform a sorting  and/or multiplication operation on the list.
@@ -401,8 +963,8 @@ class Motor(BasePv):
             velo = pvname + '.VELO'
             abort = pvname + '.STOP'
         BasePv.__init__(self, pvname, pvnumber, rbv)
-        self.velo = PV(velo)
-        self.abort = PV(abort)
+        self.velo = getPV(velo)
+        self.abort = getPV(abort)
 
     def motorWait(self, val, delta=0.005, timeout=300.0):
         """Wait until PV is near readback (or times out) to proceed."""
@@ -430,10 +992,11 @@ class PolluxMotor(Motor):
             go = ':'.join(pvname.split(':')[0:2]) + ':BO:GOABS'
             abort = ':'.join(pvname.split(':')[0:2]) + ':BO:ABORT'
         BasePv.__init__(self, pvname, pvnumber, rbv)
-        self.velo = PV(velo)
-        self.go = PV(go)
-        self.abort = PV(abort)
+        self.velo = getPV(velo)
+        self.go = getPV(go)
+        self.abort = getPV(abort)
     
+    @stepTimer.timed('move')
     def move(self, val, wait=True, delta=0.005, timeout=360.0):
         """Put value and press Go button."""
         PV.put(self, val)
@@ -459,9 +1022,10 @@ class BeckhoffMotor(Motor):
             go = pvname.split(':')[0] + ':BO:' + ':'.join(pvname.split(':')[2:3]) + ':GO:POS:ABS'
             abort = pvname.split(':')[0] + ':BO:' + ':'.join(pvname.split(':')[2:3]) + ':STOP'
         BasePv.__init__(self, pvname, pvnumber, rbv)
-        self.go = PV(go)
-        self.abort = PV(abort)
+        self.go = getPV(go)
+        self.abort = getPV(abort)
 
+    @stepTimer.timed('move')
     def move(self, val, wait=True, delta=0.005, timeout=360.0):
         """Put value and press Go button."""
         PV.put(self, val)
@@ -511,8 +1075,8 @@ class RbvPv(BasePv):
     """RBV PV class which inherits from BasePv class."""
     def __init__(self, pvname, pvnumber=None, rbv=None):
         if rbv is None:
-            rbv = PV(pvPrefix + ':SCANPV' + str(pvnumber) + ':RBVNAME').get(as_string=True)
-        if PV(rbv).status is None:
+            rbv = getPV(pvPrefix + ':SCANPV' + str(pvnumber) + ':RBVNAME').get(as_string=True)
+        if getPV(rbv).status is None:
             printMsg('Failed: RBV %s invalid' % (rbv))
             raise NameError('RbvPv: RBV %s invalid' % (rbv))
         BasePv.__init__(self, pvname, pvnumber, rbv)
@@ -526,14 +1090,14 @@ class Shutter(PV):
     """Shutter class which inherits from pyEpics PV class."""
     def __init__(self, pvname, rbvpv=None, number=0, abortFlag=False):
         PV.__init__(self, pvname)
-        self.rbv = PV(rbvpv) if rbvpv else None
+        self.rbv = getPV(rbvpv) if rbvpv else None
         if number:
-            self.shuttertype = PV(pvPrefix + ':SHUTTER' + str(number) + ':TYPE').get(as_string=False)
-            self.enabled = PV(pvPrefix + ':SHUTTER' + str(number) + ':ENABLE').get()
-            self.initial = PV(pvPrefix + ':SHUTTER' + str(number) + ':INITIAL')
+            self.shuttertype = getPV(pvPrefix + ':SHUTTER' + str(number) + ':TYPE').get(as_string=False)
+            self.enabled = getPV(pvPrefix + ':SHUTTER' + str(number) + ':ENABLE').get()
+            self.initial = getPV(pvPrefix + ':SHUTTER' + str(number) + ':INITIAL')
         self.number = number
-        self.open = PV(pvname)
-        self.close = PV(pvname)
+        self.open = getPV(pvname)
+        self.close = getPV(pvname)
     
     def openCheck(self, val=0.5):
         sleep(0.2)
@@ -565,51 +1129,51 @@ class DummyShutter(Shutter):
     """Dummy shutter class. For testing only."""
     def __init__(self, pvname, rbvpv=None, number=0):
         Shutter.__init__(self, pvname, rbvpv, number)
-        self.OCStatus = PV(pvname)
-        self.ttlInEnable = PV(pvname)
-        self.ttlInDisable = PV(pvname)
-        self.soft = PV(pvname)
-        self.fast = PV(pvname)
+        self.OCStatus = getPV(pvname)
+        self.ttlInEnable = getPV(pvname)
+        self.ttlInDisable = getPV(pvname)
+        self.soft = getPV(pvname)
+        self.fast = getPV(pvname)
 
 
 class LSCShutter(Shutter):
     """Lambda SC shutter class."""
     def __init__(self, pvname, rbvpv=None, number=0):
         Shutter.__init__(self, pvname, rbvpv, number)
-        self.OCStatus = PV(':'.join(pvname.split(':')[0:2]) + ':STATUS:OC')
-        self.ttlInEnable = PV(':'.join(pvname.split(':')[0:2]) + ':TTL:IN:HIGH')
-        self.ttlInDisable = PV(':'.join(pvname.split(':')[0:2]) + ':TTL:IN:DISABLE')
-        self.open = PV(':'.join(pvname.split(':')[0:2]) + ':OC:OPEN')
-        self.close = PV(':'.join(pvname.split(':')[0:2]) + ':OC:CLOSE')
-        self.soft = PV(':'.join(pvname.split(':')[0:2]) + ':MODE:SOFT')
-        self.fast = PV(':'.join(pvname.split(':')[0:2]) + ':MODE:FAST')
+        self.OCStatus = getPV(':'.join(pvname.split(':')[0:2]) + ':STATUS:OC')
+        self.ttlInEnable = getPV(':'.join(pvname.split(':')[0:2]) + ':TTL:IN:HIGH')
+        self.ttlInDisable = getPV(':'.join(pvname.split(':')[0:2]) + ':TTL:IN:DISABLE')
+        self.open = getPV(':'.join(pvname.split(':')[0:2]) + ':OC:OPEN')
+        self.close = getPV(':'.join(pvname.split(':')[0:2]) + ':OC:CLOSE')
+        self.soft = getPV(':'.join(pvname.split(':')[0:2]) + ':MODE:SOFT')
+        self.fast = getPV(':'.join(pvname.split(':')[0:2]) + ':MODE:FAST')
 
 
 class ThorSCShutter(Shutter):
     """Thorlabs SC shutter class."""
     def __init__(self, pvname, rbvpv=None, number=0):
         Shutter.__init__(self, pvname, rbvpv, number)
-        self.OCStatus = PV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:STATE_RBV')
-        self.ttlInEnable = PV(':'.join(pvname.split(':')[0:2]) + ':TRIG:IN_MODE')
-        self.ttlInDisable = PV(':'.join(pvname.split(':')[0:2]) + ':TRIG:IN_MODE')
-        self.open = PV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:OPEN')
-        self.close = PV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:CLOSE')
-        self.trigOutMode = PV(':'.join(pvname.split(':')[0:2]) + ':TRIG:OUT_MODE')
-        self.outputMode = PV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:OUT_MODE')
+        self.OCStatus = getPV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:STATE_RBV')
+        self.ttlInEnable = getPV(':'.join(pvname.split(':')[0:2]) + ':TRIG:IN_MODE')
+        self.ttlInDisable = getPV(':'.join(pvname.split(':')[0:2]) + ':TRIG:IN_MODE')
+        self.open = getPV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:OPEN')
+        self.close = getPV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:CLOSE')
+        self.trigOutMode = getPV(':'.join(pvname.split(':')[0:2]) + ':TRIG:OUT_MODE')
+        self.outputMode = getPV(':'.join(pvname.split(':')[0:2]) + ':SHUTTER:OUT_MODE')
 
 class UniblitzShutter(Shutter):
     """Uniblitz shutter class."""
     def __init__(self, pvname, rbvpv=None, number=0):
         Shutter.__init__(self, pvname, rbvpv, number)
-        self.OCStatus = PV(':'.join(pvname.split(':')[0:2]) + ':Shutter_RBV')
+        self.OCStatus = getPV(':'.join(pvname.split(':')[0:2]) + ':Shutter_RBV')
         self.ttlInEnable = None
         self.ttlInDisable = None
-        self.open = PV(':'.join(pvname.split(':')[0:2]) + ':Open')
-        self.close = PV(':'.join(pvname.split(':')[0:2]) + ':Close')
+        self.open = getPV(':'.join(pvname.split(':')[0:2]) + ':Open')
+        self.close = getPV(':'.join(pvname.split(':')[0:2]) + ':Close')
         self.trigOutMode = None
         self.outputMode = None
-        self.trigger = PV(':'.join(pvname.split(':')[0:2]) + ':Trigger')
-        self.reset = PV(':'.join(pvname.split(':')[0:2]) + ':Reset')
+        self.trigger = getPV(':'.join(pvname.split(':')[0:2]) + ':Trigger')
+        self.reset = getPV(':'.join(pvname.split(':')[0:2]) + ':Reset')
 
 
 class ShutterGroup:
@@ -693,7 +1257,7 @@ class DataLogger(Thread):
         if os.path.isfile(pvFile):
             with open(pvFile, 'r') as file:
                 pvlist2 = [line.strip() for line in file if not line.startswith('#')]
-                pvlist2 = [PV(line) for line in pvlist2 if line]
+                pvlist2 = [getPV(line) for line in pvlist2 if line]
             # Add additional monitor PVs to existing PV list
             pvlist += pvlist2
         # Add scan PVs
@@ -716,12 +1280,12 @@ class DataLogger(Thread):
         self.pvlist = pvlist
         self.filepath = filepath
         self.dataFilename = self.filepath + NOW + '.dat'
-        PV(pvPrefix + ':DATA:FILENAME').put(self.dataFilename)
-        self.dataEnable = PV(pvPrefix + ':DATA:ENABLE').get()  # Enable/Disable data logging
-        self.dataInt = PV(pvPrefix + ':DATA:INT').get()  # Interval between PV data log points
+        getPV(pvPrefix + ':DATA:FILENAME').put(self.dataFilename)
+        self.dataEnable = getPV(pvPrefix + ':DATA:ENABLE').get()  # Enable/Disable data logging
+        self.dataInt = getPV(pvPrefix + ':DATA:INT').get()  # Interval between PV data log points
         self.nPtsMax = 1000000  # limits number of data points
-        self.plotTimesFlag = PV(pvPrefix + ':DATA:PLOTTIMES').get()  # Plot average time to sample a Monitor PV
-        self.formatFlag = PV(pvPrefix + ':DATA:FORMAT').get()  # Format data for nice display
+        self.plotTimesFlag = getPV(pvPrefix + ':DATA:PLOTTIMES').get()  # Plot average time to sample a Monitor PV
+        self.formatFlag = getPV(pvPrefix + ':DATA:FORMAT').get()  # Format data for nice display
         self.sampleTimes = []  # To store PV sample times for (optional) plotting.
 
     def datalog(self):
@@ -748,9 +1312,9 @@ class DataLogger(Thread):
         """Write data file header."""
         self.datafile.write('%-30s %s' % ('PV name', 'PV description\n'))
         for pv in self.pvlist:
-            if '.RBV' in pv.pvname: pv = PV(pv.pvname.replace('.RBV', ''))
-            if '.RVAL' in pv.pvname: pv = PV(pv.pvname.replace('.RVAL', ''))
-            self.datafile.write('%-30s %s' % (pv.pvname, str(PV(pv.pvname + '.DESC').get()) + '\n'))
+            if '.RBV' in pv.pvname: pv = getPV(pv.pvname.replace('.RBV', ''))
+            if '.RVAL' in pv.pvname: pv = getPV(pv.pvname.replace('.RVAL', ''))
+            self.datafile.write('%-30s %s' % (pv.pvname, str(getPV(pv.pvname + '.DESC').get()) + '\n'))
         self.datafile.write('#'*50 + '\n')
 
     def _writeData(self):
@@ -835,16 +1399,18 @@ class DDGrabber():
         logging.info('%s.__init__()' % (self.__class__.__name__))
         self.cameraPvPrefix = cameraPvPrefix
         self.expname = expname
-        self.grabFlag = PV(pvPrefix + ':GRABIMAGES:ENABLE').get()
-        self.grabSeq2Flag = PV(pvPrefix + ':GRABIMAGES:SEQ2ENABLE').get() # Grab second image sequence after first 
-        self.grabSeq2Delay = PV(pvPrefix + ':GRABIMAGES:SEQ2DELAY').get() # Delay between 1st and 2nd sequence
-        self.stepFlag = PV(pvPrefix + ':GRABIMAGES:STEPNUMBER').get() # Write step number into filename
-        self.dataTime = PV(pvPrefix + ':GRABIMAGES:DATATIME').get() # Data capture time for DirectD
-        self.dataStartStopPv = PV('UED:TST:FILEWRITER:CMD')  # DataWriter start/stop PV
-        self.dataStatusPv = PV('UED:TST:FILEWRITER:STATUS')  # DataWriter status PV
-        self.dataFilenamePv = PV('UED:TST:FILEWRITER:PATH')  # DataWriter filename template PV
+        self.grabFlag = getPV(pvPrefix + ':GRABIMAGES:ENABLE').get()
+        self.grabSeq2Flag = getPV(pvPrefix + ':GRABIMAGES:SEQ2ENABLE').get() # Grab second image sequence after first 
+        self.grabSeq2Delay = getPV(pvPrefix + ':GRABIMAGES:SEQ2DELAY').get() # Delay between 1st and 2nd sequence
+        self.stepFlag = getPV(pvPrefix + ':GRABIMAGES:STEPNUMBER').get() # Write step number into filename
+        self.dataTime = getPV(pvPrefix + ':GRABIMAGES:DATATIME').get() # Data capture time for DirectD
+        self.dataStartStopPv = getPV('UED:TST:FILEWRITER:CMD')  # DataWriter start/stop PV
+        self.dataStatusPv = getPV('UED:TST:FILEWRITER:STATUS')  # DataWriter status PV
+        self.dataFilenamePv = getPV('UED:TST:FILEWRITER:PATH')  # DataWriter filename template PV
         self.nImages2 = None
         self.filenameExtras = ''
+        self.scanStep = None
+        self.acqTag = None
         self.timestampRBVPv = None
         self.captureRBVPv = None
 
@@ -886,6 +1452,213 @@ class DDGrabber():
         self.dataStartStopPv.put(0)
         
 
+class ImageFileMonitor():
+    """Count frames and collect written image filenames from camera monitor events.
+       Completion is taken from the file plugin's NumCaptured_RBV (a count, so 
+       coalesced monitor events can't lose frames); frames are counted from 
+       ArrayCounter_RBV, and filenames (and their EPICS timestamps) from 
+       FullFileName_RBV, which is only used for the names."""
+    def __init__(self, grabObject, nImages):
+        self.grabObject = grabObject
+        self.nImages = nImages
+        self.frameCount = 0
+        self.numCaptured = 0
+        self.files = []
+        self._arrayCount0 = None
+        self._done = Event()
+        self._callbacks = []
+
+    def _onArrayCounter(self, value=None, **kws):
+        """ArrayCounter_RBV callback."""
+        if value is None:
+            return
+        if self._arrayCount0 is None or value < self._arrayCount0:
+            self._arrayCount0 = 0
+        self.frameCount = value - self._arrayCount0
+
+    def _onNumCaptured(self, value=None, **kws):
+        """NumCaptured_RBV callback."""
+        if value is None:
+            return
+        self.numCaptured = value
+        if value >= self.nImages:
+            self._done.set()
+
+    def _onFilename(self, char_value=None, timestamp=None, **kws):
+        """FullFileName_RBV callback. Ignores files not written by this grab."""
+        if not char_value:
+            return
+        prefix = (self.grabObject.filepath + self.grabObject.fileNamePrefix 
+                + self.grabObject.filenameExtras)
+        if char_value.startswith(prefix) and len(self.files) < self.nImages:
+            if not self.files or self.files[-1][0] != char_value:
+                self.files.append((char_value, timestamp))
+
+    def start(self):
+        """Add callbacks. Call before arming the camera."""
+        self._arrayCount0 = self.grabObject.arrayCounterRBVPv.get()
+        self._callbacks = [
+                (self.grabObject.arrayCounterRBVPv, 
+                    self.grabObject.arrayCounterRBVPv.add_callback(self._onArrayCounter)),
+                (self.grabObject.numCapturedRBVPv, 
+                    self.grabObject.numCapturedRBVPv.add_callback(self._onNumCaptured)),
+                (self.grabObject.lastImagePv, 
+                    self.grabObject.lastImagePv.add_callback(self._onFilename))]
+
+    def wait(self, timeout=None, nameTimeout=1.0):
+        """Wait until all images are captured, then (up to nameTimeout) for their
+           filenames. Returns False on timeout."""
+        if not self._done.wait(timeout):
+            return False
+        t0 = time()
+        while len(self.files) < self.nImages and time() - t0 < nameTimeout:
+            sleep(0.01)
+        if len(self.files) < self.nImages:
+            logging.warning('ImageFileMonitor: %d images captured, but only %d filenames seen' 
+                    % (self.numCaptured, len(self.files)))
+        return True
+
+    def stop(self):
+        """Remove callbacks."""
+        for pv, index in self._callbacks:
+            pv.remove_callback(index)
+        self._callbacks = []
+
+
+class ArrayMonitor():
+    """Collect frames from the NDStdArrays plugin (ArrayData waveform) between start()
+       and stop().  Frames are selected by ArrayCounter: each frame is tagged with the
+       plugin's UniqueId_RBV, which AreaDetector posts right after ArrayData, and only
+       frames [first, first+nFrames) are kept.  ArrayData is only monitored while 
+       collecting.  Mono images only."""
+    def __init__(self, cameraPvPrefix, plugin='image1'):
+        self.arrayDataPv = getPV(cameraPvPrefix + ':' + plugin + ':ArrayData', auto_monitor=False)
+        self.uniqueIdPv = getPV(cameraPvPrefix + ':' + plugin + ':UniqueId_RBV')
+        self.sizeXPv = getPV(cameraPvPrefix + ':cam1:ArraySizeX_RBV')
+        self.sizeYPv = getPV(cameraPvPrefix + ':cam1:ArraySizeY_RBV')
+        getPV(cameraPvPrefix + ':' + plugin + ':EnableCallbacks').put(1)
+        self.frameCount = 0
+        self._frames = []
+        self._nFrames = 0
+        self._first = 0
+        self._pending = None
+        self._shape = None
+        self._callbacks = []
+        self._done = Event()
+
+    def _onArrayData(self, value=None, **kws):
+        """ArrayData callback: hold the frame until its UniqueId_RBV arrives."""
+        if value is None:
+            return
+        npix = self._shape[0]*self._shape[1]
+        if len(value) < npix:
+            return
+        self._pending = np.reshape(value[:npix], self._shape).copy()
+
+    def _onUniqueId(self, value=None, **kws):
+        """UniqueId_RBV callback: keep the pending frame if it is in range."""
+        frame, self._pending = self._pending, None
+        if frame is None or value is None:
+            return
+        if self._first <= value < self._first + self._nFrames:
+            self._frames.append(frame)
+            self.frameCount += 1
+            if self.frameCount >= self._nFrames:
+                self._done.set()
+
+    def start(self, nFrames, first):
+        """Start collecting frames with ArrayCounter first to first+nFrames-1."""
+        self._shape = (self.sizeYPv.get(), self.sizeXPv.get())
+        self._frames = []
+        self._nFrames = nFrames
+        self._first = first
+        self._pending = None
+        self.frameCount = 0
+        self._done.clear()
+        self.arrayDataPv.auto_monitor = True
+        self._callbacks = [
+                (self.uniqueIdPv, self.uniqueIdPv.add_callback(self._onUniqueId)),
+                (self.arrayDataPv, self.arrayDataPv.add_callback(self._onArrayData))]
+
+    def wait(self, timeout=None):
+        """Wait until nFrames frames have arrived. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def stop(self):
+        """Stop collecting and return frames as an (n, y, x) array."""
+        for pv, index in self._callbacks:
+            pv.remove_callback(index)
+        if self._callbacks:
+            self.arrayDataPv.auto_monitor = False
+        self._callbacks = []
+        if not self._frames:
+            return np.zeros((0,) + (self._shape or (0, 0)))
+        return np.asarray(self._frames)
+
+
+class ImageReducer():
+    """Online image reduction: ROI integrals, centroids and (optionally) projections
+       for every grabbed frame.  Results are appended to a per-scan table, one row per
+       frame, keyed by scan step and acquisition tag; the mean ROI sums of each
+       (step, tag) are kept in results.  Projections are saved to one .npz file per grab.
+       ROIs are read from a PV as 'x,y,width,height' entries separated by semicolons;
+       if none are given, the full frame is used."""
+    def __init__(self, filepath, cameraPvPrefix, rois=None):
+        if rois is None:
+            rois = parseRois(getOptional(pvPrefix + ':GRABIMAGES:REDUCE:ROIS', '', as_string=True))
+        self.rois = rois
+        self.projFlag = getOptional(pvPrefix + ':GRABIMAGES:REDUCE:PROJ', 0)  # Save projections
+        self.filename = filepath + 'reduced-' + cameraPvPrefix + '-' + NOW + '.dat'
+        self.projFilename = filepath + 'projections-' + cameraPvPrefix + '-' + NOW + '-%s.npz'
+        self.nGrabs = 0
+        self.results = {}  # (step, tag) --> mean ROI sums
+
+    def _writeHeader(self, rois):
+        """Write table header."""
+        with open(self.filename, 'w') as outfile:
+            for i, roi in enumerate(rois):
+                outfile.write('# ROI%d: x=%d y=%d width=%d height=%d\n' % ((i+1,) + tuple(roi)))
+            outfile.write('Step Tag Frame ' + ' '.join(['ROI%d_sum ROI%d_cx ROI%d_cy' % (i+1, i+1, i+1) 
+                    for i in range(len(rois))]) + ' Extras\n')
+
+    def reduce(self, frames, step=None, tag=None, key=''):
+        """Reduce an (n, y, x) stack of frames, grabbed at scan step step (label) for 
+           acquisition tag, and append the results to the table."""
+        step = str(step) if step is not None else '-'
+        tag = tag or '-'
+        if not len(frames):
+            logging.warning('ImageReducer: no frames for step %s %s' % (step, tag))
+            return
+        frames = np.asarray(frames, dtype=np.float64)
+        rois = self.rois if self.rois else [(0, 0, frames.shape[2], frames.shape[1])]
+        self.nGrabs += 1
+        if self.nGrabs == 1:
+            self._writeHeader(rois)
+        cols = []
+        projections = {}
+        for i, (x, y, w, h) in enumerate(rois):
+            sub = frames[:, y:y+h, x:x+w]
+            projX = sub.sum(axis=1)
+            projY = sub.sum(axis=2)
+            sums = projX.sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cx = x + np.dot(projX, np.arange(projX.shape[1]))/sums
+                cy = y + np.dot(projY, np.arange(projY.shape[1]))/sums
+            cols += [sums, cx, cy]
+            projections['ROI%d_x' % (i+1)] = projX
+            projections['ROI%d_y' % (i+1)] = projY
+        table = np.column_stack([np.arange(1, len(frames)+1)] + cols)
+        with open(self.filename, 'a') as outfile:
+            for row in table:
+                outfile.write('%s %s %d ' % (step, tag, row[0]) + ' '.join(['%.6g' % (v) for v in row[1:]]) 
+                        + ' ' + (key.lstrip('_') or '-') + '\n')
+        if self.projFlag:
+            np.savez(self.projFilename % ('%s-%s' % (step.replace(':', '_'), tag)), **projections)
+        result = table[:, 1::3].mean(axis=0)
+        self.results[(step, tag)] = result
+        printMsg('Step %s %s ROI sums: %s' % (step, tag, ' '.join(['%.4g' % (v) for v in result])))
+
+
 class ADGrabber():
     """AreaDetector grabber."""
     def __init__(self, cameraPvPrefix=None, filepath=None, nImages=None, 
@@ -894,12 +1667,12 @@ class ADGrabber():
         functionName = '__init__'
         logging.info('%s.%s' % (className, functionName))
         if cameraPvPrefix is None: 
-            cameraPvPrefix = PV(pvPrefix + ':GRABIMAGES:CAMERA').get(as_string=True)
+            cameraPvPrefix = getPV(pvPrefix + ':GRABIMAGES:CAMERA').get(as_string=True)
         if filepath is None:
-            filepath = PV(pvPrefix + ':DATA:FILEPATH').get(as_string=True)
+            filepath = getPV(pvPrefix + ':DATA:FILEPATH').get(as_string=True)
             if not filepath.endswith('/'): filepath = filepath + '/'
         if nImages is None:
-            nImages = PV(pvPrefix + ':GRABIMAGES:N').get()
+            nImages = getPV(pvPrefix + ':GRABIMAGES:N').get()
         if pvlist is None:
             if 'ANDOR' in cameraPvPrefix:
                 pvlist = ['cam1:BI:NAME.DESC', 'cam1:AcquireTime_RBV',
@@ -918,10 +1691,10 @@ class ADGrabber():
                         'cam1:ArraySizeY_RBV']
             pvlist = [(cameraPvPrefix + ':' + item) for item in pvlist]
         filepath += 'images' + '-' + cameraPvPrefix + '/' 
-        self.scanmode = PV(pvPrefix + ':SCAN:MODE').get()
-        self.grabFlag = PV(pvPrefix + ':GRABIMAGES:ENABLE').get()
-        self.imageModeInitialPv = PV(pvPrefix + ':GRABIMAGES:IMAGEMODE_INITIAL')
-        self.acquiringInitialPv = PV(pvPrefix + ':GRABIMAGES:ACQUIRING_INITIAL')
+        self.scanmode = getPV(pvPrefix + ':SCAN:MODE').get()
+        self.grabFlag = getPV(pvPrefix + ':GRABIMAGES:ENABLE').get()
+        self.imageModeInitialPv = getPV(pvPrefix + ':GRABIMAGES:IMAGEMODE_INITIAL')
+        self.acquiringInitialPv = getPV(pvPrefix + ':GRABIMAGES:ACQUIRING_INITIAL')
         if plugin == 'TIFF1':
             fileExt = '.tif'
         elif plugin == 'JPEG1':
@@ -929,16 +1702,11 @@ class ADGrabber():
         else:
             fileExt = '.img'
         self.imagePvPrefix = cameraPvPrefix + ':' + plugin
-        self.numCapturePv = PV(self.imagePvPrefix + ':NumCapture')
-        self.templatePv = PV(self.imagePvPrefix + ':FileTemplate')
-        self.capturePv = PV(self.imagePvPrefix + ':Capture')
-        self.captureRBVPv = PV(self.imagePvPrefix + ':Capture_RBV.RVAL')
-        self.grabImagesCaptureRBVPv = PV(pvPrefix + ':GRABIMAGES:CAPTURE_RBV.INP')
-        self.grabImagesCaptureRBVPv.put(self.captureRBVPv.pvname + ' CPP')
-        self.acquirePv = PV(cameraPvPrefix + ':cam1:Acquire')
-        self.acquireRBVPv = PV(cameraPvPrefix + ':cam1:Acquire_RBV.RVAL')
-        self.imageModePv = PV(cameraPvPrefix + ':cam1:ImageMode')
-        self.imageModeRBVPv = PV(cameraPvPrefix + ':cam1:ImageMode_RBV')
+        self._init_plugin_pvs()
+        self.acquirePv = getPV(cameraPvPrefix + ':cam1:Acquire')
+        self.acquireRBVPv = getPV(cameraPvPrefix + ':cam1:Acquire_RBV.RVAL')
+        self.imageModePv = getPV(cameraPvPrefix + ':cam1:ImageMode')
+        self.imageModeRBVPv = getPV(cameraPvPrefix + ':cam1:ImageMode_RBV')
         # Get initial image mode for abort routine
         self.imageModeInitial = self.imageModeRBVPv.get()
         self.acquiringInitial = self.acquireRBVPv.get()
@@ -948,16 +1716,11 @@ class ADGrabber():
         if not abortFlag:
             self.imageModeInitialPv.put(self.imageModeInitial)
             self.acquiringInitialPv.put(self.acquiringInitial)
-        self.numExposuresPv = PV(cameraPvPrefix + ':cam1:NumExposures')
-        self.arrayCounterPv = PV(cameraPvPrefix + ':cam1:ArrayCounter')
-        self.arrayCounterRBVPv = PV(cameraPvPrefix + ':cam1:ArrayCounter_RBV')
-        self.imagesPerAcqPv = PV(cameraPvPrefix + ':cam1:NumImages')
-        self.lastImagePv = PV(self.imagePvPrefix + ':FullFileName_RBV')
-        self.writingRBVPv = PV(self.imagePvPrefix + ':WriteFile_RBV.RVAL')
-        self.timestampRBVPv = PV(self.imagePvPrefix + ':TimeStamp_RBV')
-        self.filePathPv = PV(self.imagePvPrefix + ':FilePath')
-        self.fileNamePv = PV(self.imagePvPrefix + ':FileName')
-        self.queueSizePv = PV(self.imagePvPrefix + ':QueueSize')
+        self.numExposuresPv = getPV(cameraPvPrefix + ':cam1:NumExposures')
+        self.arrayCounterPv = getPV(cameraPvPrefix + ':cam1:ArrayCounter')
+        self.arrayCounterRBVPv = getPV(cameraPvPrefix + ':cam1:ArrayCounter_RBV')
+        self.imagesPerAcqPv = getPV(cameraPvPrefix + ':cam1:NumImages')
+        self.timestampRBVPv = getPV(self.imagePvPrefix + ':TimeStamp_RBV')
         self.cameraPvPrefix = cameraPvPrefix
         self.fileNamePrefix = self.cameraPvPrefix  # To make this user modifiable
         self.pvlist = pvlist
@@ -966,51 +1729,104 @@ class ADGrabber():
         self.nImages = nImages
         self.fileExt = fileExt
         self.filenameExtras = ''
-        self.captureMode = PV(pvPrefix + ':GRABIMAGES:CAPTUREMODE').get()
-        self.writeTiffTagsFlag = PV(pvPrefix + ':GRABIMAGES:TIFFTS').get() # Tiff tag timestamps
-        self.stepFlag = PV(pvPrefix + ':GRABIMAGES:STEPNUMBER').get() # Write step number into filename
-        self.grabSeq2Flag = PV(pvPrefix + ':GRABIMAGES:SEQ2ENABLE').get() # Grab second image sequence after first 
-        self.grabSeq2Delay = PV(pvPrefix + ':GRABIMAGES:SEQ2DELAY').get() 
-        self.nImages2 = PV(pvPrefix + ':GRABIMAGES:N2').get() # N images for second sequence
-        self.waitForNewImageFlag = PV(pvPrefix + ':GRABIMAGES:WAIT_NEW').get() # Wait for new image before capturing?
-        self.stopAcquisitionFlag = PV(pvPrefix + ':GRABIMAGES:STOP_ACQ').get() # Stop acquisition at end of scan
+        self.scanStep = None  # Scan step label and acquisition tag of the current grab
+        self.acqTag = None
+        self.captureMode = getPV(pvPrefix + ':GRABIMAGES:CAPTUREMODE').get()
+        self.writeTiffTagsFlag = getPV(pvPrefix + ':GRABIMAGES:TIFFTS').get() # Tiff tag timestamps
+        self.stepFlag = getPV(pvPrefix + ':GRABIMAGES:STEPNUMBER').get() # Write step number into filename
+        self.grabSeq2Flag = getPV(pvPrefix + ':GRABIMAGES:SEQ2ENABLE').get() # Grab second image sequence after first 
+        self.grabSeq2Delay = getPV(pvPrefix + ':GRABIMAGES:SEQ2DELAY').get() 
+        self.nImages2 = getPV(pvPrefix + ':GRABIMAGES:N2').get() # N images for second sequence
+        self.waitForNewImageFlag = getPV(pvPrefix + ':GRABIMAGES:WAIT_NEW').get() # Wait for new image before capturing?
+        self.stopAcquisitionFlag = getPV(pvPrefix + ':GRABIMAGES:STOP_ACQ').get() # Stop acquisition at end of scan
         self.imageFilepaths = []
+        self.imageFiles = []  # (filename, EPICS timestamp) of the last grab, from monitor events
+        self.imageTemplate = None  # Last FileTemplate put, for indexed capture mode
+        self.imageIndexFilename = None  # Side-car index (filename --> EPICS timestamp)
+        self.reduceFlag = getOptional(pvPrefix + ':GRABIMAGES:REDUCE:ENABLE', 0) # Online image reduction
+        self.reduceOnlyFlag = getOptional(pvPrefix + ':GRABIMAGES:REDUCE:NOSAVE', 0) # Reduce only, don't save images
+        self.lastFrames = None
+        self._init_reducer(abortFlag)
+
+    def _init_plugin_pvs(self):
+        """Create the file plugin PVs."""
+        self.numCapturePv = getPV(self.imagePvPrefix + ':NumCapture')
+        self.templatePv = getPV(self.imagePvPrefix + ':FileTemplate')
+        self.capturePv = getPV(self.imagePvPrefix + ':Capture')
+        self.captureRBVPv = getPV(self.imagePvPrefix + ':Capture_RBV.RVAL')
+        self.grabImagesCaptureRBVPv = getPV(pvPrefix + ':GRABIMAGES:CAPTURE_RBV.INP')
+        self.grabImagesCaptureRBVPv.put(self.captureRBVPv.pvname + ' CPP')
+        self.lastImagePv = getPV(self.imagePvPrefix + ':FullFileName_RBV')
+        self.numCapturedRBVPv = getPV(self.imagePvPrefix + ':NumCaptured_RBV')
+        self.writingRBVPv = getPV(self.imagePvPrefix + ':WriteFile_RBV.RVAL')
+        self.filePathPv = getPV(self.imagePvPrefix + ':FilePath')
+        self.fileNamePv = getPV(self.imagePvPrefix + ':FileName')
+        self.queueSizePv = getPV(self.imagePvPrefix + ':QueueSize')
+
+    def _init_reducer(self, abortFlag=False):
+        """Create the online image reducer, if enabled."""
+        if self.reduceFlag and not abortFlag:
+            self.arrayMonitor = ArrayMonitor(self.cameraPvPrefix)
+            self.reducer = ImageReducer(self.filepath, self.cameraPvPrefix)
+        else:
+            self.arrayMonitor = None
+            self.reducer = None
 
-    def _create_image_filepath(self):
+    def _create_image_filepath(self, resume=False):
         """Creates image filepath, sets IMAGE:FILEPATH PV.
            Should be called just after image grabber object is created.
+           If resume is set, an existing filepath is reused.
         """
         if self.scanmode and self.grabFlag:
-            if os.path.exists(self.filepath):
+            if resume and os.path.isdir(self.filepath):
+                pass
+            elif os.path.exists(self.filepath):
                 msgPv.put('Failed: Filepath already exists')
                 raise IOError('Filepath already exists')
             else:
                 os.makedirs(self.filepath)
-        PV(pvPrefix + ':IMAGE:FILEPATH').put(self.filepath)  # Write filepath to PV for "Browse images" button
+        getPV(pvPrefix + ':IMAGE:FILEPATH').put(self.filepath)  # Write filepath to PV for "Browse images" button
         
-    def grabImages(self, nImages=0, grabImagesWriteSettingsFlag=0, pause=0.5):
+    @stepTimer.timed('capture')
+    def grabImages(self, nImages=0, grabImagesWriteSettingsFlag=0, pause=GRAB_PAUSE):
         """Grabs n images from camera."""
         functionName = 'grabImages'
         logging.debug('%s: captureMode: %s' % (functionName, self.captureMode))
         self.nImages = nImages if nImages else self.nImages
         printMsg('Grabbing %d images from %s...' % (self.nImages, self.cameraPvPrefix))
-        PV(self.imagePvPrefix + ':EnableCallbacks').put(1)
+        if self.arrayMonitor and self.reducer and self.reduceOnlyFlag:
+            self._reduceOnlyCapture()
+            self.lastFrames = self.arrayMonitor.stop()
+            self._reduce(self.lastFrames)
+            printSleep(pause, string='Reduced %d images from %s: Pausing' % 
+                      (len(self.lastFrames), self.cameraPvPrefix))
+            return
+        getPV(self.imagePvPrefix + ':EnableCallbacks').put(1)
         # PV().put() seems to need a null terminator when putting strings to waveforms.
         self.filePathPv.put(self.filepath + '\0')
         self.fileNamePv.put(self.fileNamePrefix + self.filenameExtras + '\0')
-        PV(self.imagePvPrefix + ':AutoIncrement').put(1)
+        getPV(self.imagePvPrefix + ':AutoIncrement').put(1)
         # Use "Stream" write mode (FileWriteMode=2) as "Capture" will be removed in a future version of AD:
-        PV(self.imagePvPrefix + ':FileWriteMode').put(2)
-        PV(self.imagePvPrefix + ':AutoSave').put(1)
-        PV(self.imagePvPrefix + ':FileNumber').put(1)
+        getPV(self.imagePvPrefix + ':FileWriteMode').put(2)
+        getPV(self.imagePvPrefix + ':AutoSave').put(1)
+        # In indexed mode, FileNumber keeps incrementing across grabs to keep filenames unique
+        if self.captureMode != 5 or self.imageIndexFilename is None:
+            getPV(self.imagePvPrefix + ':FileNumber').put(1)
         if self.captureMode == 1:
             self._bufferedCapture()
         elif self.captureMode == 2:
             self._CBACapture()
         elif self.captureMode == 3:
             self._multipleCapture()
+        elif self.captureMode == 4:
+            self._arrayCounterCapture()
+        elif self.captureMode == 5:
+            self._indexedCapture()
         else:
             self._individualCapture()
+        if self.arrayMonitor:
+            self.lastFrames = self.arrayMonitor.stop()
+            self._reduce(self.lastFrames)
         if grabImagesWriteSettingsFlag:
             self._writeCameraSettings()
         if self.writeTiffTagsFlag:
@@ -1018,6 +1834,20 @@ class ADGrabber():
         printSleep(pause, string='Grabbed %d images from %s: Pausing' % 
                   (self.nImages, self.cameraPvPrefix))
             
+    def _armArrayMonitor(self, first=None):
+        """Start collecting the next nImages frames for online reduction, from 
+           ArrayCounter first (default: the frame after the current one).  Called 
+           by each capture mode right before it starts capturing."""
+        if self.arrayMonitor:
+            if first is None:
+                first = self.arrayCounterRBVPv.get() + 1
+            self.arrayMonitor.start(self.nImages, first)
+
+    def _reduce(self, frames):
+        """Reduce frames for the current scan step and acquisition tag."""
+        if self.reducer:
+            self.reducer.reduce(frames, self.scanStep, self.acqTag, self.filenameExtras)
+
     def _setAcquire(self, retry=True):
         """Starts camera acquisition if not already acquiring."""
         functionName = '_setAcquire'
@@ -1047,11 +1877,12 @@ class ADGrabber():
             outfile.write(timestamp() + '\n')
             outfile.write('-----------------------------------------------------------\n')
             for pv in self.pvlist:
-                pv = PV(pv)
+                pv = getPV(pv)
                 outfile.write(str(pv.pvname) + ' ')
                 outfile.write(str(pv.value) + '\n')
             outfile.write('\n')
 
+    @stepTimer.timed('rename')
     def _writeTiffTags(self):
         """Timestamps image file names with tiff tags."""
         functionName = '_writeTiffTags'
@@ -1094,13 +1925,15 @@ class ADGrabber():
         if self.waitForNewImageFlag:
             self._waitForNewImage()
         logging.debug('%s: capturing, QueueSize=%s' % (functionName, self.nImages))
+        self._armArrayMonitor()
         self.capturePv.put(1, wait=True)
         # Build a list of filenames for (optional) tiff tag file naming
         if self.writeTiffTagsFlag:
             self.imageFilepaths = ([('%s%s%s_%04d%s' % (self.filepath, self.fileNamePrefix, 
                     self.filenameExtras, n+1, self.fileExt)) for n in range(self.nImages)])
-        while self.captureRBVPv.get() or self.writingRBVPv.get():
-            sleep(0.05)
+        with stepTimer.span('write'):
+            while self.captureRBVPv.get() or self.writingRBVPv.get():
+                sleep(0.05)
         logging.debug('%s: Done capturing' % (functionName))
 
     def _individualCapture(self):
@@ -1117,6 +1950,7 @@ class ADGrabber():
             self._waitForNewImage()
         # Capturing loop
         logging.debug('%s: capturing' % (functionName))
+        self._armArrayMonitor()
         for i in range(self.nImages):
             # Set FileTemplate PV and then grab image
             imageFilenameTemplate = '%s%s_' + timestamp(1) + '_%4.4d' + self.fileExt
@@ -1144,6 +1978,7 @@ class ADGrabber():
         self.numCapturePv.put(1)
         # Capturing loop
         logging.debug('%s: capturing' % (functionName))
+        self._armArrayMonitor()
         for i in range(self.nImages):
             # Set FileTemplate PV and then grab image
             imageFilenameTemplate = '%s%s_' + timestamp(1) + '_%4.4d' + self.fileExt
@@ -1188,6 +2023,7 @@ class ADGrabber():
         if self.waitForNewImageFlag:
             self._waitForNewImage()
         logging.debug('%s: capturing, QueueSize=%s' % (functionName, self.nImages))
+        self._armArrayMonitor(first=1)  # ArrayCounter was reset
         self.capturePv.put(1, wait=False)
         sleep(0.1)
         # Turn acquisition on:
@@ -1198,12 +2034,117 @@ class ADGrabber():
                     self.filenameExtras, n+1, self.fileExt)) for n in range(self.nImages)])
         while self.arrayCounterRBVPv.get() < self.nImages:
             sleep(0.05)
-        while self.captureRBVPv.get() or self.writingRBVPv.get() or self.acquireRBVPv.get():
-            sleep(0.05)
+        with stepTimer.span('write'):
+            while self.captureRBVPv.get() or self.writingRBVPv.get() or self.acquireRBVPv.get():
+                sleep(0.05)
+        logging.debug('%s: Done capturing' % (functionName))
+        # Set Image Mode back to initial
+        self.imageModePv.put(imageMode0)
+
+    def _arrayCounterCapture(self, timeout=300.0):
+        """Capture images with a single armed acquisition (AD Image Mode = Multiple).
+           Frames are counted from ArrayCounter_RBV monitor events, and filenames
+           are collected from FullFileName_RBV monitor events, so there are no
+           per-image puts or polling gets."""
+        functionName = '_arrayCounterCapture'
+        logging.debug('%s' % (functionName))
+        # If we're acquiring, stop now
+        if self.acquireRBVPv.get():
+            self.stopAcquire()
+            sleep(0.1)
+        imageMode0 = self.imageModeRBVPv.get()
+        # Arm plugin and camera once for all images
+        self.arrayCounterPv.put(0, wait=True)
+        self.imageModePv.put(1)  # Set to Image Mode = Multiple
+        self.numExposuresPv.put(1)  # 1 exposure per image
+        self.imagesPerAcqPv.put(self.nImages)
+        self.numCapturePv.put(self.nImages)
+        self.queueSizePv.put(self.nImages)
+        imageFilenameTemplate = '%s%s_%4.4d' + self.fileExt
+        self.templatePv.put(imageFilenameTemplate + '\0', wait=True)
+        monitor = ImageFileMonitor(self, self.nImages)
+        monitor.start()
+        try:
+            logging.debug('%s: capturing, NumImages=%s' % (functionName, self.nImages))
+            self._armArrayMonitor(first=1)  # ArrayCounter was reset
+            self.capturePv.put(1, wait=False)
+            sleep(0.1)
+            self.acquirePv.put(1)
+            if not monitor.wait(timeout):
+                logging.warning('%s: timed out after %s s: %d/%d frames acquired, %d captured' 
+                        % (functionName, timeout, monitor.frameCount, self.nImages, monitor.numCaptured))
+        finally:
+            monitor.stop()
+        self.imageFiles = monitor.files
+        self.imageFilepaths = [filename for filename, ts in monitor.files]
+        self._writeImageIndex(monitor.files)
         logging.debug('%s: Done capturing' % (functionName))
         # Set Image Mode back to initial
         self.imageModePv.put(imageMode0)
 
+    def _indexedCapture(self, timeout=300.0):
+        """Capture images in AD individual mode, without per-image puts.
+           FileTemplate is only set once; FileNumber auto-increment keeps
+           filenames unique, and a side-car index of filename --> EPICS
+           timestamp is built from FullFileName_RBV monitor events."""
+        functionName = '_indexedCapture'
+        logging.debug('%s' % (functionName))
+        # Set Image Mode to "Continuous"
+        if self.imageModeRBVPv.get() != 2:
+            self.stopAcquire()
+            self.imageModePv.put(2)
+        self._setAcquire() # Turn acquisition on
+        imageFilenameTemplate = '%s%s_%4.4d' + self.fileExt
+        if self.imageTemplate != imageFilenameTemplate:
+            self.templatePv.put(imageFilenameTemplate + '\0', wait=True)
+            self.imageTemplate = imageFilenameTemplate
+        self.numCapturePv.put(self.nImages)
+        if self.waitForNewImageFlag:
+            self._waitForNewImage()
+        monitor = ImageFileMonitor(self, self.nImages)
+        monitor.start()
+        try:
+            logging.debug('%s: capturing' % (functionName))
+            self._armArrayMonitor()
+            self.capturePv.put(1, wait=False)
+            if not monitor.wait(timeout):
+                logging.warning('%s: timed out after %s s: %d/%d images captured' 
+                        % (functionName, timeout, monitor.numCaptured, self.nImages))
+        finally:
+            monitor.stop()
+        self.imageFiles = monitor.files
+        self.imageFilepaths = [filename for filename, ts in monitor.files]
+        self._writeImageIndex(monitor.files)
+        logging.debug('%s: Done capturing' % (functionName))
+
+    def _writeImageIndex(self, files):
+        """Append (filename, EPICS timestamp) records to the side-car image index."""
+        if self.imageIndexFilename is None:
+            self.imageIndexFilename = (self.filepath + 'imageIndex-' + 
+                    self.cameraPvPrefix + '-' + NOW + '.txt')
+        with open(self.imageIndexFilename, 'a') as outfile:
+            for filename, ts in files:
+                if ts is None:
+                    outfile.write('%s Invalid Invalid\n' % (filename))
+                else:
+                    outfile.write('%s %s %.6f\n' % (filename, 
+                            datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d_%H%M%S.%f'), ts))
+
+    def _reduceOnlyCapture(self, timeout=300.0):
+        """Collect images from the array plugin for online reduction, without saving files."""
+        functionName = '_reduceOnlyCapture'
+        logging.debug('%s' % (functionName))
+        # Set Image Mode to "Continuous"
+        if self.imageModeRBVPv.get() != 2:
+            self.stopAcquire()
+            self.imageModePv.put(2)
+        self._setAcquire() # Turn acquisition on
+        self._armArrayMonitor()
+        if not self.arrayMonitor.wait(timeout):
+            logging.warning('%s: timed out after %s s: %d/%d frames' 
+                    % (functionName, timeout, self.arrayMonitor.frameCount, self.nImages))
+        logging.debug('%s: Done capturing' % (functionName))
+
     def _waitForNewImage(self):
         """Waits for ArrayCounter to increment."""
         functionName = '_waitForNewImage'
@@ -1228,6 +2169,134 @@ class ADGrabber():
             self._setAcquire()
 
 
+class ArrayGrabber(ADGrabber):
+    """AreaDetector grabber which bypasses the file plugins.  Frames are taken from
+       the NDStdArrays plugin (ArrayData waveform) and written straight into a
+       preallocated, memory-mapped NumPy stack (.npy), one block of frames per grab.
+       Mono images only; EPICS_CA_MAX_ARRAY_BYTES must be large enough for one frame."""
+    def __init__(self, cameraPvPrefix=None, filepath=None, nImages=None, nFrames=None,
+                 pvlist=None, plugin='image1', abortFlag=False):
+        ADGrabber.__init__(self, cameraPvPrefix, filepath, nImages, pvlist, plugin, abortFlag)
+        className = self.__class__.__name__
+        functionName = '__init__'
+        self.sizeX = getPV(self.cameraPvPrefix + ':cam1:ArraySizeX_RBV').get()
+        self.sizeY = getPV(self.cameraPvPrefix + ':cam1:ArraySizeY_RBV').get()
+        dataType = getPV(self.cameraPvPrefix + ':cam1:DataType_RBV').get(as_string=True)
+        try:
+            self.dtype = np.dtype(dataType.lower())
+        except (AttributeError, TypeError):
+            logging.warning('%s.%s: unknown data type %s, using uint16' % (className, functionName, dataType))
+            self.dtype = np.dtype('uint16')
+        self.nFrames = nFrames if nFrames is not None else self.nImages
+        self.captureMode = None
+        self.writeTiffTagsFlag = 0
+        self.stack = None
+        self.stackFilename = None
+        self.indexFilename = None
+        self.frameIndex = 0  # Next free frame in the stack
+        self._stopIndex = 0
+        self._frameTimestamps = []
+        self._done = Event()
+
+    def _init_plugin_pvs(self):
+        """Create the NDStdArrays plugin PVs; there are no file plugin PVs.  ArrayData
+           is only monitored while grabbing, so frames aren't streamed between grabs."""
+        self.arrayDataPv = getPV(self.imagePvPrefix + ':ArrayData', auto_monitor=False)
+        self.enableCallbacksPv = getPV(self.imagePvPrefix + ':EnableCallbacks')
+        self.captureRBVPv = None
+        self.lastImagePv = None
+        self.numCapturedRBVPv = None
+        self.writingRBVPv = None
+
+    def _init_reducer(self, abortFlag=False):
+        """Create the online image reducer, if enabled; frames come from the stack."""
+        self.arrayMonitor = None
+        self.reducer = (ImageReducer(self.filepath, self.cameraPvPrefix) 
+                if self.reduceFlag and not abortFlag else None)
+
+    def _create_image_filepath(self, resume=False):
+        """Creates image filepath and the memory-mapped frame stack."""
+        ADGrabber._create_image_filepath(self, resume)
+        if self.scanmode and self.grabFlag:
+            self.stackFilename = self.filepath + 'frames-' + self.cameraPvPrefix + '-' + NOW + '.npy'
+            self.indexFilename = self.filepath + 'frames-' + self.cameraPvPrefix + '-' + NOW + '.txt'
+            self.stack = np.lib.format.open_memmap(self.stackFilename, mode='w+', 
+                    dtype=self.dtype, shape=(self.nFrames, self.sizeY, self.sizeX))
+            with open(self.indexFilename, 'w') as outfile:
+                outfile.write('# Frame index, step, EPICS timestamp for %s\n' % (self.stackFilename))
+
+    def _onArrayData(self, value=None, timestamp=None, **kws):
+        """ArrayData callback: copy frame into the stack while armed."""
+        if value is None or self.frameIndex >= self._stopIndex:
+            return
+        npix = self.sizeX*self.sizeY
+        if len(value) < npix:
+            logging.warning('ArrayGrabber: short array (%d < %d), check image size' % (len(value), npix))
+            return
+        self.stack[self.frameIndex] = np.reshape(value[:npix], (self.sizeY, self.sizeX))
+        self._frameTimestamps.append(timestamp)
+        self.frameIndex += 1
+        if self.frameIndex >= self._stopIndex:
+            self._done.set()
+
+    @stepTimer.timed('capture')
+    def grabImages(self, nImages=0, grabImagesWriteSettingsFlag=0, pause=GRAB_PAUSE, timeout=300.0):
+        """Grabs n frames from the ArrayData waveform into the frame stack."""
+        functionName = 'grabImages'
+        self.nImages = nImages if nImages else self.nImages
+        printMsg('Grabbing %d images from %s...' % (self.nImages, self.cameraPvPrefix))
+        if self.stack is None:
+            printMsg('Failed: %s frame stack not created' % (self.cameraPvPrefix))
+            return
+        nFree = self.nFrames - self.frameIndex
+        if self.nImages > nFree:
+            logging.warning('%s: frame stack full, grabbing %d of %d images' 
+                    % (functionName, nFree, self.nImages))
+        start = self.frameIndex
+        self.enableCallbacksPv.put(1)
+        # Set Image Mode to "Continuous"
+        if self.imageModeRBVPv.get() != 2:
+            self.stopAcquire()
+            self.imageModePv.put(2)
+        self._setAcquire()
+        if self.waitForNewImageFlag:
+            self._waitForNewImage()
+        self._frameTimestamps = []
+        self._done.clear()
+        self._stopIndex = start + min(self.nImages, nFree)
+        if self._stopIndex > start:
+            self.arrayDataPv.auto_monitor = True
+            index = self.arrayDataPv.add_callback(self._onArrayData)
+            try:
+                if not self._done.wait(timeout):
+                    logging.warning('%s: timed out after %s s: %d/%d frames' 
+                            % (functionName, timeout, self.frameIndex - start, self.nImages))
+            finally:
+                self._stopIndex = self.frameIndex
+                self.arrayDataPv.remove_callback(index)
+                self.arrayDataPv.auto_monitor = False
+        self.stack.flush()
+        self.lastFrames = self.stack[start:self.frameIndex]
+        self._reduce(self.lastFrames)
+        with open(self.indexFilename, 'a') as outfile:
+            for i, ts in enumerate(self._frameTimestamps):
+                outfile.write('%d %s %s\n' % (start + i, self.filenameExtras.lstrip('_') or '-', 
+                        '%.6f' % (ts) if ts is not None else 'Invalid'))
+        if grabImagesWriteSettingsFlag:
+            self._writeCameraSettings()
+        printSleep(pause, string='Grabbed %d images from %s: Pausing' % 
+                  (self.frameIndex - start, self.cameraPvPrefix))
+
+    def abort(self):
+        """Abort image grabbing."""
+        self._stopIndex = self.frameIndex
+        self.stopAcquire()
+        self.imageModePv.put(self.imageModeInitialPv.get())
+        sleep(0.15)
+        if self.acquiringInitialPv.get():
+            self._setAcquire()
+
+
 class Error(Exception):
     """Base class for exceptions in this module."""
     pass
@@ -1238,8 +2307,616 @@ class ShutterError(Error):
     pass
 
 
+class ScanCheckpoint():
+    """Scan checkpoint file, written atomically after every completed scan step, so
+       that an aborted scan can be resumed (SCAN:RESUME) in the same directory."""
+    filename = 'checkpoint.json'
+
+    def __init__(self, filepath):
+        self.filepath = filepath + self.filename
+        self.state = None
+
+    def load(self):
+        """Return the saved state, or None if there is no checkpoint."""
+        try:
+            with open(self.filepath, 'r') as fh:
+                self.state = json.load(fh)
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('ScanCheckpoint.load: %s' % (e))
+            self.state = None
+        return self.state
+
+    def save(self, **state):
+        """Write state to a temporary file, then rename it over the checkpoint."""
+        state['time'] = timestamp(1)
+        tmpFilepath = self.filepath + '.tmp'
+        with open(tmpFilepath, 'w') as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmpFilepath, self.filepath)
+        self.state = state
+
+
+# Largest exponent allowed in coupled axis expressions
+EXPR_MAX_EXPONENT = 100
+
+
+def _power(base, exponent):
+    """** for expressions: numbers (or arrays) only, in floating point, with 
+       |exponent| <= EXPR_MAX_EXPONENT, so that e.g. 9**9**9 can't hang the scan."""
+    try:
+        base, exponent = np.asarray(base, dtype=float), np.asarray(exponent, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError('** needs numbers')
+    if np.any(np.abs(exponent) > EXPR_MAX_EXPONENT):
+        raise ValueError('exponent larger than %d' % (EXPR_MAX_EXPONENT))
+    with np.errstate(all='ignore'):
+        return np.power(base, exponent)
+
+
+# Operators allowed in coupled axis expressions
+EXPR_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, 
+        ast.Div: operator.truediv, ast.Pow: _power, ast.Mod: operator.mod,
+        ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Lt: operator.lt, ast.LtE: operator.le,
+        ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+
+def evalExpression(expression, namespace):
+    """Evaluate an arithmetic expression: numbers, names from namespace, + - * / ** %
+       (see _power), comparisons, and calls of functions from namespace.  Anything else (attributes,
+       subscripts, keyword arguments, ...) raises ValueError."""
+    def _eval(node):
+        if isinstance(node, ast.Expression):
+            return _eval(node.body)
+        if isinstance(node, getattr(ast, 'Constant', ())) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, getattr(ast, 'Num', ())):  # Python < 3.8
+            return node.n
+        if isinstance(node, ast.Name):
+            if node.id not in namespace:
+                raise ValueError('unknown name %s' % (node.id))
+            return namespace[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in EXPR_OPERATORS:
+            return EXPR_OPERATORS[type(node.op)](_eval(node.left), _eval(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in EXPR_OPERATORS:
+            return EXPR_OPERATORS[type(node.op)](_eval(node.operand))
+        if (isinstance(node, ast.Compare) and len(node.ops) == 1 
+                and type(node.ops[0]) in EXPR_OPERATORS):
+            return EXPR_OPERATORS[type(node.ops[0])](_eval(node.left), _eval(node.comparators[0]))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and callable(namespace.get(node.func.id))
+                and not node.keywords and not getattr(node, 'starargs', None) 
+                and not getattr(node, 'kwargs', None)):
+            return namespace[node.func.id](*[_eval(arg) for arg in node.args])
+        raise ValueError('%s not allowed' % (type(node).__name__))
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('syntax error: %s' % (e))
+    return _eval(tree)
+
+
+class Trajectory():
+    """Full scan trajectory, built up front: an (nSteps, nAxes) array of positions, 
+       one row per scan step in the order pvNDScan visits them.  Coupled axes are
+       arithmetic expressions (see evalExpression) of the other axes (x1, x2, ...) and
+       numpy functions, e.g. 'r*cos(radians(x1))'."""
+    namespace = dict((name, getattr(np, name)) for name in ('sin', 'cos', 'tan', 'arcsin', 
+            'arccos', 'arctan', 'arctan2', 'sqrt', 'exp', 'log', 'log10', 'abs', 'radians', 
+            'degrees', 'minimum', 'maximum', 'clip', 'where', 'pi'))
+
+    def __init__(self):
+        self.names = []
+        self.columns = []
+        self.pvs = []
+        self.coupled = []
+
+    @classmethod
+    def fromScanPvs(cls, pv1, pv2=None):
+        """Build the step grid of a 1- or 2-D scan; PV #2 is the inner loop."""
+        trajectory = cls()
+        pos1 = np.asarray(pv1.scanPos, dtype=float)
+        if pv2 is None:
+            trajectory.addAxis('x1', pos1, pv1)
+        else:
+            pos2 = np.asarray(pv2.scanPos, dtype=float)
+            trajectory.addAxis('x1', np.repeat(pos1, len(pos2)), pv1)
+            trajectory.addAxis('x2', np.tile(pos2, len(pos1)), pv2)
+        return trajectory
+
+    @property
+    def nSteps(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    @property
+    def positions(self):
+        """(nSteps, nAxes) array of positions."""
+        return np.column_stack(self.columns) if self.columns else np.empty((0, 0))
+
+    def addAxis(self, name, positions, pv=None):
+        """Add an axis from an array of positions, one per step."""
+        positions = np.asarray(positions, dtype=float).ravel()
+        if self.columns and len(positions) != self.nSteps:
+            raise ValueError('Trajectory: axis %s has %d points, expected %d' 
+                    % (name, len(positions), self.nSteps))
+        self.names.append(name)
+        self.columns.append(positions)
+        self.pvs.append(pv)
+        return positions
+
+    def addCoupledAxis(self, name, expression, pv=None, **params):
+        """Add an axis computed from the existing axes, e.g. a Z-lock 'slope*x1 + intercept'
+           with slope and intercept passed as params."""
+        namespace = dict(self.namespace)
+        namespace.update(params)
+        namespace.update(zip(self.names, self.columns))
+        try:
+            positions = evalExpression(expression, namespace)
+        except Exception as e:
+            raise ValueError('Trajectory: invalid expression for %s: %s (%s)' % (name, expression, e))
+        positions = self.addAxis(name, np.asarray(positions, dtype=float) + np.zeros(self.nSteps), pv)
+        self.coupled.append(len(self.names) - 1)
+        return positions
+
+    def softLimits(self, values=None):
+        """Return {name: (low, high)} for axes with a PV and soft limits set.
+           The limit fields are fetched in one batch unless values are given."""
+        fields = dict((name, axisFields(pv)) for name, pv in zip(self.names, self.pvs) if pv is not None)
+        if values is None:
+            values = cagetMany([f[key] for f in fields.values() for key in ('low', 'high')])
+        limits = {}
+        for name, f in fields.items():
+            low, high = values.get(f['low']), values.get(f['high'])
+            if low is None or high is None or low == high:
+                continue
+            limits[name] = (min(low, high), max(low, high))
+        return limits
+
+    def validate(self, limits=None):
+        """Check every point of the trajectory against soft limits before the first move.
+           Raises ValueError at the first axis with a point out of range."""
+        if limits is None:
+            limits = self.softLimits()
+        for name, positions in zip(self.names, self.columns):
+            bad = np.flatnonzero(~np.isfinite(positions))
+            if bad.size:
+                raise ValueError('Trajectory: %s position at step %d is not a number' % (name, bad[0] + 1))
+            if name not in limits:
+                continue
+            low, high = limits[name]
+            bad = np.flatnonzero((positions < low) | (positions > high))
+            if bad.size:
+                raise ValueError('Trajectory: %s position %f at step %d outside soft limits [%f, %f] '
+                        '(%d of %d points)' % (self._label(name), positions[bad[0]], bad[0] + 1, 
+                        low, high, bad.size, len(positions)))
+        logging.info('Trajectory.validate: %d steps, %d axes OK' % (self.nSteps, len(self.names)))
+
+    def moveCoupled(self, row):
+        """Move the coupled axes to their positions for a step (row)."""
+        for i in self.coupled:
+            pv = self.pvs[i]
+            if pv is None:
+                continue
+            printMsg('Setting %s to %f' % (pv.pvname, self.columns[i][row]))
+            pv.move(self.columns[i][row])
+
+    def _label(self, name):
+        pv = self.pvs[self.names.index(name)]
+        return '%s (%s)' % (pv.pvname, name) if pv is not None else name
+
+
+def axisFields(pv):
+    """Return the PV names of the soft limits, velocity, acceleration time and 
+       readback of a scan PV (None where not available).  Motor records use 
+       .LLM/.HLM; other records (including the Pollux and Beckhoff ao records)
+       use .DRVL/.DRVH."""
+    pvname = pv.pvname.split('.')[0]
+    if type(pv) is Motor:
+        low, high, accl = pvname + '.LLM', pvname + '.HLM', pvname + '.ACCL'
+    else:
+        low, high, accl = pvname + '.DRVL', pvname + '.DRVH', None
+    velo = getattr(pv, 'velo', None)
+    return {'low': low, 'high': high, 'accl': accl, 
+            'velo': velo.pvname if velo is not None else None,
+            'pos': pv.rbv.pvname if pv.rbv else pv.pvname}
+
+
+def preflight(exp, trajectory, pv1, pv2=None, grabObject=None, startRow=0):
+    """Check the whole scan before the first move.  Soft limits, velocities and
+       positions of all axes (and the camera frame period) are fetched in one batch, 
+       every point is validated (ValueError if one is out of range), and the scan 
+       duration from startRow on is estimated as moves + settling + acquisition.
+       Moves of axes with a readback are rounded up to the readback polling interval
+       (MOVE_POLL); acquisition includes the pause after each grab and the shutter
+       and sequence pauses.  The estimate is published to SCAN:EST_DURATION (s) and 
+       SCAN:EST_FINISH."""
+    functionName = 'preflight'
+    t0 = time()
+    fields = dict((name, axisFields(pv)) for name, pv in zip(trajectory.names, trajectory.pvs) 
+            if pv is not None)
+    pvnames = [pvname for f in fields.values() for pvname in f.values()]
+    cameraPvPrefix = getattr(grabObject, 'cameraPvPrefix', None) if isinstance(grabObject, ADGrabber) else None
+    if cameraPvPrefix:
+        pvnames += [cameraPvPrefix + ':cam1:AcquireTime_RBV', cameraPvPrefix + ':cam1:AcquirePeriod_RBV']
+    values = cagetMany(pvnames)
+    trajectory.validate(trajectory.softLimits(values))
+    nSteps = trajectory.nSteps - startRow
+    # Moves, from the current positions; axes without a velocity move instantly, but 
+    # waiting for the readback takes at least one polling interval
+    moveTime = 0.0
+    for name, column, pv in zip(trajectory.names, trajectory.columns, trajectory.pvs):
+        f = fields.get(name)
+        if not f or not nSteps:
+            continue
+        velo = values.get(f['velo'])
+        pos0 = values.get(f['pos'])
+        column = column[startRow:]
+        dist = np.abs(np.diff(np.concatenate(([column[0] if pos0 is None else pos0], column))))
+        dist = dist[dist > 0]
+        times = dist/velo + (values.get(f['accl']) or 0.0) if velo else np.zeros(len(dist))
+        if pv.rbv:
+            times = MOVE_POLL*np.maximum(1, np.ceil(times/MOVE_POLL - 1e-9))
+        moveTime += times.sum()
+    # Settling: PV #1 settles once per outer step, PV #2 at every step
+    if pv2 is not None:
+        rows = np.arange(startRow, trajectory.nSteps)
+        settleTime = (pv1.settletime*len(np.unique(rows//len(pv2.scanPos))) 
+                + pv2.settletime*nSteps)
+    else:
+        settleTime = pv1.settletime*nSteps
+    # Acquisition: a grab takes nImages frame periods and a pause; a DirectD grab 
+    # writes data for DATATIME, with pauses around starting and stopping the DataWriter
+    acqTime = 0.0
+    if grabObject and grabObject.grabFlag:
+        framePeriod = 0.0
+        if cameraPvPrefix:
+            framePeriod = max([values.get(cameraPvPrefix + ':cam1:' + field) or 0.0 
+                    for field in ('AcquireTime_RBV', 'AcquirePeriod_RBV')])
+        if isinstance(grabObject, DDGrabber):
+            nImages, pause = 0, (grabObject.dataTime or 0.0) + 1.0
+        else:
+            nImages, pause = grabObject.nImages or 0, GRAB_PAUSE
+        if exp.acqSequence is not None and not exp.acqFixed:
+            acqTime = exp.acqSequence.estimate(nImages, framePeriod, pause)
+        else:
+            acqTime = nImages*framePeriod + pause
+        if grabObject.grabSeq2Flag:
+            acqTime += (0.25 + _pumpedSequence(grabObject.nImages2 or 0, []).estimate(0, framePeriod, pause)
+                    + (grabObject.grabSeq2Delay or 0.0))
+        acqTime *= nSteps
+    duration = moveTime + settleTime + acqTime
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=duration)
+    putOptional(pvPrefix + ':SCAN:EST_DURATION', duration)
+    putOptional(pvPrefix + ':SCAN:EST_FINISH', finish.strftime('%Y-%m-%d %H:%M:%S'))
+    printMsg('Pre-flight OK: %d steps, estimated duration %s, finish %s' 
+            % (nSteps, datetime.timedelta(seconds=int(duration)), finish.strftime('%H:%M:%S')))
+    logging.info('%s: moves %.1f s, settling %.1f s, acquisition %.1f s; checked in %.3f s' 
+            % (functionName, moveTime, settleTime, acqTime, time() - t0))
+    return duration
+
+
+class FlyScan():
+    """Continuous (fly) scan of a Motor axis: a single move across the whole range, 
+       at a velocity set from the step spacing and the camera frame period, while 
+       the camera captures one frame per step.  RBV, ArrayCounter_RBV and Capture_RBV
+       monitor events are buffered with their EPICS timestamps; the first nImages 
+       frames after capture started are each tagged with the RBV interpolated at 
+       their timestamp.  The frame table (ArrayCounter, timestamp, position) is 
+       written to flyscan-<desc>-NOW.dat.  VELO is restored afterwards.  A 
+       single-entry acquisition sequence sets the shutters around the fly move."""
+    # Capture modes that take one frame per camera frame period (not 0 and 2, 
+    # which hand-shake every image)
+    captureModes = (1, 3, 4, 5)
+
+    def __init__(self, pv, positions, grabObject=None, filepath=None, acqSequence=None):
+        self.pv = pv
+        self.positions = np.asarray(positions, dtype=float)
+        self.grabObject = grabObject if grabObject and grabObject.grabFlag else None
+        self.acqSequence = acqSequence if self.grabObject else None
+        self.filename = filepath + 'flyscan-' + pv.desc + '-' + NOW + '.dat' if filepath else None
+        self._rbv = []  # (timestamp, position)
+        self._frames = []  # (timestamp, ArrayCounter)
+        self._captureStart = None  # Timestamp of Capture_RBV going on
+        self._grabError = None
+        self.filenameExtras = ''  # Of the grab, for the frame table header
+        self.table = None
+
+    @classmethod
+    def check(cls, exp, grabObject):
+        """Raise ValueError if images can't be grabbed during a fly move: the grabber 
+           needs ArrayCounter_RBV and Capture_RBV and a capture mode with a fixed frame 
+           rate, and the acquisition sequence must be fixed or a single entry."""
+        if not grabObject or not grabObject.grabFlag:
+            return
+        if (getattr(grabObject, 'arrayCounterRBVPv', None) is None 
+                or getattr(grabObject, 'captureRBVPv', None) is None):
+            raise ValueError('fly scan needs a file plugin grabber with ArrayCounter_RBV and Capture_RBV')
+        if grabObject.reduceOnlyFlag or grabObject.captureMode not in cls.captureModes:
+            raise ValueError('fly scan needs capture mode %s, with saved images' 
+                    % (', '.join([str(mode) for mode in cls.captureModes])))
+        if not exp.acqFixed and exp.acqSequence is not None and len(exp.acqSequence.entries) != 1:
+            raise ValueError('fly scan needs a fixed or single-entry acquisition sequence')
+        if exp.bgCache:
+            raise ValueError('fly scan does not support the background reference cache')
+
+    def _onRbv(self, value=None, timestamp=None, **kws):
+        """RBV callback."""
+        if value is not None:
+            self._rbv.append((timestamp, value))
+
+    def _onArrayCounter(self, value=None, timestamp=None, **kws):
+        """ArrayCounter_RBV callback."""
+        if value is not None:
+            self._frames.append((timestamp, value))
+
+    def _onCapture(self, value=None, timestamp=None, **kws):
+        """Capture_RBV callback."""
+        if value and self._captureStart is None:
+            self._captureStart = timestamp
+
+    def _framePeriod(self):
+        """Camera frame period (s): the longest of AcquireTime, AcquirePeriod and the 
+           period from the measured ArrayRate."""
+        prefix = self.grabObject.cameraPvPrefix + ':cam1:'
+        values = cagetMany([prefix + 'AcquireTime_RBV', prefix + 'AcquirePeriod_RBV', 
+                prefix + 'ArrayRate_RBV'])
+        rate = values[prefix + 'ArrayRate_RBV']
+        return max(values[prefix + 'AcquireTime_RBV'] or 0.0, values[prefix + 'AcquirePeriod_RBV'] or 0.0, 
+                1.0/rate if rate and rate > 0 else 0.0)
+
+    def velocity(self, framePeriod):
+        """Velocity that covers one step spacing per frame, limited to VMAX."""
+        velo = abs(self.positions[-1] - self.positions[0])/((len(self.positions) - 1)*framePeriod)
+        vmax = getPV(self.pv.pvname + '.VMAX').get()
+        if vmax and velo > vmax:
+            printMsg('WARNING: fly scan velocity %f is above VMAX, using %f' % (velo, vmax))
+            velo = vmax
+        return velo
+
+    def _grab(self, nImages):
+        """Grab thread target; keeps the exception for run() to raise."""
+        self.filenameExtras = self.grabObject.filenameExtras
+        try:
+            self.grabObject.grabImages(nImages)
+        except Exception as e:
+            logging.exception('FlyScan: grabImages failed')
+            self._grabError = e
+
+    def _setShutters(self):
+        """Set the shutters (and acquisition tag) of a single-entry acquisition sequence; 
+           return the state to restore."""
+        sequence = self.acqSequence
+        if sequence is None:
+            return None
+        entry = sequence.entries[0]
+        filenameExtras0 = self.grabObject.filenameExtras
+        if entry.tag:
+            printMsg('Starting %s acquisition' % (entry.tag))
+            self.grabObject.filenameExtras = '_' + entry.tag + self.grabObject.filenameExtras
+        self.grabObject.acqTag = entry.tag
+        initialState = tuple([shutterState(shutter) for shutter in sequence.shutters])
+        commanded = set()
+        state = sequence._setShutters(initialState, entry.state, commanded)
+        if sequence.check:
+            sequence._checkShutters(entry)
+        return filenameExtras0, initialState, state, commanded
+
+    def _restoreShutters(self, shutterStates):
+        """Undo _setShutters."""
+        if shutterStates is None:
+            return
+        sequence = self.acqSequence
+        filenameExtras0, initialState, state, commanded = shutterStates
+        self.grabObject.acqTag = None
+        self.grabObject.filenameExtras = filenameExtras0
+        if sequence.restore and state != initialState:
+            printMsg('Returning shutters to initial state')
+            sequence._setShutters(state, _restoreState(initialState, commanded), commanded)
+        if sequence.entries[0].tag:
+            printMsg('Finished %s acquisition' % (sequence.entries[0].tag))
+
+    def run(self):
+        """Move to the start, then fly to the end while capturing; return the frame table."""
+        functionName = 'FlyScan.run'
+        pv = self.pv
+        if not len(self.positions):
+            self.table = np.empty((0, 3))
+            return self.table
+        steps = np.diff(self.positions)
+        if len(self.positions) < 2 or not (np.all(steps > 0) or np.all(steps < 0)):
+            raise ValueError('FlyScan: %s positions must be monotonic, with at least 2 points' % (pv.pvname))
+        framePeriod = self._framePeriod() if self.grabObject else pv.settletime
+        if not framePeriod:
+            raise ValueError('FlyScan: camera frame period is 0')
+        velo0 = pv.velo.get()
+        velo = self.velocity(framePeriod)
+        printMsg('Setting %s to fly scan start %f' % (pv.pvname, self.positions[0]))
+        pv.move(self.positions[0])
+        self._rbv = [(pv.rbv.timestamp, pv.rbv.get())]
+        self._frames = []
+        self._captureStart = None
+        self._grabError = None
+        grabThread = None
+        shutterStates = self._setShutters()
+        rbvIndex = pv.rbv.add_callback(self._onRbv)
+        if self.grabObject:
+            counterIndex = self.grabObject.arrayCounterRBVPv.add_callback(self._onArrayCounter)
+            captureIndex = self.grabObject.captureRBVPv.add_callback(self._onCapture)
+        try:
+            pv.velo.put(velo, wait=True)
+            if self.grabObject:
+                # Frames before this point are not captured
+                frameCount0 = len(self._frames)
+                grabThread = Thread(target=self._grab, args=(len(self.positions),))
+                grabThread.start()
+                # Start moving once capturing
+                for i in range(50):
+                    if self._captureStart is not None or self._grabError or not grabThread.is_alive():
+                        break
+                    sleep(0.1)
+                if self._grabError:
+                    raise self._grabError
+                if self._captureStart is None:
+                    printMsg('WARNING: fly scan: capture has not started, flying anyway')
+            printMsg('Flying %s to %f at %f/s' % (pv.pvname, self.positions[-1], velo))
+            pv.move(self.positions[-1])
+        finally:
+            if grabThread:
+                grabThread.join()
+            pv.rbv.remove_callback(rbvIndex)
+            if self.grabObject:
+                self.grabObject.arrayCounterRBVPv.remove_callback(counterIndex)
+                self.grabObject.captureRBVPv.remove_callback(captureIndex)
+            pv.velo.put(velo0, wait=True)
+            self._restoreShutters(shutterStates)
+        if self._grabError:
+            raise self._grabError
+        if self.grabObject:
+            self.table = self._interpolate(frameCount0, self._captureStart, len(self.positions))
+        else:
+            self.table = self._interpolate()
+        logging.info('%s: %d RBV events, %d frames' % (functionName, len(self._rbv), len(self.table)))
+        self._write()
+        return self.table
+
+    def _interpolate(self, frameCount0=0, captureStart=None, nFrames=None):
+        """Interpolate RBV at the frame timestamps.  Only the first nFrames frame events 
+           after frameCount0 (events seen before capture was started) and captureStart 
+           (timestamp) are kept."""
+        frames = np.array(self._frames[frameCount0:], dtype=float).reshape(-1, 2)
+        if captureStart is not None:
+            frames = frames[frames[:, 0] >= captureStart]
+        if nFrames is not None:
+            frames = frames[:nFrames]
+        rbv = np.array(sorted(self._rbv), dtype=float).reshape(-1, 2)
+        positions = np.interp(frames[:, 0], rbv[:, 0], rbv[:, 1]) if len(rbv) else np.nan*frames[:, 0]
+        return np.column_stack((frames[:, 1], frames[:, 0], positions))
+
+    def _write(self):
+        """Append the frame table to the flyscan file."""
+        if not self.filename:
+            return
+        with open(self.filename, 'a') as outfile:
+            outfile.write('# %s %s\n' % (self.pv.pvname, self.filenameExtras))
+            outfile.write('# ArrayCounter Timestamp Position\n')
+            np.savetxt(outfile, self.table, fmt=('%d', '%.6f', '%.6f'))
+
+
+class AdaptiveScan():
+    """Adaptive 1-D scan.  The scan positions are used as a coarse grid; after a 
+       figure of merit has been measured at each of them, a point is inserted at the
+       midpoint of the interval where the figure of merit changes most, until 
+       ADAPTIVE:NPOINTS steps are done (default: only the coarse grid).  Every point goes through the usual move, 
+       settle and acquisition.  The figure of merit is the value of the PV named 
+       in ADAPTIVE:FOMPV after each step, or else the first ROI sum of the image 
+       reducer for the step's ADAPTIVE:FOMTAG acquisition (default: PumpProbe, or 
+       the only acquisition of the sequence).  Intervals are not split below 1/16 
+       of the coarse spacing, nor split again when their midpoint gave no figure 
+       of merit.  Positions and figures of merit are written to adaptive-<desc>-NOW.dat."""
+    minFraction = 1/16.0
+
+    def __init__(self, exp, pv, grabObject=None, shutters=(None, None, None), scanCorr=None):
+        self.exp = exp
+        self.pv = pv
+        self.grabObject = grabObject
+        self.shutters = shutters
+        self.scanCorr = scanCorr
+        self.nPoints = pv.adaptiveNPoints
+        fomPvname = getOptional(pvPrefix + ':SCANPV' + str(pv.pvnumber) + ':ADAPTIVE:FOMPV', '')
+        self.fomPv = getPV(fomPvname) if fomPvname else None
+        self.reducer = getattr(grabObject, 'reducer', None) if grabObject and grabObject.grabFlag else None
+        if self.fomPv is None and self.reducer is None:
+            raise ValueError('adaptive scan needs ADAPTIVE:FOMPV or image reduction enabled')
+        self.fomTag = getOptional(pvPrefix + ':SCANPV' + str(pv.pvnumber) + ':ADAPTIVE:FOMTAG', '', as_string=True)
+        if not self.fomTag:
+            tags = [entry.tag for entry in exp.acqSequence.entries] if exp.acqSequence else []
+            self.fomTag = 'PumpProbe' if 'PumpProbe' in tags or len(tags) != 1 else tags[0]
+        if exp.acqFixed or exp.acqSequence is None:
+            self.fomTag = None  # Untagged acquisition
+        self.filename = (exp.filepath + 'adaptive-' + pv.desc + '-' + NOW + '.dat' 
+                if exp.filepath and os.path.isdir(exp.filepath) else None)
+        self.points = []  # (position, figure of merit), in scan order
+        self.minStep = 0.0
+
+    def figureOfMerit(self, stepCount):
+        """Figure of merit of step stepCount, or None if it wasn't measured."""
+        if self.fomPv is not None:
+            return self.fomPv.get()
+        result = self.reducer.results.get((str(stepCount), self.fomTag or '-'))
+        if result is None or not len(result):
+            logging.warning('AdaptiveScan: no %s result for step %d' % (self.fomTag or 'untagged', stepCount))
+            return None
+        return float(result[0])
+
+    def measure(self, x):
+        """Do one scan step at x and record its figure of merit."""
+        stepCount = len(self.points) + 1
+        if self.scanCorr:
+            self.scanCorr.set(x)
+        printMsg('Setting %s to %f' % (self.pv.pvname, x))
+        self.pv.move(x)
+        self.pv.stepCountPv.put(stepCount)
+        self.pv.settle()
+        _scanStep(self.exp, self.grabObject, [self.pv], [stepCount], self.shutters)
+        fom = self.figureOfMerit(stepCount)
+        printMsg('Step %d: %s = %f, figure of merit: %s' % (stepCount, self.pv.pvname, x, fom))
+        self.points.append((x, fom))
+        if self.filename:
+            with open(self.filename, 'a') as outfile:
+                outfile.write('%d %f %s\n' % (stepCount, x, fom))
+        stepTimer.endStep(stepCount)
+        return fom
+
+    def nextPoint(self):
+        """Midpoint of the interval with the largest change in figure of merit, or None.
+           Intervals with a point already measured inside (whose figure of merit 
+           was None) are skipped."""
+        points = sorted([point for point in self.points if point[1] is not None])
+        if len(points) < 2:
+            return None
+        xs, foms = np.array(points, dtype=float).T
+        scores = np.abs(np.diff(foms))
+        scores[np.diff(xs) < max(self.minStep, 1e-12)] = -1
+        measured = np.sort([point[0] for point in self.points])
+        inside = np.searchsorted(measured, xs[1:], 'left') - np.searchsorted(measured, xs[:-1], 'right')
+        scores[inside > 0] = -1
+        i = np.argmax(scores)
+        if scores[i] <= 0:
+            return None
+        return 0.5*(xs[i] + xs[i+1])
+
+    def run(self, positions):
+        """Scan the coarse grid, then refine; return the list of (position, figure of merit)."""
+        positions = [float(x) for x in positions]
+        nPoints = max(self.nPoints or 0, len(positions))
+        if len(positions) > 1:
+            self.minStep = self.minFraction*np.median(np.abs(np.diff(sorted(positions))))
+        printMsg('Adaptive scan of %s: %d coarse points, %d points total' 
+                % (self.pv.pvname, len(positions), nPoints))
+        for x in positions:
+            self.measure(x)
+        while len(self.points) < nPoints:
+            x = self.nextPoint()
+            if x is None:
+                printMsg('Adaptive scan: no interval left to refine')
+                break
+            self.measure(x)
+        return self.points
+
+
 def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
-    """Do 0-, 1-, or 2-D scan and grab images at each step (or do nothing and bail)."""
+    """Do 0-, 1-, or 2-D scan and grab images at each step (or do nothing and bail).
+       If the scan fails, user scripts still running are killed."""
+    try:
+        return _pvNDScan(exp, scanpvs, grabObject, shutters)
+    except BaseException:
+        runner = getattr(exp, 'userScript', None)
+        if runner:
+            runner.kill()
+        raise
+
+def _pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
+    """pvNDScan, without the cleanup on failure."""
     functionName = 'pvNDScan'
     logging.debug('%s: %s' %(functionName, scanpvs))
     if scanpvs is None:
@@ -1256,6 +2933,7 @@ def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
             pv2 = scanpvs[1]
         else:
             raise ValueError('pvNDScan: Need one or two PVs.')
+    shutter1 = shutter2 = shutter3 = None
     if shutters is not None:
         shutter1 = shutters[0] if len(shutters) >= 1 else None
         shutter2 = shutters[1] if len(shutters) >= 2 else None
@@ -1272,8 +2950,57 @@ def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
             initialPos2 = pv2.get()
         elif exp.scanmode == 2 and not pv2:
             print('***WARNING***: pvNDScan: Scan mode 2-D selected but no PV #2.')
+        initialCoupled = [pv.get() for pv, expression in exp.coupledAxes]
+        scan2D = exp.scanmode == 2 and pv2
+        # Resume from checkpoint if enabled from PV
+        lastStep = (0, 0)
+        checkpoint = exp.checkpoint
+        if checkpoint and exp.resumeFlag and checkpoint.load():
+            state = checkpoint.state
+            if state['pvnames'] != [pv.pvname for pv in (pv1, pv2) if pv][:2 if scan2D else 1]:
+                msg = 'Failed: checkpoint is for PVs %s' % (', '.join(state['pvnames']))
+                printMsg(msg)
+                raise ValueError(msg)
+            pv1.scanPos = state['scanPos1']
+            if scan2D:
+                pv2.scanPos = state['scanPos2']
+            lastStep = (state['step1'], state['step2'])
+            printMsg('Resuming scan after step %s (%s)' % (lastStep if scan2D else lastStep[0], 
+                    state['filenameExtras']))
         # Do pre-scan if enabled from PV
-        if exp.preScanflag: preScan(exp, pv1, grabObject)
+        elif exp.preScanflag: preScan(exp, pv1, grabObject)
+        nSteps2 = len(pv2.scanPos) if scan2D else 0
+        if exp.scanCorFlag:
+            scanCorr1.precompute(pv1.scanPos)
+        # Build the whole trajectory, check it and estimate the duration before the first move
+        trajectory = Trajectory.fromScanPvs(pv1, pv2 if scan2D else None)
+        startRow = max(0, (lastStep[0] - 1)*nSteps2 + lastStep[1]) if scan2D else lastStep[0]
+        try:
+            for i, (pv, expression) in enumerate(exp.coupledAxes, 1):
+                trajectory.addCoupledAxis('c%d' % (i), expression, pv)
+            preflight(exp, trajectory, pv1, pv2 if scan2D else None, grabObject, startRow)
+            # Fly scan the inner axis (PV #1 for 1-D, PV #2 for 2-D) if enabled from PV
+            flyPv = pv2 if scan2D else pv1
+            fly = flyPv.flyFlag and isinstance(flyPv, Motor) and getattr(flyPv, 'velo', None) is not None
+            if flyPv.flyFlag and not fly:
+                printMsg('WARNING: fly scan needs a motor with VELO, stepping %s' % (flyPv.pvname))
+            if fly and (trajectory.coupled or (exp.scanCorFlag and not scan2D)):
+                raise ValueError('fly scan of %s does not support coupled axes or scan correction' 
+                        % (flyPv.pvname))
+            if fly:
+                FlyScan.check(exp, grabObject)
+            # Adaptive refinement of a 1-D scan if enabled from PV
+            adaptive = pv1.adaptiveFlag and not scan2D and not fly
+            if adaptive and (trajectory.coupled or lastStep != (0, 0)):
+                raise ValueError('adaptive scan of %s does not support coupled axes or resuming' 
+                        % (pv1.pvname))
+            if adaptive:
+                adaptiveScan = AdaptiveScan(exp, pv1, grabObject, [shutter1, shutter2, shutter3], 
+                        scanCorr1 if exp.scanCorFlag else None)
+        except ValueError as e:
+            printMsg('Failed: %s' % (e))
+            exp.msgSevrPv.put(2)
+            raise
         # Scan PV #1
         if pv1.scanPosMode:
             printMsg('Scanning {0} over {1} using {2} mode'.format(pv1.pvname, 
@@ -1281,94 +3008,81 @@ def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
         else:
             printMsg('Scanning %s from %f to %f in %d steps' % 
                     (pv1.pvname, pv1.start, pv1.stop, len(pv1.scanPos)))
-        stepCount1 = 0
-        for x in pv1.scanPos:
-            printMsg('Setting %s to %f' % (pv1.pvname, x))
-            pv1.move(x)
-            if exp.scanCorFlag:
-                scanCorr1.set(x)
-            stepCount1 += 1
-            pv1.stepCountPv.put(stepCount1)
-            printSleep(pv1.settletime,'Settling')
-            # Scan PV #2
-            if exp.scanmode == 2 and pv2:
-                if pv1.scanPosMode:
-                    printMsg('Scanning {0} over {1} using {2} mode'.format(pv1.pvname, 
-                            pv1.scanPosString, pv1.scanPosModePv.get(as_string=True)))
-                else:
-                    printMsg('Scanning %s from %f to %f in %d steps' % 
-                            (pv2.pvname, pv2.start, pv2.stop, len(pv2.scanPos)))
-                stepCount2 = 0
-                for y in pv2.scanPos:
-                    printMsg('Setting %s to %f' % (pv2.pvname, y))
-                    pv2.move(y)
-                    stepCount2 += 1
-                    pv2.stepCountPv.put(stepCount2)
-                    printSleep(pv2.settletime, 'Settling')
-                    if exp.runUserScriptFlag:
-                        runUserScript()
-                    if grabObject:
-                        if grabObject.grabFlag:
-                            if grabObject.stepFlag:
-                                grabObject.filenameExtras = ('_{0}_{1:03d}_{2:0{6}.{7}f}_{3}_{4:03d}_{5:0{8}.{9}f}'
-                                        .format(pv1.desc, stepCount1, pv1.get(), pv2.desc, stepCount2,
-                                        pv2.get(), pv1.filenameWidth, pv1.filenamePrec,
-                                        pv2.filenameWidth, pv2.filenamePrec))
-                            else:
-                                grabObject.filenameExtras = ('_{0}_{1:0{4}.{5}f}_{2}_{3:0{6}.{7}f}'
-                                        .format(pv1.desc, pv1.get(), pv2.desc, pv2.get(),
-                                        pv1.filenameWidth, pv1.filenamePrec,
-                                        pv2.filenameWidth, pv2.filenamePrec))
-                            if grabObject.grabSeq2Flag:
-                                pumpedGrabSequence(grabObject, shutter1, shutter2, shutter3)
-                            if exp.acqFixed:
-                                grabObject.grabImages()
-                            else:
-                                if exp.acqPumpProbe:
-                                    acqPumpProbe(exp, grabObject, shutter1, shutter2)
-                                    if exp.acqDelay1 and (exp.acqStatic or exp.acqPumpBG or exp.acqDarkCurrent):
-                                        printSleep(exp.acqDelay1, 'Pausing')
-                                if exp.acqStatic:
-                                    acqStatic(exp, grabObject, shutter1, shutter2)
-                                    if exp.acqDelay2 and (exp.acqPumpBG or exp.acqDarkCurrent):
-                                        printSleep(exp.acqDelay2, 'Pausing')
-                                if exp.acqPumpBG:
-                                    acqPumpBG(exp, grabObject, shutter1, shutter2)    
-                                    if exp.acqDelay3 and exp.acqDarkCurrent:
-                                        printSleep(exp.acqDelay3, 'Pausing')
-                                if exp.acqDarkCurrent:
-                                    acqDarkCurrent(exp, grabObject, shutter1, shutter2)
-            else:
-                if exp.runUserScriptFlag:
-                    runUserScript()
+        if exp.timingFlag:
+            stepTimer.start(exp.filepath, exp.timingWindow)
+        caCounter.inStepLoop = True
+        try:
+            if fly and not scan2D:
                 if grabObject:
-                    if grabObject.grabFlag:
-                        if grabObject.stepFlag:
-                            grabObject.filenameExtras = ('_{0}_{1:03d}_{2:0{3}.{4}f}'
-                                    .format(pv1.desc, stepCount1, pv1.get(),
-                                    pv1.filenameWidth, pv1.filenamePrec))
-                        else:
-                            grabObject.filenameExtras = ('_{0}_{1:0{2}.{3}f}'.format(pv1.desc, pv1.get(),
+                    grabObject.filenameExtras = '_{0}_fly'.format(pv1.desc)
+                    grabObject.scanStep = 'fly'
+                if exp.runUserScriptFlag:
+                    runUserScript(exp, _stepContext(exp, grabObject, [pv1], [], 'fly'))
+                FlyScan(pv1, pv1.scanPos[startRow:], grabObject, exp.filepath, exp.acqSequence).run()
+                pv1.stepCountPv.put(len(pv1.scanPos))
+                if checkpoint:
+                    _saveCheckpoint(checkpoint, grabObject, pv1, None, len(pv1.scanPos), 0)
+                stepTimer.endStep('fly')
+            elif adaptive:
+                adaptiveScan.run(pv1.scanPos)
+            else:
+                for stepCount1, x in enumerate(pv1.scanPos, 1):
+                    if (stepCount1, nSteps2) <= lastStep:
+                        continue
+                    # Set scan correction first, so the correction PVs move along with PV #1
+                    if exp.scanCorFlag:
+                        scanCorr1.set(x)
+                    printMsg('Setting %s to %f' % (pv1.pvname, x))
+                    pv1.move(x)
+                    pv1.stepCountPv.put(stepCount1)
+                    if not scan2D:
+                        trajectory.moveCoupled(stepCount1 - 1)
+                    pv1.settle()
+                    # Fly scan PV #2
+                    if scan2D and fly:
+                        if grabObject:
+                            grabObject.filenameExtras = ('_{0}_{1:03d}_{2:0{4}.{5}f}_{3}_fly'
+                                    .format(pv1.desc, stepCount1, pv1.get(), pv2.desc, 
                                     pv1.filenameWidth, pv1.filenamePrec))
-                        if grabObject.grabSeq2Flag:
-                            pumpedGrabSequence(grabObject, shutter1, shutter2, shutter3)
-                        if exp.acqFixed:
-                            grabObject.grabImages()
+                            grabObject.scanStep = '%d:fly' % (stepCount1)
+                        if exp.runUserScriptFlag:
+                            runUserScript(exp, _stepContext(exp, grabObject, [pv1], [stepCount1], 
+                                    '%d:fly' % (stepCount1)))
+                        FlyScan(pv2, pv2.scanPos[lastStep[1] if stepCount1 == lastStep[0] else 0:], 
+                                grabObject, exp.filepath, exp.acqSequence).run()
+                        pv2.stepCountPv.put(nSteps2)
+                        if checkpoint:
+                            _saveCheckpoint(checkpoint, grabObject, pv1, pv2, stepCount1, nSteps2)
+                        stepTimer.endStep('%d:fly' % (stepCount1))
+                    # Scan PV #2
+                    elif scan2D:
+                        if pv1.scanPosMode:
+                            printMsg('Scanning {0} over {1} using {2} mode'.format(pv1.pvname, 
+                                    pv1.scanPosString, pv1.scanPosModePv.get(as_string=True)))
                         else:
-                            if exp.acqPumpProbe:
-                                acqPumpProbe(exp, grabObject, shutter1, shutter2)
-                                if exp.acqDelay1 and (exp.acqStatic or exp.acqPumpBG or exp.acqDarkCurrent):
-                                    printSleep(exp.acqDelay1, 'Pausing')
-                            if exp.acqStatic:
-                                acqStatic(exp, grabObject, shutter1, shutter2)
-                                if exp.acqDelay2 and (exp.acqPumpBG or exp.acqDarkCurrent):
-                                    printSleep(exp.acqDelay2, 'Pausing')
-                            if exp.acqPumpBG:
-                                acqPumpBG(exp, grabObject, shutter1, shutter2)    
-                                if exp.acqDelay3 and exp.acqDarkCurrent:
-                                    printSleep(exp.acqDelay3, 'Pausing')
-                            if exp.acqDarkCurrent:
-                                acqDarkCurrent(exp, grabObject, shutter1, shutter2)
+                            printMsg('Scanning %s from %f to %f in %d steps' % 
+                                    (pv2.pvname, pv2.start, pv2.stop, len(pv2.scanPos)))
+                        for stepCount2, y in enumerate(pv2.scanPos, 1):
+                            if (stepCount1, stepCount2) <= lastStep:
+                                continue
+                            printMsg('Setting %s to %f' % (pv2.pvname, y))
+                            pv2.move(y)
+                            pv2.stepCountPv.put(stepCount2)
+                            trajectory.moveCoupled((stepCount1 - 1)*nSteps2 + stepCount2 - 1)
+                            pv2.settle()
+                            _scanStep(exp, grabObject, [pv1, pv2], [stepCount1, stepCount2], 
+                                    [shutter1, shutter2, shutter3])
+                            if checkpoint:
+                                _saveCheckpoint(checkpoint, grabObject, pv1, pv2, stepCount1, stepCount2)
+                            stepTimer.endStep('%d:%d' % (stepCount1, stepCount2))
+                    else:
+                        _scanStep(exp, grabObject, [pv1], [stepCount1], [shutter1, shutter2, shutter3])
+                        if checkpoint:
+                            _saveCheckpoint(checkpoint, grabObject, pv1, None, stepCount1, 0)
+                        stepTimer.endStep(stepCount1)
+        finally:
+            caCounter.inStepLoop = False
+            stepTimer.stop()
         # Stop acquisition (if enabled)
         if grabObject:
             if grabObject.stopAcquisitionFlag:
@@ -1382,9 +3096,12 @@ def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
         if exp.scanmode == 2 and pv2:
             printMsg('Setting %s back to initial position: %f' % (pv2.pvname, initialPos2))
             pv2.move(initialPos2)
+        for (pv, expression), initialPos in zip(exp.coupledAxes, initialCoupled):
+            printMsg('Setting %s back to initial position: %f' % (pv.pvname, initialPos))
+            pv.move(initialPos)
     elif exp.scanmode == 3:  # Grab images only
         if exp.runUserScriptFlag:
-            runUserScript()
+            runUserScript(exp, _stepContext(exp, grabObject, [], [], '0'))
         if grabObject:
             if grabObject.grabFlag:
                 if grabObject.grabSeq2Flag:
@@ -1398,172 +3115,422 @@ def pvNDScan(exp, scanpvs=None, grabObject=None, shutters=None):
     else:
         printMsg('Scan mode "None" selected or no PVs entered, continuing...')
         sleep(1)
+    if exp.userScript:
+        exp.userScript.wait()
+    if 1 <= exp.scanmode <= 2 and pv1:
+        _logSettleTimes(exp, [pv for pv in (pv1, pv2) if pv])
+    if caCounter.enabled:
+        caCounter.report(exp.filepath)
+        # Counting enabled from CACOUNT:ENABLE lasts for one scan
+        if exp.caCountMode and not os.environ.get('PVSCAN_CACOUNT'):
+            caCounter.disable()
+    logging.info('pvNDScan: channel pool: %s' % (channelPool))
     return 0
+
+def _logSettleTimes(exp, pvs):
+    """Print settle time statistics per PV and save the settle times to settle-NOW.dat,
+       for tuning SETTLETIME and the adaptive settle parameters."""
+    lines = []
+    for pv in pvs:
+        if not pv.settleTimes:
+            continue
+        times = np.array(pv.settleTimes)
+        printMsg('Settle times for %s: mean %.3f s, max %.3f s (%d steps)' 
+                % (pv.pvname, times.mean(), times.max(), len(times)))
+        lines.append('%s %s\n' % (pv.pvname, ' '.join(['%.3f' % (x) for x in times])))
+        pv.settleTimes = []
+    if lines and exp.filepath and os.path.isdir(exp.filepath):
+        with open(exp.filepath + 'settle-' + NOW + '.dat', 'a') as outfile:
+            outfile.writelines(lines)
    
+def _filenameExtras(grabObject, pvs, stepCounts):
+    """Filename extras for a scan step: description, step number (if enabled) and 
+       position of each scan PV."""
+    extras = ''
+    for pv, stepCount in zip(pvs, stepCounts):
+        if grabObject.stepFlag:
+            extras += ('_{0}_{1:03d}_{2:0{3}.{4}f}'.format(pv.desc, stepCount, pv.get(), 
+                    pv.filenameWidth, pv.filenamePrec))
+        else:
+            extras += '_{0}_{1:0{2}.{3}f}'.format(pv.desc, pv.get(), pv.filenameWidth, pv.filenamePrec)
+    return extras
+
+def _scanStep(exp, grabObject, pvs, stepCounts, shutters):
+    """Scan step after the moves: run the user script (if enabled) and acquire images."""
+    grab = grabObject and grabObject.grabFlag
+    if grab:
+        grabObject.filenameExtras = _filenameExtras(grabObject, pvs, stepCounts)
+        grabObject.scanStep = ':'.join([str(n) for n in stepCounts])
+    if exp.runUserScriptFlag:
+        runUserScript(exp, _stepContext(exp, grabObject if grab else None, pvs, stepCounts))
+    if grab:
+        acqStep(exp, grabObject, *shutters)
+
+def _saveCheckpoint(checkpoint, grabObject, pv1, pv2, stepCount1, stepCount2):
+    """Save scan position after a completed step."""
+    checkpoint.save(pvnames=[pv.pvname for pv in (pv1, pv2) if pv],
+            scanPos1=[float(x) for x in pv1.scanPos],
+            scanPos2=[float(x) for x in pv2.scanPos] if pv2 else [],
+            step1=stepCount1, step2=stepCount2,
+            stepCounts=[stepCount1, stepCount2] if pv2 else [stepCount1],
+            filenameExtras=grabObject.filenameExtras if grabObject else '')
+
+
+def acqStep(exp, grabObject, shutter1=None, shutter2=None, shutter3=None):
+    """Do the image acquisitions for one scan step, using the experiment's acquisition sequence."""
+    if grabObject.grabSeq2Flag:
+        pumpedGrabSequence(grabObject, shutter1, shutter2, shutter3)
+    if exp.acqFixed or exp.acqSequence is None:
+        grabObject.grabImages()
+        return
+    exp.acqSequence.run(grabObject, exp.bgCache)
+
+
+class BackgroundCache():
+    """Cache of dark-current and pump-background reference frames, so that they
+       need not be grabbed at every scan step.
+       
+       A reference (tag 'DarkCurrent' or 'PumpBG') is due to be grabbed when:
+         - there is no reference yet, or
+         - NSTEPS scan steps have passed since it was last grabbed (if NSTEPS > 0), or
+         - INTERVAL seconds have passed since it was last grabbed (if INTERVAL > 0), or
+         - the camera settings (exposure, gain, image size) have changed.
+       If NSTEPS and INTERVAL are both 0, references are grabbed at every step.
+       Each grab is folded into a running mean of all frames grabbed since the last 
+       camera settings change; a settings change discards the mean.  Every refresh 
+       gets a new reference ID, and the mean is saved as bgref-<tag>-<ID>.npy.  The 
+       reference IDs used for each PumpProbe grab are recorded once the step's 
+       sequence (including any refreshes) has run.  The camera settings PVs are 
+       connected once per scan and monitored, so checking them costs no round trips."""
+    def __init__(self, filepath=None, nSteps=None, interval=None):
+        if nSteps is None:
+            nSteps = getOptional(pvPrefix + ':ACQ:BGCACHE:NSTEPS')
+        if interval is None:
+            interval = getOptional(pvPrefix + ':ACQ:BGCACHE:INTERVAL')
+        self.filepath = filepath
+        self.nSteps = nSteps or 0
+        self.interval = interval or 0
+        self.step = 0
+        self.refs = {}
+        self.settingsPvs = None
+
+    def _settings(self, grabObject):
+        """Return camera settings that invalidate a reference when they change."""
+        if self.settingsPvs is None:
+            prefix = grabObject.cameraPvPrefix + ':cam1:'
+            self.settingsPvs = [getPV(prefix + name, auto_monitor=True) for name in 
+                    ('AcquireTime_RBV', 'Gain_RBV', 'ArraySizeX_RBV', 'ArraySizeY_RBV')]
+        return tuple([pv.get() for pv in self.settingsPvs])
+
+    def nextStep(self):
+        """Call once at the start of every scan step."""
+        self.step += 1
+
+    def due(self, tag, grabObject):
+        """Return True if reference frames for tag need to be grabbed this step."""
+        ref = self.refs.get(tag)
+        if ref is None:
+            return True
+        if not self.nSteps and not self.interval:
+            return True
+        if self._settings(grabObject) != ref['settings']:
+            logging.info('BackgroundCache: %s: camera settings changed' % (tag))
+            ref['mean'] = None
+            ref['n'] = 0
+            return True
+        if self.nSteps and self.step - ref['step'] >= self.nSteps:
+            return True
+        if self.interval and time() - ref['time'] >= self.interval:
+            return True
+        printMsg('Using cached %s reference %d' % (tag, ref['id']))
+        return False
+
+    def update(self, tag, grabObject):
+        """Fold the frames just grabbed into the running mean for tag."""
+        ref = self.refs.setdefault(tag, {'id': 0, 'mean': None, 'n': 0})
+        settings = self._settings(grabObject)
+        frames = grabObject.lastFrames if hasattr(grabObject, 'lastFrames') else None
+        if frames is not None and len(frames):
+            frameSum = np.asarray(frames, dtype=np.float64).sum(axis=0)
+            if ref['mean'] is None or ref['mean'].shape != frameSum.shape or ref.get('settings') != settings:
+                ref['mean'] = frameSum/len(frames)
+                ref['n'] = len(frames)
+            else:
+                ref['mean'] = (ref['mean']*ref['n'] + frameSum)/(ref['n'] + len(frames))
+                ref['n'] += len(frames)
+        ref['id'] += 1
+        ref['step'] = self.step
+        ref['time'] = time()
+        ref['settings'] = settings
+        if self.filepath and ref['mean'] is not None:
+            np.save('%sbgref-%s-%03d.npy' % (self.filepath, tag, ref['id']), ref['mean'])
+        logging.debug('BackgroundCache: %s reference %d, %d frames' % (tag, ref['id'], ref['n']))
+
+    def attach(self, filenameExtras):
+        """Record the current reference IDs for a PumpProbe grab."""
+        if not self.filepath:
+            return
+        with open(self.filepath + 'bgref-' + NOW + '.txt', 'a') as outfile:
+            outfile.write('%s PumpProbe%s %s\n' % (self.step, filenameExtras, ' '.join(['%s=%03d' 
+                    % (tag, ref['id']) for tag, ref in sorted(self.refs.items())]) or '-'))
+
+
 def pumpedGrabSequence(grabObject, shutter1, shutter2, shutter3):
     """Do a pumped/static image grab sequence."""
-    debug = 0
     printMsg('Starting pumped image sequence')
     sleep(0.25)
-    shutter1Stat = shutter1.OCStatus.get()
-    shutter2Stat = shutter2.OCStatus.get()
-    shutter3Stat = shutter3.OCStatus.get()
-    if debug: 
-        print('shutter stats: %s, %s, %s' 
-                % (shutter1.OCStatus.get(), shutter2.OCStatus.get(), shutter3.OCStatus.get()))
-    printMsg('Opening shutters 1, 2 and 3')
-    shutter1.open.put(1)
-    shutter2.open.put(1)
-    shutter3.open.put(1)
-    sleep(0.25)
-    if debug: 
-        print('shutter stats: %s, %s, %s'
-                % (shutter1.OCStatus.get(), shutter2.OCStatus.get(), shutter3.OCStatus.get()))
-    if debug: print(grabObject.filenameExtras)
     if 'Static' in grabObject.filenameExtras:
         grabObject.filenameExtras = grabObject.filenameExtras.replace('Static', 'Pumped')
     else:
         grabObject.filenameExtras = '_' + 'Pumped' + grabObject.filenameExtras
-    if debug: print(grabObject.filenameExtras)
-    grabObject.grabImages(grabObject.nImages2)
-    printMsg('Returning shutters to initial state')
-    shutter1.open.put(1) if shutter1Stat == 1 else shutter1.close.put(0)
-    shutter2.open.put(1) if shutter2Stat == 1 else shutter2.close.put(0)
-    shutter3.open.put(1) if shutter3Stat == 1 else shutter3.close.put(0)
-    sleep(0.25)
-    if debug: 
-        print('shutter stats: %s, %s, %s' 
-                % (shutter1.OCStatus.get(), shutter2.OCStatus.get(), shutter3.OCStatus.get()))
-    if debug: print(grabObject.filenameExtras)
+    _pumpedSequence(grabObject.nImages2, [shutter1, shutter2, shutter3]).run(grabObject)
     if 'Pumped' in grabObject.filenameExtras:
         grabObject.filenameExtras = grabObject.filenameExtras.replace('Pumped', 'Static')
     else:
         grabObject.filenameExtras = '_' + 'Static'
-    if debug: print(grabObject.filenameExtras)
     printMsg('Finished pumped image sequence')
     printSleep(grabObject.grabSeq2Delay)
 
 
+def _pumpedSequence(nImages, shutters):
+    """Acquisition sequence of pumpedGrabSequence: nImages with all shutters open."""
+    return AcqSequence([AcqEntry((1, 1, 1), None, nImages, 0)], shutters, restore=True, settleTime=0.25)
+
+
 def acqPumpProbe(exp, grabObject, shutter1, shutter2):
     """Do a pump-probe image grab sequence: open both shutters, and return them to
     initial state when finished."""
-    functionName = 'acqPumpProbe'
-    printMsg('Starting pump-probe acquisition')
-    if exp.shutterRestore:
-        shutter1Stat = shutter1.OCStatus.get()
-        shutter2Stat = shutter2.OCStatus.get()
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    printMsg('Opening shutters %s and %s' % (shutter1.number, shutter2.number))
-    shutter1.open.put(1)
-    shutter2.open.put(1)
-    sleep(0.5)
-    if exp.shutterCheck:
-        logging.debug('%s: shutter check' % (functionName))
-        shutter1.openCheck(val=0.5)
-        shutter2.openCheck(val=0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    filenameExtras0 = grabObject.filenameExtras
-    grabObject.filenameExtras = '_' + 'PumpProbe' + grabObject.filenameExtras
-    grabObject.grabImages()    
-    if exp.shutterRestore:
-        printMsg('Returning shutters to initial state')
-        shutter1.open.put(1) if shutter1Stat == 1 else shutter1.close.put(0)
-        shutter2.open.put(1) if shutter2Stat == 1 else shutter2.close.put(0)
-        sleep(0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    grabObject.filenameExtras = filenameExtras0
-    printMsg('Finished pump-probe acquisition')
+    AcqSequence.single('PumpProbe', exp, [shutter1, shutter2]).run(grabObject)
 
 
 def acqStatic(exp, grabObject, shutter1, shutter2):
     """Do a static image grab sequence: open shutter1, close shutter 2, and return them to
     initial state when finished."""
-    functionName = 'acqStatic'
-    printMsg('Starting static acquisition')
-    if exp.shutterRestore:
-        shutter1Stat = shutter1.OCStatus.get()
-        shutter2Stat = shutter2.OCStatus.get()
-    printMsg('Opening shutter %s, closing shutter %s' % (shutter1.number, shutter2.number))
-    shutter1.open.put(1)
-    shutter2.close.put(0)
-    sleep(0.5)
-    if exp.shutterCheck:
-        logging.debug('%s: shutter check' % (functionName))
-        shutter1.openCheck(val=0.5)
-        shutter2.closeCheck(val=0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    filenameExtras0 = grabObject.filenameExtras
-    grabObject.filenameExtras = '_' + 'Static' + grabObject.filenameExtras
-    grabObject.grabImages()    
-    if exp.shutterRestore:
-        printMsg('Returning shutters to initial state')
-        shutter1.open.put(1) if shutter1Stat == 1 else shutter1.close.put(0)
-        shutter2.open.put(1) if shutter2Stat == 1 else shutter2.close.put(0)
-        sleep(0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    grabObject.filenameExtras = filenameExtras0
-    printMsg('Finished static acquisition')
+    AcqSequence.single('Static', exp, [shutter1, shutter2]).run(grabObject)
+
 
 def acqPumpBG(exp, grabObject, shutter1, shutter2):
     """Do a pump-background image grab sequence: close shutter1, open shutter 2, and return them to
     initial state when finished."""
-    functionName = 'acqPumpBG'
-    printMsg('Starting pump BG acquisition')
-    if exp.shutterRestore:
-        shutter1Stat = shutter1.OCStatus.get()
-        shutter2Stat = shutter2.OCStatus.get()
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    printMsg('Closing shutter %s, opening shutter %s' % (shutter1.number, shutter2.number))
-    shutter1.close.put(0)
-    shutter2.open.put(1)
-    sleep(0.5)
-    if exp.shutterCheck:
-        logging.debug('%s: shutter check' % (functionName))
-        shutter1.closeCheck(val=0.5)
-        shutter2.openCheck(val=0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    filenameExtras0 = grabObject.filenameExtras
-    grabObject.filenameExtras = '_' + 'PumpBG' + grabObject.filenameExtras
-    grabObject.grabImages()    
-    if exp.shutterRestore:
-        printMsg('Returning shutters to initial state')
-        shutter1.open.put(1) if shutter1Stat == 1 else shutter1.close.put(0)
-        shutter2.open.put(1) if shutter2Stat == 1 else shutter2.close.put(0)
-        sleep(0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    grabObject.filenameExtras = filenameExtras0
-    printMsg('Finished pump BG acquisition')
+    AcqSequence.single('PumpBG', exp, [shutter1, shutter2]).run(grabObject)
 
 
 def acqDarkCurrent(exp, grabObject, shutter1, shutter2):
     """Do a dark-current image grab sequence: close both shutters, and return them to
     initial state when finished."""
-    functionName = 'acqDarkCurrent'
-    printMsg('Starting dark current acquisition')
-    if exp.shutterRestore:
-        shutter1Stat = shutter1.OCStatus.get()
-        shutter2Stat = shutter2.OCStatus.get()
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    printMsg('Closing both shutters')
-    shutter1.close.put(0)
-    shutter2.close.put(0)
-    sleep(0.5)
-    if exp.shutterCheck:
-        logging.debug('%s: shutter check' % (functionName))
-        shutter1.closeCheck(val=0.5)
-        shutter2.closeCheck(val=0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    filenameExtras0 = grabObject.filenameExtras
-    grabObject.filenameExtras = '_' + 'DarkCurrent' + grabObject.filenameExtras
-    grabObject.grabImages()    
-    if exp.shutterRestore:
-        printMsg('Returning shutters to initial state')
-        shutter1.open.put(1) if shutter1Stat == 1 else shutter1.close.put(0)
-        shutter2.open.put(1) if shutter2Stat == 1 else shutter2.close.put(0)
-        sleep(0.5)
-    logging.debug('%s: shutter stats: %s, %s' % (functionName, shutter1.OCStatus.get(), shutter2.OCStatus.get()))
-    grabObject.filenameExtras = filenameExtras0
-    printMsg('Finished dark current acquisition')
+    AcqSequence.single('DarkCurrent', exp, [shutter1, shutter2]).run(grabObject)
+
+
+# Shutter states (shutter1, shutter2) for each acquisition type; 1 = open, 0 = closed
+ACQ_STATES = collections.OrderedDict([('PumpProbe', (1, 1)), ('Static', (1, 0)), 
+        ('PumpBG', (0, 1)), ('DarkCurrent', (0, 0))])
+
+# One acquisition: target shutter states (1 = open, 0 = closed, None = leave as is),
+# filename tag, number of images (0 = grabber default), and pause afterwards [s]
+AcqEntry = collections.namedtuple('AcqEntry', ['state', 'tag', 'nImages', 'delay'])
+
+
+class AcqSequence():
+    """Table-driven acquisition sequence: a list of AcqEntry, run at every scan step.
+       All shutters an entry sets are put for the first entry of each step; after 
+       that, puts are only skipped for shutters already commanded to the same state 
+       earlier in the step (all puts first, then a single settle pause), states are optionally verified against the shutter RBVs, and 
+       the initial shutter states are restored once at the end if restore is set.
+       If optimize is set, the entries are reordered to minimize shutter transitions.
+
+       A sequence can be read from a file or a PV, one entry per line (or separated 
+       by semicolons), '#' for comments:
+           tag state [nImages [delay]]
+       where state is one character per shutter: 1 (open), 0 (closed), x (leave as is),
+       e.g. 'PumpProbe 11 0 0.5'."""
+    def __init__(self, entries, shutters, restore=False, check=False, optimize=False, settleTime=0.5):
+        self.entries = list(entries)
+        self.shutters = shutters
+        self.restore = restore
+        self.check = check
+        self.optimize = optimize
+        self.settleTime = settleTime
+
+    @classmethod
+    def single(cls, tag, exp, shutters):
+        """Sequence with one standard acquisition (PumpProbe, Static, PumpBG or DarkCurrent)."""
+        return cls([AcqEntry(ACQ_STATES[tag], tag, 0, 0)], shutters, 
+                restore=exp.shutterRestore, check=exp.shutterCheck)
+
+    @classmethod
+    def fromExperiment(cls, exp, shutters):
+        """Sequence from the ACQ PVs, or from ACQ:SEQUENCE:FILE or ACQ:SEQUENCE:TABLE if set."""
+        filename = getOptional(pvPrefix + ':ACQ:SEQUENCE:FILE', '', as_string=True)
+        table = getOptional(pvPrefix + ':ACQ:SEQUENCE:TABLE', '', as_string=True)
+        if filename:
+            with open(filename, 'r') as fh:
+                entries = parseAcqTable(fh.read())
+        elif table:
+            entries = parseAcqTable(table)
+        else:
+            flags = (exp.acqPumpProbe, exp.acqStatic, exp.acqPumpBG, exp.acqDarkCurrent)
+            delays = (exp.acqDelay1, exp.acqDelay2, exp.acqDelay3, 0)
+            entries = [AcqEntry(ACQ_STATES[tag], tag, 0, delay) for tag, flag, delay 
+                    in zip(ACQ_STATES, flags, delays) if flag]
+        for entry in entries:
+            if len(entry.state) > len(shutters):
+                msg = 'Shutter Error: acquisition %s needs %d shutters' % (entry.tag, len(entry.state))
+                msgPv.put(msg)
+                raise ShutterError(msg)
+        return cls(entries, shutters, restore=exp.shutterRestore, check=exp.shutterCheck,
+                optimize=exp.acqOptimize)
+
+    def estimate(self, nImages, framePeriod, pause=GRAB_PAUSE):
+        """Estimated time (s) to run all entries once: per entry, the shutter settling, 
+           the grab (entries without nImages use nImages) and the pause after it, and 
+           the delay before the next entry; plus the settling when the shutters are 
+           restored (after every entry, or once at the end if optimized)."""
+        if not self.entries:
+            return 0.0
+        duration = sum([self.settleTime + (entry.nImages or nImages)*framePeriod + pause + entry.delay 
+                for entry in self.entries]) - self.entries[-1].delay
+        if self.restore:
+            duration += self.settleTime*(1 if self.optimize else len(self.entries))
+        return duration
+
+    @stepTimer.timed('shutters')
+    def _setShutters(self, state, newState, commanded):
+        """Move shutters to newState, skipping those in commanded (indices of shutters 
+           set earlier in this step) that are already there; pause once if any moved.  
+           Adds the shutters put to commanded."""
+        newState = _resolveState(state, newState)
+        moved = []
+        for i, (shutter, val0, val) in enumerate(zip(self.shutters, state, newState)):
+            if val is not None and (val != val0 or i not in commanded):
+                moved.append((shutter, val))
+                commanded.add(i)
+        for shutter, val in moved:
+            shutter.open.put(1) if val else shutter.close.put(0)
+        if moved:
+            sleep(self.settleTime)
+        return newState
+
+    @stepTimer.timed('shutters')
+    def _checkShutters(self, entry):
+        """Verify shutter states from RBVs."""
+        for shutter, val in zip(self.shutters, entry.state):
+            if val is not None:
+                shutter.openCheck(val=0.5) if val else shutter.closeCheck(val=0.5)
+
+    def run(self, grabObject, bgCache=None):
+        """Run all entries once."""
+        functionName = 'AcqSequence.run'
+        entries = self.entries
+        if bgCache:
+            bgCache.nextStep()
+            entries = [entry for entry in entries if entry.tag not in ('PumpBG', 'DarkCurrent') 
+                    or bgCache.due(entry.tag, grabObject)]
+        initialState = tuple([shutterState(shutter) for shutter in self.shutters])
+        if self.optimize:
+            entries, nTransitions, nTransitionsFixed = planAcqSequence(entries, initialState, self.restore)
+            printMsg('Acquisition order: %s (%d shutter transitions, %d saved)' 
+                    % (', '.join([str(entry.tag) for entry in entries]), 
+                    nTransitions, nTransitionsFixed - nTransitions))
+        state = initialState
+        commanded = set()  # Shutters set during this step; only their states are known
+        pumpProbeExtras = []
+        for i, entry in enumerate(entries):
+            if entry.tag:
+                printMsg('Starting %s acquisition' % (entry.tag))
+            state = self._setShutters(state, entry.state, commanded)
+            logging.debug('%s: shutter states: %s' % (functionName, state))
+            if self.check:
+                logging.debug('%s: shutter check' % (functionName))
+                self._checkShutters(entry)
+            filenameExtras0 = grabObject.filenameExtras
+            if entry.tag:
+                grabObject.filenameExtras = '_' + entry.tag + grabObject.filenameExtras
+            grabObject.acqTag = entry.tag
+            grabObject.grabImages(entry.nImages)
+            grabObject.acqTag = None
+            grabObject.filenameExtras = filenameExtras0
+            if bgCache:
+                if entry.tag == 'PumpProbe':
+                    pumpProbeExtras.append(grabObject.filenameExtras)
+                elif entry.tag in ('PumpBG', 'DarkCurrent'):
+                    bgCache.update(entry.tag, grabObject)
+            # Without optimization, restore after each entry, like the old acq* functions
+            if self.restore and not self.optimize and state != initialState:
+                printMsg('Returning shutters to initial state')
+                state = self._setShutters(state, _restoreState(initialState, commanded), commanded)
+            if entry.tag:
+                printMsg('Finished %s acquisition' % (entry.tag))
+            if entry.delay and i < len(entries) - 1:
+                printSleep(entry.delay, 'Pausing')
+        if self.restore and state != initialState:
+            printMsg('Returning shutters to initial state')
+            self._setShutters(state, _restoreState(initialState, commanded), commanded)
+        # Record references after the whole sequence, so this step's refreshes are included
+        for filenameExtras in pumpProbeExtras:
+            bgCache.attach(filenameExtras)
+
+
+def parseAcqTable(strng):
+    """Parse an acquisition sequence table (see AcqSequence) into a list of AcqEntry."""
+    entries = []
+    for line in re.split(r'[;\n]', strng):
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        if len(fields) < 2 or not re.match(r'^[01xX]+$', fields[1]):
+            raise ValueError('parseAcqTable: invalid entry: %s' % (line))
+        state = tuple([None if c in 'xX' else int(c) for c in fields[1]])
+        nImages = int(fields[2]) if len(fields) > 2 else 0
+        delay = float(fields[3]) if len(fields) > 3 else 0
+        entries.append(AcqEntry(state, fields[0], nImages, delay))
+    return entries
+
+
+def shutterState(shutter):
+    """Return 1 if shutter is open, 0 if closed."""
+    return 1 if shutter.OCStatus.get() == 1 else 0
+
+
+def _resolveState(state, newState):
+    """Apply newState (None = leave as is) to state."""
+    newState = tuple(newState) + (None,)*(len(state) - len(newState))
+    return tuple([val0 if val is None else val for val0, val in zip(state, newState)])
+
+
+def _restoreState(initialState, commanded):
+    """Target state to restore the shutters in commanded (indices) to initialState."""
+    return tuple([val if i in commanded else None for i, val in enumerate(initialState)])
+
+
+def _nTransitions(state1, state2):
+    """Number of shutters that change between two shutter states."""
+    return sum([a != b for a, b in zip(state1, _resolveState(state1, state2))])
+
+
+def planAcqSequence(entries, initialState, restore=True):
+    """Order acquisition entries to minimize shutter transitions, starting from initialState 
+       (and returning to it at the end if restore).  Returns the new order, its number 
+       of shutter transitions, and the number of transitions for the fixed order, 
+       where each acquisition restores the shutters itself."""
+    def cost(order):
+        n = 0
+        state = initialState
+        for entry in order:
+            n += _nTransitions(state, entry.state)
+            state = _resolveState(state, entry.state)
+        if restore:
+            n += _nTransitions(state, initialState)
+        return n
+    # Brute force over all orders; min() keeps the first (fixed) order on ties
+    if not entries or len(entries) > 7:
+        order = list(entries)
+    else:
+        order = list(min(itertools.permutations(entries), key=cost))
+    if restore:
+        nFixed = sum([2*_nTransitions(initialState, entry.state) for entry in entries])
+    else:
+        nFixed = cost(entries)
+    return order, cost(order), nFixed
 
 
 def preScan(exp, pv1, grabObject=None):
@@ -1576,7 +3543,7 @@ def preScan(exp, pv1, grabObject=None):
         newPos1 = pv1.pre_start + i*pre_inc
         printMsg('Setting %s to %f' % (pv1.pvname, newPos1))
         pv1.move(newPos1)
-        printSleep(pv1.settletime,'Settling')
+        pv1.settle()
         if grabObject:
             if grabObject.grabFlag:
                 if grabObject.stepFlag:
@@ -1586,28 +3553,277 @@ def preScan(exp, pv1, grabObject=None):
                 else:
                     grabObject.filenameExtras = ('_prescan_' + pv1.desc + 
                             '-' + '{0:08.4f}'.format(pv1.get()))
+                grabObject.scanStep = 'prescan%d' % (i+1)
                 grabObject.grabImages()
     printMsg('Pre-scan done ' + '-'*20) 
 
 
-def runUserScript():
-    """Run arbitrary script after image grabbing."""
+class UserScriptRunner():
+    """Runs the user script (RUNSCRIPT:PATH) at scan steps.  By default the scan waits 
+       for the script to finish.  With RUNSCRIPT:ASYNC, the script is started and the 
+       scan goes on (e.g. grabbing images) while it runs; at most RUNSCRIPT:MAXJOBS 
+       scripts run at once, and starting another waits for the oldest to finish.
+       Scripts running longer than RUNSCRIPT:TIMEOUT seconds (0 = no limit) are killed.
+       The step context is passed in environment variables: PVSCAN_STEP, 
+       PVSCAN_STEPCOUNTS, PVSCAN_PVNAMES, PVSCAN_POSITIONS, PVSCAN_FILEPATH, 
+       PVSCAN_IMAGE_FILEPATH and PVSCAN_FILENAME_EXTRAS.  The start time, run time 
+       and exit status of each run are written to userScript-NOW.dat in the scan 
+       directory.  A failing script is reported but does not stop the scan."""
+    def __init__(self, filepath=None, asyncFlag=None):
+        self.args = (getPV(pvPrefix + ':RUNSCRIPT:PATH').get(as_string=True) or '').split()
+        self.asyncFlag = (getOptional(pvPrefix + ':RUNSCRIPT:ASYNC', 0) 
+                if asyncFlag is None else asyncFlag)
+        self.maxJobs = max(1, getOptional(pvPrefix + ':RUNSCRIPT:MAXJOBS') or 1)
+        self.timeout = getOptional(pvPrefix + ':RUNSCRIPT:TIMEOUT') or None
+        self.filename = (filepath + 'userScript-' + NOW + '.dat' 
+                if filepath and os.path.isdir(filepath) else None)
+        self.jobs = []  # (step, Popen, start time)
+        self.nRuns = 0
+        self.nFailed = 0
+
+    def run(self, context=None):
+        """Start the script for one step, with context (a dict) in PVSCAN_<KEY> environment
+           variables.  Returns the exit status (0 if asynchronous), or -1 if it could not
+           be started."""
+        context = context or {}
+        if not self.args:
+            logging.error('runUserScript: path is zero length')
+            return -1
+        env = dict(os.environ)
+        for key, value in context.items():
+            if isinstance(value, (list, tuple)):
+                value = ' '.join([str(x) for x in value])
+            env['PVSCAN_' + key.upper()] = str(value)
+        step = str(context.get('step', ''))
+        printMsg('Running user script...')
+        self._reap()
+        while len(self.jobs) >= self.maxJobs:
+            self._finish(self.jobs[0])
+        t0 = time()
+        try:
+            process = subprocess.Popen(self.args, env=env)
+        except OSError as e:
+            msg = 'Failed: %s: %s' % ('runUserScript', e.strerror)
+            logging.error(msg)
+            msgPv.put(msg)
+            self._log(step, t0, 0.0, 'OSError')
+            self.nFailed += 1
+            return -1
+        job = (step, process, t0)
+        self.jobs.append(job)
+        if self.asyncFlag:
+            return 0
+        return self._finish(job)
+
+    def _reap(self):
+        """Log finished scripts and kill scripts that ran over the timeout, without waiting."""
+        for job in list(self.jobs):
+            step, process, t0 = job
+            if process.poll() is not None or (self.timeout and time() - t0 > self.timeout):
+                self._finish(job)
+
+    def _finish(self, job):
+        """Wait for a script (at most until its timeout), log it and return its exit status."""
+        step, process, t0 = job
+        if self.timeout is None:
+            process.wait()
+        else:
+            while process.poll() is None and time() - t0 < self.timeout:
+                sleep(0.01)
+        status = process.poll()
+        if status is None:
+            process.kill()
+            process.wait()
+            status = 'timeout'
+        self.jobs.remove(job)
+        self.nRuns += 1
+        self._log(step, t0, time() - t0, status)
+        if status != 0:
+            self.nFailed += 1
+            printMsg('WARNING: user script (step %s) exited with status %s' % (step, status))
+        return status
+
+    def _log(self, step, t0, runTime, status):
+        if self.filename:
+            with open(self.filename, 'a') as outfile:
+                outfile.write('%s %s %.3f %s\n' % (step or '-', 
+                        datetime.datetime.fromtimestamp(t0).strftime('%Y%m%d_%H%M%S.%f'), runTime, status))
+
+    def wait(self):
+        """Wait for all running scripts."""
+        while self.jobs:
+            self._finish(self.jobs[0])
+        if self.nFailed:
+            printMsg('WARNING: %d of %d user script runs failed' % (self.nFailed, self.nRuns))
+
+    def kill(self):
+        """Kill all running scripts, e.g. when the scan fails."""
+        for step, process, t0 in self.jobs:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            self.nRuns += 1
+            self.nFailed += 1
+            self._log(step, t0, time() - t0, 'killed')
+        if self.jobs:
+            printMsg('WARNING: killed %d running user script(s)' % (len(self.jobs)))
+        self.jobs = []
+
+
+class UserScriptWorker(UserScriptRunner):
+    """Persistent user script (RUNSCRIPT:WORKER), started once instead of at every step.
+       It receives one line of JSON per step on stdin, with the step context, e.g.
+           {"event": "step", "step": "2:3", "stepcounts": [2, 3], "positions": [...], ...}
+       and must reply with one line of JSON on stdout when done with the step, e.g. 
+       {"status": 0} (other output must go to stderr).  Replies are taken in order.
+       At the end of the scan it receives {"event": "end"}, and stdin is closed.
+       RUNSCRIPT:ASYNC, MAXJOBS (steps awaiting a reply) and TIMEOUT (per reply) work as
+       for script runs; a worker that times out or exits is restarted at the next step."""
+    def __init__(self, filepath=None, asyncFlag=None):
+        UserScriptRunner.__init__(self, filepath, asyncFlag)
+        self.process = None
+        self.replies = None
+        self.pending = []  # (step, start time) awaiting a reply
+
+    def _start(self):
+        """Start the worker and a thread reading its replies."""
+        printMsg('Starting user script worker %s' % (' '.join(self.args)))
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                universal_newlines=True, bufsize=1)
+        self.replies = queue.Queue()
+        reader = Thread(target=self._read, args=(self.process.stdout, self.replies))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _read(stdout, replies):
+        for line in iter(stdout.readline, ''):
+            replies.put(line)
+        replies.put(None)
+
+    def _stop(self, kill=False):
+        """End the worker: send the end event and close stdin (or kill it)."""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        if not kill:
+            try:
+                process.stdin.write(json.dumps({'event': 'end'}) + '\n')
+                process.stdin.close()
+            except (IOError, OSError, ValueError):
+                pass
+            t0 = time()
+            while process.poll() is None and time() - t0 < (self.timeout or 5.0):
+                sleep(0.01)
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+    def run(self, context=None):
+        """Send the step event to the worker (starting it if needed).  Returns the reply 
+           status (0 if asynchronous), or -1 if the event could not be sent."""
+        context = context or {}
+        if not self.args:
+            logging.error('runUserScript: path is zero length')
+            return -1
+        step = str(context.get('step', ''))
+        self._reap()
+        while len(self.pending) >= self.maxJobs:
+            self._finish()
+        t0 = time()
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self._stop(kill=True)
+                self._start()
+            self.process.stdin.write(json.dumps(dict(context, event='step'), default=str) + '\n')
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            msg = 'Failed: %s: %s' % ('runUserScript', e.strerror)
+            logging.error(msg)
+            msgPv.put(msg)
+            self._log(step, t0, 0.0, type(e).__name__)
+            self.nFailed += 1
+            self._stop(kill=True)
+            return -1
+        self.pending.append((step, t0))
+        if self.asyncFlag:
+            return 0
+        return self._finish()
+
+    def _reap(self):
+        """Take the replies that are in, and time out overdue steps, without waiting."""
+        while self.pending and (not self.replies.empty() 
+                or (self.timeout and time() - self.pending[0][1] > self.timeout)):
+            self._finish()
+
+    def _finish(self):
+        """Wait for the reply to the oldest pending step, log it and return its status."""
+        step, t0 = self.pending.pop(0)
+        try:
+            line = self.replies.get(timeout=max(0.0, self.timeout - (time() - t0)) if self.timeout else None)
+        except queue.Empty:
+            line = 'timeout'
+        if line is None or line == 'timeout':
+            status = 'exited' if line is None else 'timeout'
+            self._stop(kill=True)
+            for step0, t00 in [(step, t0)] + self.pending:
+                self._log(step0, t00, time() - t00, status)
+                self.nRuns += 1
+                self.nFailed += 1
+            printMsg('WARNING: user script worker %s at step %s' % (status, step))
+            self.pending = []
+            return status
+        try:
+            status = json.loads(line).get('status', 0)
+        except (ValueError, AttributeError):
+            status = 'invalid reply'
+            logging.warning('UserScriptWorker: invalid reply: %s' % (line.strip()))
+        self.nRuns += 1
+        self._log(step, t0, time() - t0, status)
+        if status != 0:
+            self.nFailed += 1
+            printMsg('WARNING: user script (step %s) replied with status %s' % (step, status))
+        return status
+
+    def wait(self):
+        """Wait for all pending replies, then end the worker."""
+        while self.pending:
+            self._finish()
+        self._stop()
+        if self.nFailed:
+            printMsg('WARNING: %d of %d user script steps failed' % (self.nFailed, self.nRuns))
+
+    def kill(self):
+        """Kill the worker, e.g. when the scan fails; pending steps are logged as killed."""
+        for step, t0 in self.pending:
+            self.nRuns += 1
+            self.nFailed += 1
+            self._log(step, t0, time() - t0, 'killed')
+        if self.pending:
+            printMsg('WARNING: killed user script worker with %d step(s) pending' % (len(self.pending)))
+        self.pending = []
+        self._stop(kill=True)
+
+
+@stepTimer.timed('script')
+def runUserScript(exp=None, context=None):
+    """Run the user script with the experiment's UserScriptRunner (or synchronously if
+       there is none).  Returns the exit status, see UserScriptRunner.run."""
     #runUserScriptFlag = PV(pvPrefix + ':RUNSCRIPT:ENABLE').get()
     #if runUserScriptFlag:
-    try:
-        runUserScriptPath = PV(pvPrefix + ':RUNSCRIPT:PATH').get(as_string=True)
-    except ValueError:
-        logging.error('runUserScript: path is zero length')
-        return(-1)
-    runUserScriptPath = runUserScriptPath.split()
-    printMsg('Running user script...')
-    try:
-        subprocess.call(runUserScriptPath)
-    except OSError as e:
-        msg = 'Failed: %s: %s' % ('runUserScript', e.strerror)
-        logging.error(msg)
-        msgPv.put(msg)
-        sys.exit(e.errno)
+    runner = getattr(exp, 'userScript', None)
+    if runner is None:
+        return UserScriptRunner(asyncFlag=False).run(context)
+    return runner.run(context)
+
+
+def _stepContext(exp, grabObject, pvs, stepCounts, step=None):
+    """Step context for the user script."""
+    return {'step': step or ':'.join([str(n) for n in stepCounts]), 'stepcounts': stepCounts,
+            'pvnames': [pv.pvname for pv in pvs], 'positions': [pv.get() for pv in pvs],
+            'filepath': exp.filepath or '', 'image_filepath': getattr(grabObject, 'filepath', '') or '',
+            'filename_extras': getattr(grabObject, 'filenameExtras', '') or ''}
+
     
 class ScanCorrection():
     """Do a 2-D correction, based on a PV value.  
@@ -1616,24 +3832,29 @@ class ScanCorrection():
         self.className = self.__class__.__name__
         functionName = '__init__'
         logging.info('%s.%s' % (self.className, functionName))
-        scanCorPvname1 = PV(pvPrefix + ':SCANCOR:PVNAME1').get(as_string=True)
-        scanCorPvname2 = PV(pvPrefix + ':SCANCOR:PVNAME2').get(as_string=True)
-        self.scanCorPv1 = PV(scanCorPvname1)
-        self.scanCorPv2 = PV(scanCorPvname2)
+        scanCorPvname1 = getPV(pvPrefix + ':SCANCOR:PVNAME1').get(as_string=True)
+        scanCorPvname2 = getPV(pvPrefix + ':SCANCOR:PVNAME2').get(as_string=True)
+        self.scanCorPv1 = getPV(scanCorPvname1)
+        self.scanCorPv2 = getPV(scanCorPvname2)
         sleep(0.2)
         self.initVal1 = self.scanCorPv1.get()
         self.initVal2 = self.scanCorPv2.get()
+        # Correction parameters are read once, at the start of the scan
+        self.pvscale1 = getPV(pvPrefix + ':SCANCOR:PVSCALE1').get()
+        self.pvscale2 = getPV(pvPrefix + ':SCANCOR:PVSCALE2').get()
+        self.corrType = getPV(pvPrefix + ':SCANCOR:CORRTYPE').get()
+        self.table = {}
         self._fitData()
 
     def _fitData(self):
         """Fit data from file.  Result is two fit functions, one for each axis."""
         functionName = '_fitData'
         try:
-            scanCorPath = PV(pvPrefix + ':SCANCOR:PATH').get(as_string=True)
+            scanCorPath = getPV(pvPrefix + ':SCANCOR:PATH').get(as_string=True)
         except ValueError:
             logging.error('%s:%s: path is zero length' % (self.className, functionName))
             return(-1)
-        scanCorFitType = PV(pvPrefix + ':SCANCOR:FITTYPE').get()
+        scanCorFitType = getPV(pvPrefix + ':SCANCOR:FITTYPE').get()
         with open(scanCorPath, 'r') as fh:
             scanCorData = [line.strip() for line in fh if not line.startswith('#')]
             scanCorData = [line.split() for line in scanCorData if line]
@@ -1645,7 +3866,7 @@ class ScanCorrection():
 
     def plot(self):    
         """Plot fits."""
-        scanCorShowPlot = PV(pvPrefix + ':SCANCOR:SHOWPLOT').get()
+        scanCorShowPlot = getPV(pvPrefix + ':SCANCOR:SHOWPLOT').get()
         sleep(0.1)
         if scanCorShowPlot:
             t = np.linspace(min(self.vals), max(self.vals), num=100, endpoint=True)
@@ -1654,17 +3875,29 @@ class ScanCorrection():
             plt.legend(['xdata', 'x', 'ydata', 'y'], loc='best')
             plt.show()
 
+    def _corrections(self, scanPvValues):
+        """Return arrays of correction values for an array of scan PV values."""
+        scanPvValues = np.asarray(scanPvValues, dtype=np.float64)
+        corVals1 = self.pvscale1*self.fitFunc1(scanPvValues)
+        corVals2 = self.pvscale2*self.fitFunc2(scanPvValues)
+        if not self.corrType:
+            corVals1 += self.initVal1
+            corVals2 += self.initVal2
+        return corVals1, corVals2
+
+    def precompute(self, scanPos):
+        """Build a lookup table of correction values for all scan positions."""
+        corVals1, corVals2 = self._corrections(scanPos)
+        self.table = dict(zip([float(x) for x in scanPos], zip(corVals1.tolist(), corVals2.tolist())))
+
     def set(self, scanPvValue):
-        """Set correction PVs using fit functions, based on the value of the PV being scanned."""
-        scanCorPvscale1 = PV(pvPrefix + ':SCANCOR:PVSCALE1').get()
-        scanCorPvscale2 = PV(pvPrefix + ':SCANCOR:PVSCALE2').get()
-        scanCorCorrType = PV(pvPrefix + ':SCANCOR:CORRTYPE').get()
-        if scanCorCorrType:
-            corVal1 = scanCorPvscale1*float(self.fitFunc1(scanPvValue))
-            corVal2 = scanCorPvscale2*float(self.fitFunc2(scanPvValue))
-        else:
-            corVal1 = self.initVal1 + scanCorPvscale1*float(self.fitFunc1(scanPvValue))
-            corVal2 = self.initVal2 + scanCorPvscale2*float(self.fitFunc2(scanPvValue))
+        """Set correction PVs using fit functions, based on the value of the PV being scanned.
+           Values come from the precomputed table if possible.  The puts don't wait, so 
+           they can overlap with the move of the scan PV."""
+        try:
+            corVal1, corVal2 = self.table[float(scanPvValue)]
+        except KeyError:
+            corVal1, corVal2 = [float(x) for x in self._corrections([scanPvValue])]
         printMsg('Setting %s to %f' % (self.scanCorPv1.pvname, corVal1))
         self.scanCorPv1.put(corVal1)
         printMsg('Setting %s to %f' % (self.scanCorPv2.pvname, corVal2))
@@ -1682,17 +3915,19 @@ def printMsg(string, pv=msgPv):
     """Print message to stdout and to message PV."""
     try:
         print('%s %s' % (timestamp(1), string))
-        pv.put(string)
+        with stepTimer.span('msg'):
+            pv.put(string)
     except ValueError:
         print('msgPv.put failed: string too long')
 
 
-def printSleep(sleepTime, string='Pausing', pv=msgPv):
-    """Print message and pause for sleepTime seconds."""
+def printSleep(sleepTime, string='Pausing', pv=msgPv, phase='pause'):
+    """Print message and pause for sleepTime seconds (timed as phase by stepTimer)."""
     if sleepTime:
         message = '%s for %f seconds...' % (string, sleepTime)
         printMsg(message)
-        sleep(sleepTime)
+        with stepTimer.span(phase):
+            sleep(sleepTime)
 
 
 def printScanInfo(exp, scanpvs=None):
@@ -1729,6 +3964,19 @@ def printScanInfo(exp, scanpvs=None):
     print('################################')
 
 
+def parseRois(strng):
+    """Parse a string of 'x,y,width,height' ROIs separated by semicolons or newlines."""
+    rois = []
+    for item in re.split(r'[;\n]', strng or ''):
+        vals = [x for x in re.split(r'[,\s]\s*', item.strip()) if x]
+        if not vals:
+            continue
+        if len(vals) != 4 or not all([isNumber(x) for x in vals]):
+            logging.warning('parseRois: invalid ROI: %s' % (item))
+            continue
+        rois.append(tuple([int(float(x)) for x in vals]))
+    return rois
+
 def frange(start, stop, step=1.0):
     """A range() for floats."""
     x = float(start)
@@ -1782,7 +4030,7 @@ if __name__ == "__main__":
         show_usage()
         sys.exit(1)
     pvPrefix = sys.argv[1]
-    iocPv = PV(pvPrefix + ':IOC')
+    iocPv = getPV(pvPrefix + ':IOC')
     print('IOC name PV: ', iocPv)
     print('IOC name: ', iocPv.get())
     sys.exit(0)
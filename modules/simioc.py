@@ -0,0 +1,691 @@
+#!/usr/bin/env python
+# simioc module: simulated pvScan IOC, motors, shutters and AreaDetector cameras
+
+from __future__ import print_function
+import argparse
+import collections
+import logging
+import os
+import re
+import sys
+import tempfile
+import types
+from time import sleep, time
+from threading import Thread, Lock, Event
+import numpy as np
+
+#################################################################################################################
+#
+# Usage (the fake epics module must be installed before pvscan is imported):
+#
+#     import simioc
+#     ioc = simioc.install('SIM:PVSCAN')
+#     ioc.addMotor('SIM:MOTR1', velo=5.0)
+#     ioc.addCamera('SIM:CAM1')
+#     ioc.configure({':SCAN:MODE': 1, ':SCANPV1:PVNAME': 'SIM:MOTR1', ':SCANPV1:PVTYPE': 1})
+#     import pvscan
+#
+# Any record under the pvScan IOC prefix exists, with a default value, so the
+# :SCANPV*, :SHUTTER*, :GRABIMAGES:* and :DATA:* records need no setup.  Other
+# PVs exist only if added (addRecord, addMotor, addShutter, addCamera), unless
+# strict is False.  Records listed in missing (names after the prefix) don't exist
+# unless set, like in an IOC database without them.  ioc.speed > 1 runs motors and cameras faster than real time,
+# ioc.latency adds a delay to every round trip, and ioc.counts counts channel
+# creations, gets, puts and monitor events.
+#
+#################################################################################################################
+
+# Default values for pvScan IOC records (suffixes after the prefix)
+DEFAULTS = {
+    ':SCAN:SAMPLE_NAME': 'sim',
+    ':SCAN:NAME': 'sim',
+    ':SCAN:TYPE': 'Simulated',
+    ':SCAN:ENABLE': 1,
+    ':DATA:INT': 0.1,
+    ':GRABIMAGES:N': 1,
+    ':GRABIMAGES:N2': 1,
+}
+SCANPV_DEFAULTS = {
+    'START': 0.0,
+    'STOP': 1.0,
+    'NSTEPS': 5,
+    'ScanPosNumIter': 1,
+    'FILENAME_WIDTH': 8,
+    'FILENAME_PREC': 4,
+    'T0_DELAYUNITS': 'ps',
+    'PRE_NSTEPS': 2,
+    'SETTLE:TOL': 0.001,
+    'SETTLE:WINDOW': 0.05,
+}
+# Last name components of string-valued records
+STRING_FIELDS = ('PVNAME', 'DESC', 'NAME', 'SAMPLE_NAME', 'FILEPATH', 'FILENAME', 'CAMERA',
+        'ScanPosString', 'T0_DELAYUNITS', 'EXPR', 'FILE', 'TABLE', 'ROIS', 'MSG', 'RBV',
+        'FOMPV', 'FOMTAG', 'PATH', 'EST_FINISH')
+
+
+class Record():
+    """Simulated record: value, timestamp, monitor callbacks and an optional put hook.
+       A put hook may return an Event, which a put with wait=True waits for."""
+    def __init__(self, ioc, name, value=0, onPut=None):
+        self.ioc = ioc
+        self.name = name
+        self.value = value
+        self.timestamp = time()
+        self.onPut = onPut
+        self._callbacks = collections.OrderedDict()
+        self._index = 0
+        self._lock = Lock()
+
+    def get(self, as_string=False):
+        value = self.value
+        if as_string and not isinstance(value, str):
+            if isinstance(value, np.ndarray):
+                return ''.join([chr(x) for x in value if x])
+            return str(value)
+        return value
+
+    def set(self, value):
+        """Set the value (from the device side) and post monitors."""
+        if isinstance(value, str):
+            value = value.rstrip('\0')
+        with self._lock:
+            self.value = value
+            self.timestamp = time()
+            callbacks = list(self._callbacks.values())
+        for callback in callbacks:
+            self.ioc.counts['monitor'] += 1
+            try:
+                callback(value=value, char_value=self.get(as_string=True), timestamp=self.timestamp,
+                        status=0, severity=0)
+            except Exception as e:
+                logging.warning('Record %s: callback error: %s' % (self.name, e))
+
+    def put(self, value, wait=False, timeout=30.0):
+        """Put from a client: set the value, then run the put hook."""
+        self.set(value)
+        done = self.onPut(value) if self.onPut else None
+        if wait and done is not None:
+            done.wait(timeout)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._index += 1
+            self._callbacks[self._index] = callback
+            return self._index
+
+    def unsubscribe(self, index):
+        with self._lock:
+            self._callbacks.pop(index, None)
+
+
+class SimIOC():
+    """Registry of simulated records and devices."""
+    def __init__(self, pvPrefix='SIM:PVSCAN', filepath=None, speed=1.0, latency=0.0, strict=True, 
+            missing=()):
+        self.pvPrefix = pvPrefix
+        if filepath is None:
+            filepath = tempfile.mkdtemp(prefix='pvscan-sim-') + '/data/'
+        self.filepath = filepath
+        self.speed = speed
+        self.latency = latency
+        self.strict = strict
+        self.missing = set(missing)
+        self.records = {}
+        self.devices = []
+        self.counts = collections.Counter()
+        self._lock = Lock()
+
+    @staticmethod
+    def _normalize(name):
+        """VAL and RVAL fields are the record itself."""
+        name = name.strip()
+        for field in ('.VAL', '.RVAL'):
+            if name.endswith(field):
+                return name[:-len(field)]
+        return name
+
+    def record(self, name, create=None):
+        """Return the record for a PV name, or None if it doesn't exist."""
+        name = self._normalize(name)
+        with self._lock:
+            record = self.records.get(name)
+            if record is None:
+                if create is None:
+                    create = ((name.startswith(self.pvPrefix + ':') or not self.strict) 
+                            and name[len(self.pvPrefix):] not in self.missing)
+                if create:
+                    record = Record(self, name, self._default(name))
+                    self.records[name] = record
+        return record
+
+    def _default(self, name):
+        """Default value of a pvScan IOC record."""
+        suffix = name[len(self.pvPrefix):] if name.startswith(self.pvPrefix) else name
+        if suffix == ':DATA:FILEPATH':
+            return self.filepath
+        if suffix in DEFAULTS:
+            return DEFAULTS[suffix]
+        match = re.match(r':SCANPV(\d+):(.*)$', suffix)
+        if match:
+            if match.group(2) == 'DESC':
+                return 'PV' + match.group(1)
+            if match.group(2) in SCANPV_DEFAULTS:
+                return SCANPV_DEFAULTS[match.group(2)]
+        if '.' in suffix or suffix.split(':')[-1] in STRING_FIELDS:
+            return ''
+        return 0
+
+    def addRecord(self, name, value=0, onPut=None):
+        """Add (or replace) a record."""
+        record = Record(self, self._normalize(name), value, onPut)
+        with self._lock:
+            self.records[record.name] = record
+        return record
+
+    def get(self, name, as_string=False):
+        """Value of a record, without counting it as a client get."""
+        return self.record(name).get(as_string)
+
+    def set(self, name, value):
+        """Set a record from the device side (creating it if needed)."""
+        self.record(name, create=True).set(value)
+
+    def configure(self, settings):
+        """Set records from a dict; names starting with ':' are under the pvScan IOC prefix."""
+        for name, value in settings.items():
+            self.set(self.pvPrefix + name if name.startswith(':') else name, value)
+
+    def addMotor(self, name, **kws):
+        motor = SimMotor(self, name, **kws)
+        self.devices.append(motor)
+        return motor
+
+    def addShutter(self, name, rbv=None, state=0):
+        shutter = SimShutter(self, name, rbv, state)
+        self.devices.append(shutter)
+        return shutter
+
+    def addCamera(self, prefix, **kws):
+        camera = SimCamera(self, prefix, **kws)
+        self.devices.append(camera)
+        return camera
+
+    def shutdown(self, timeout=1.0):
+        """Stop moving motors and acquiring cameras, waiting for the camera threads."""
+        for device in self.devices:
+            if isinstance(device, SimCamera):
+                device.acquire.set(0)
+                if device._thread is not None:
+                    device._thread.join(timeout)
+            elif isinstance(device, SimMotor):
+                device._stop(1)
+
+    def roundTrips(self):
+        """Number of client operations that need a network round trip in real CA: 
+           connects, non-monitored gets, puts with wait and polls for batched gets."""
+        return self.counts['connect'] + self.counts['get'] + self.counts['put_wait'] + self.counts['poll']
+
+    def wait(self, seconds):
+        """Sleep for simulated seconds."""
+        sleep(seconds/self.speed)
+
+    def _roundTrip(self, kind):
+        self.counts[kind] += 1
+        if self.latency:
+            sleep(self.latency)
+
+
+class SimMotor():
+    """Simulated motor record: moves at VELO (plus ACCL) from RBV to VAL, updating RBV
+       with monitors, honours soft limits (LLM/HLM, none if equal), STOP and DMOV."""
+    def __init__(self, ioc, name, position=0.0, velo=1.0, accl=0.0, llm=0.0, hlm=0.0, vmax=0.0,
+            updatePeriod=0.02):
+        self.ioc = ioc
+        self.name = name
+        self.updatePeriod = updatePeriod
+        self.val = ioc.addRecord(name, position, onPut=self._move)
+        self.rbv = ioc.addRecord(name + '.RBV', position)
+        self.velo = ioc.addRecord(name + '.VELO', velo)
+        self.accl = ioc.addRecord(name + '.ACCL', accl)
+        self.vmax = ioc.addRecord(name + '.VMAX', vmax)
+        self.llm = ioc.addRecord(name + '.LLM', llm)
+        self.hlm = ioc.addRecord(name + '.HLM', hlm)
+        self.dmov = ioc.addRecord(name + '.DMOV', 1)
+        self.movn = ioc.addRecord(name + '.MOVN', 0)
+        ioc.addRecord(name + '.STOP', 0, onPut=self._stop)
+        ioc.addRecord(name + '.DESC', name)
+        ioc.addRecord(name + '.EGU', 'mm')
+        self._generation = 0
+        self._lock = Lock()
+
+    def _move(self, target):
+        done = Event()
+        low, high = self.llm.value, self.hlm.value
+        if low != high and not (low <= target <= high):
+            logging.warning('SimMotor %s: %s outside soft limits [%s, %s]' % (self.name, target, low, high))
+            done.set()
+            return done
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        thread = Thread(target=self._run, args=(float(target), generation, done))
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def _stop(self, value):
+        with self._lock:
+            self._generation += 1
+
+    def _run(self, target, generation, done):
+        start = self.rbv.value
+        distance = target - start
+        duration = (abs(distance)/self.velo.value + self.accl.value) if distance and self.velo.value else 0.0
+        self.dmov.set(0)
+        self.movn.set(1)
+        t0 = time()
+        stopped = False
+        while True:
+            elapsed = (time() - t0)*self.ioc.speed
+            if generation != self._generation:
+                stopped = True
+                break
+            if elapsed >= duration:
+                break
+            self.rbv.set(start + distance*elapsed/duration)
+            sleep(self.updatePeriod/self.ioc.speed)
+        if not stopped:
+            self.rbv.set(target)
+        if generation == self._generation or stopped:
+            self.movn.set(0)
+            self.dmov.set(1)
+        done.set()
+
+
+class SimShutter():
+    """Simulated shutter: a single record (as used by DummyShutter), with an optional
+       readback that follows it."""
+    def __init__(self, ioc, name, rbv=None, state=0):
+        self.record = ioc.addRecord(name, state, onPut=self._onPut)
+        self.rbv = ioc.addRecord(rbv, state) if rbv else None
+
+    def _onPut(self, value):
+        if self.rbv:
+            self.rbv.set(value)
+
+
+class SimCamera():
+    """Simulated AreaDetector camera with cam1, image1 (NDStdArrays) and file plugins.
+       Acquisition runs in Single, Multiple or Continuous image mode at
+       max(AcquireTime, AcquirePeriod); file plugins capture (Stream mode) NumCapture
+       frames, updating FileNumber, FullFileName_RBV and Capture_RBV.  Files are only
+       written if writeFiles is set.  signal, if given, is called for every frame
+       and scales the simulated image."""
+    def __init__(self, ioc, prefix, plugins=('TIFF1', 'JPEG1'), sizeX=64, sizeY=64,
+            acquireTime=0.01, acquirePeriod=0.02, signal=None, writeFiles=False):
+        self.ioc = ioc
+        self.prefix = prefix
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.signal = signal
+        self.writeFiles = writeFiles
+        self.counter = 0
+        self._lock = Lock()
+        self._thread = None
+        self._rng = np.random.RandomState(0)
+        cam = prefix + ':cam1:'
+        rec = ioc.addRecord
+        self.acquire = rec(cam + 'Acquire', 0, onPut=self._onAcquire)
+        self.acquireRBV = rec(cam + 'Acquire_RBV', 0)
+        self.imageMode = rec(cam + 'ImageMode', 2, onPut=lambda v: self.imageModeRBV.set(v))
+        self.imageModeRBV = rec(cam + 'ImageMode_RBV', 2)
+        self.numImages = rec(cam + 'NumImages', 1)
+        rec(cam + 'NumExposures', 1)
+        self.arrayCounterRBV = rec(cam + 'ArrayCounter_RBV', 0)
+        rec(cam + 'ArrayCounter', 0, onPut=self._onArrayCounter)
+        self.acquireTime = rec(cam + 'AcquireTime', acquireTime,
+                onPut=lambda v: self.ioc.set(cam + 'AcquireTime_RBV', v))
+        rec(cam + 'AcquireTime_RBV', acquireTime)
+        self.acquirePeriod = rec(cam + 'AcquirePeriod', acquirePeriod,
+                onPut=lambda v: self.ioc.set(cam + 'AcquirePeriod_RBV', v))
+        rec(cam + 'AcquirePeriod_RBV', acquirePeriod)
+        for name, value in (('ArraySizeX_RBV', sizeX), ('ArraySizeY_RBV', sizeY), ('DataType_RBV', 3),
+                ('Gain_RBV', 0), ('TriggerMode_RBV', 0), ('ColorMode_RBV', 0), ('ArrayRate_RBV', 0),
+                ('DetectorState_RBV', 0), ('BI:NAME.DESC', 'Simulated camera')):
+            rec(cam + name, value)
+        self.arrayData = rec(prefix + ':image1:ArrayData', np.zeros(sizeX*sizeY, dtype=np.uint16))
+        self.arrayCallbacks = rec(prefix + ':image1:EnableCallbacks', 1)
+        rec(prefix + ':image1:ArrayCounter_RBV', 0)
+        rec(prefix + ':image1:UniqueId_RBV', 0)
+        self.plugins = [SimFilePlugin(ioc, prefix + ':' + plugin) for plugin in plugins]
+
+    def _onAcquire(self, value):
+        if value:
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self.acquireRBV.set(1)
+                    self._thread = Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+        else:
+            self.acquireRBV.set(0)
+
+    def _onArrayCounter(self, value):
+        self.counter = int(value)
+        self.arrayCounterRBV.set(self.counter)
+
+    def _run(self):
+        mode = self.imageMode.value
+        nImages = 1 if mode == 0 else self.numImages.value if mode == 1 else None
+        count = 0
+        while self.acquire.value and (nImages is None or count < nImages):
+            self.ioc.wait(max(self.acquireTime.value, self.acquirePeriod.value, 0.001))
+            if not self.acquire.value:
+                break
+            self._frame()
+            count += 1
+        self.acquire.set(0)
+        self.acquireRBV.set(0)
+
+    def _frame(self):
+        """Produce one frame."""
+        self.counter += 1
+        self.arrayCounterRBV.set(self.counter)
+        if self.arrayCallbacks.value:
+            scale = self.signal(self.ioc) if self.signal else 1.0
+            frame = (100 + 1000*scale*self._rng.random_sample(self.sizeX*self.sizeY)).astype(np.uint16)
+            self.arrayData.set(frame)
+            self.ioc.set(self.prefix + ':image1:ArrayCounter_RBV', self.counter)
+            self.ioc.set(self.prefix + ':image1:UniqueId_RBV', self.counter)
+        for plugin in self.plugins:
+            plugin.frame(self.writeFiles)
+
+
+class SimFilePlugin():
+    """Simulated AreaDetector file plugin (Stream/Capture write mode)."""
+    def __init__(self, ioc, prefix):
+        self.ioc = ioc
+        rec = ioc.addRecord
+        self.filePath = rec(prefix + ':FilePath', '')
+        self.fileName = rec(prefix + ':FileName', '')
+        self.template = rec(prefix + ':FileTemplate', '%s%s_%4.4d')
+        self.fileNumber = rec(prefix + ':FileNumber', 1)
+        self.autoIncrement = rec(prefix + ':AutoIncrement', 1)
+        self.numCapture = rec(prefix + ':NumCapture', 1)
+        self.numCaptured = rec(prefix + ':NumCaptured_RBV', 0)
+        self.capture = rec(prefix + ':Capture', 0, onPut=self._onCapture)
+        self.captureRBV = rec(prefix + ':Capture_RBV', 0)
+        self.fullFileName = rec(prefix + ':FullFileName_RBV', '')
+        self.timeStamp = rec(prefix + ':TimeStamp_RBV', 0.0)
+        for name, value in (('WriteFile_RBV', 0), ('QueueSize', 1), ('FileWriteMode', 2),
+                ('AutoSave', 1), ('EnableCallbacks', 1)):
+            rec(prefix + ':' + name, value)
+        self._done = Event()
+        self._done.set()
+
+    def _onCapture(self, value):
+        if value:
+            self._done = Event()
+            self.numCaptured.set(0)
+            self.captureRBV.set(1)
+        else:
+            self.captureRBV.set(0)
+            self._done.set()
+        return self._done
+
+    def frame(self, writeFiles=False):
+        """Save a frame if capturing."""
+        if not self.captureRBV.value:
+            return
+        try:
+            filename = self.template.value % (self.filePath.value, self.fileName.value, self.fileNumber.value)
+        except (TypeError, ValueError):
+            filename = self.filePath.value + self.fileName.value
+        if writeFiles and os.path.isdir(self.filePath.value):
+            open(filename, 'wb').close()
+        self.timeStamp.set(time())
+        self.fullFileName.set(filename)
+        if self.autoIncrement.value:
+            self.fileNumber.set(self.fileNumber.value + 1)
+        self.numCaptured.set(self.numCaptured.value + 1)
+        if self.numCaptured.value >= max(1, self.numCapture.value):
+            self.capture.set(0)
+            self.captureRBV.set(0)
+            self._done.set()
+
+
+##################################################################################################################
+# Fake epics module
+
+_ioc = None
+
+# DBR field types, as in epics.dbr
+DBR_STRING, DBR_ENUM, DBR_CHAR, DBR_DOUBLE = 0, 3, 4, 6
+
+
+class PV(object):
+    """Stand-in for epics.PV, backed by the simulated IOC."""
+    def __init__(self, pvname, callback=None, form='time', verbose=False, auto_monitor=None,
+            count=None, connection_callback=None, connection_timeout=None, **kws):
+        self.pvname = pvname.strip()
+        self.auto_monitor = auto_monitor
+        self._record = _ioc.record(self.pvname)
+        self._callbacks = {}
+        _ioc._roundTrip('connect')
+        self.connected = self._record is not None
+        self.status = 0 if self.connected else None
+        self.severity = 0 if self.connected else None
+        if callback is not None:
+            self.add_callback(callback)
+
+    def connect(self, timeout=None):
+        return self.connected
+
+    def wait_for_connection(self, timeout=None):
+        return self.connected
+
+    def get(self, count=None, as_string=False, as_numpy=True, timeout=None, with_ctrlvars=False,
+            use_monitor=True):
+        if not self.connected:
+            return None
+        # Like pyepics, scalars are monitored by default, and monitored gets are local
+        monitored = (self.auto_monitor if self.auto_monitor is not None 
+                else not isinstance(self._record.value, np.ndarray))
+        if use_monitor and monitored:
+            _ioc.counts['get_cached'] += 1
+        else:
+            _ioc._roundTrip('get')
+        return self._record.get(as_string)
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False, callback=None, callback_data=None):
+        if not self.connected:
+            return None
+        _ioc._roundTrip('put_wait' if wait else 'put')
+        self._record.put(value, wait=wait, timeout=timeout)
+        if callback is not None:
+            callback(pvname=self.pvname, data=callback_data)
+        return 1
+
+    @property
+    def value(self):
+        return self.get()
+
+    @property
+    def char_value(self):
+        return self.get(as_string=True)
+
+    @property
+    def timestamp(self):
+        return self._record.timestamp if self.connected else None
+
+    def add_callback(self, callback=None, index=None, run_now=False, with_ctrlvars=True, **kws):
+        if not self.connected or callback is None:
+            return None
+        pvname = self.pvname
+        def wrapper(**kw):
+            kw.update(kws)
+            callback(pvname=pvname, **kw)
+        index = self._record.subscribe(wrapper)
+        self._callbacks[index] = wrapper
+        if run_now:
+            wrapper(value=self._record.value, char_value=self._record.get(as_string=True),
+                    timestamp=self._record.timestamp)
+        return index
+
+    def remove_callback(self, index=None):
+        if index in self._callbacks:
+            self._record.unsubscribe(index)
+            self._callbacks.pop(index)
+
+    def clear_callbacks(self):
+        for index in list(self._callbacks):
+            self.remove_callback(index)
+
+    def disconnect(self):
+        self.clear_callbacks()
+
+    def __repr__(self):
+        return "<PV '%s' (simulated)>" % (self.pvname)
+
+
+class _Channel():
+    """Channel handle for the fake ca module."""
+    def __init__(self, pvname):
+        self.pvname = pvname
+        self.record = None
+        self.pending = None
+        self.created = time()
+
+
+def _create_channel(pvname, connect=False, auto_cb=True, callback=None):
+    chid = _Channel(pvname.strip())
+    if connect:
+        _connect_channel(chid)
+    return chid
+
+
+def _connect_channel(chid, timeout=None, verbose=False):
+    if chid.record is None:
+        # The search went out when the channel was created, so channels created 
+        # together connect in parallel
+        _ioc.counts['connect'] += 1
+        remaining = _ioc.latency - (time() - chid.created)
+        if remaining > 0:
+            sleep(remaining)
+        chid.record = _ioc.record(chid.pvname)
+    return chid.record is not None
+
+
+def _field_type(chid):
+    if chid.record is None:
+        return -1
+    value = chid.record.value
+    if isinstance(value, str):
+        return DBR_STRING
+    return DBR_CHAR if isinstance(value, np.ndarray) else DBR_DOUBLE
+
+
+def _ca_get(chid, ftype=None, count=None, wait=True, timeout=None, as_string=False, as_numpy=True):
+    if chid.record is None:
+        return None
+    as_string = as_string or ftype == DBR_STRING
+    if wait:
+        _ioc._roundTrip('get')
+        return chid.record.get(as_string)
+    # Batched: the round trip is paid once per poll
+    _ioc.counts['get_batched'] += 1
+    chid.pending = chid.record.get(as_string)
+    return None
+
+
+def _ca_get_complete(chid, ftype=None, count=None, timeout=None, as_string=False, as_numpy=True):
+    as_string = as_string or ftype == DBR_STRING
+    value = chid.pending if chid.pending is not None else (chid.record.get(as_string)
+            if chid.record is not None else None)
+    if as_string and value is not None and not isinstance(value, str):
+        value = str(value)
+    chid.pending = None
+    return value
+
+
+def _ca_poll(evt=None, iot=None):
+    _ioc._roundTrip('poll')
+
+
+def _caget(pvname, as_string=False, timeout=5.0, **kws):
+    return PV(pvname).get(as_string=as_string)
+
+
+def _caput(pvname, value, wait=False, timeout=60, **kws):
+    return PV(pvname).put(value, wait=wait, timeout=timeout)
+
+
+def install(pvPrefix='SIM:PVSCAN', **kws):
+    """Create the simulated IOC and install a fake epics module in sys.modules.
+       Must be called before pvscan (or anything else using epics) is imported.
+       Sets PVSCAN_PVPREFIX.  Returns the SimIOC."""
+    global _ioc
+    if 'pvscan' in sys.modules:
+        raise RuntimeError('simioc.install: pvscan was imported before the simulated IOC')
+    _ioc = SimIOC(pvPrefix, **kws)
+    ca = types.ModuleType('epics.ca')
+    ca.create_channel = _create_channel
+    ca.connect_channel = _connect_channel
+    ca.get = _ca_get
+    ca.get_complete = _ca_get_complete
+    ca.poll = _ca_poll
+    ca.pend_io = lambda timeout=1.0: None
+    ca.pend_event = lambda timeout=1.e-5: None
+    ca.isConnected = lambda chid: chid.record is not None
+    ca.field_type = _field_type
+    ca.element_count = lambda chid: len(chid.record.value) if isinstance(chid.record.value, np.ndarray) else 1
+    dbr = types.ModuleType('epics.dbr')
+    dbr.STRING, dbr.ENUM, dbr.CHAR, dbr.DOUBLE = DBR_STRING, DBR_ENUM, DBR_CHAR, DBR_DOUBLE
+    ca.name = lambda chid: chid.pvname
+    epics = types.ModuleType('epics')
+    epics.__doc__ = 'Simulated epics module (pvScan simioc)'
+    epics.PV = PV
+    epics.ca = ca
+    epics.dbr = dbr
+    epics.caget = _caget
+    epics.caput = _caput
+    epics.poll = _ca_poll
+    sys.modules['epics'] = epics
+    sys.modules['epics.ca'] = ca
+    sys.modules['epics.dbr'] = dbr
+    os.environ['PVSCAN_PVPREFIX'] = pvPrefix
+    return _ioc
+
+
+##################################################################################################################
+
+def demo(nSteps=5, speed=10.0):
+    """Run a 1-D motor scan with image grabbing against the simulated IOC."""
+    ioc = install(speed=speed)
+    ioc.addMotor('SIM:MOTR1', velo=2.0, llm=-10.0, hlm=10.0)
+    ioc.addCamera('SIM:CAM1')
+    ioc.configure({':SCAN:MODE': 1, ':GRABIMAGES:ENABLE': 1, ':GRABIMAGES:CAMERA': 'SIM:CAM1',
+            ':GRABIMAGES:N': 2, ':GRABIMAGES:CAPTUREMODE': 4, ':ACQ:FIXED': 1,
+            ':SCANPV1:PVNAME': 'SIM:MOTR1', ':SCANPV1:PVTYPE': 1, ':SCANPV1:NSTEPS': nSteps,
+            ':SCANPV1:SETTLETIME': 0.1})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pvscan
+    t0 = time()
+    exp = pvscan.Experiment(npvs=1, nshutters=0, log=False)
+    pvscan.pvNDScan(exp, exp.scanpvs, exp.grabber, exp.shutters)
+    print('Scan of %d steps done in %.2f s; %d round trips, counts: %s'
+            % (nSteps, time() - t0, ioc.roundTrips(), dict(ioc.counts)))
+    print('Data in %s' % (exp.filepath))
+    ioc.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a demo pvScan scan against a simulated IOC.')
+    parser.add_argument('--nsteps', type=int, default=5, help='Number of scan steps')
+    parser.add_argument('--speed', type=float, default=10.0, help='Simulation speed-up factor')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    demo(args.nsteps, args.speed)
+
+
+### End ##########################################################################
@@ -4,7 +4,6 @@
 
 import os
 import shutil
-import signal
 import sys
 from time import sleep
 from epics import PV
@@ -36,7 +35,8 @@ def abortRoutine():
     "This is the abort routine"
     # Kill scan routine process
     pvscan.printMsg('Killing process %d...' % (pid))
-    os.kill(pid, signal.SIGKILL)
+    # Scans run in-process by pvScan-multiScan.py are stopped with SIGTERM, so they can clean up
+    pvscan.stopScanProcess(pid)
     # Stop the wrapper script
     pvscan.printMsg('Stopping wrapper script')
     runFlagPv.put(0)
@@ -7,6 +7,7 @@ from time import sleep
 import datetime,os,sys
 from threading import Thread
 import subprocess
+import numpy as np
 
 # PV prefix for pvScan IOC; should be passed as an argument to this script.
 pvPrefix=sys.argv[1]
@@ -247,17 +248,35 @@ def wdmScan(exp,pv1,pv2,pv3,pv4,grabObject=''):
         if exp.scanmode==2 and pv2.scanpv:
             initialPos2=pv2.scanpv.get()
             inc2=(pv2.scanpv.stop-pv2.scanpv.start)/(pv2.scanpv.nsteps-1)
+        # Compute scan and lock positions for all steps up front
+        positions1=pv1.scanpv.start + inc1*np.arange(pv1.scanpv.nsteps)
+        if zLockFlag:
+            positions3=zSlope*positions1 + zIntercept
+        if yLockFlag:
+            positions4=ySlope*positions1 + yIntercept
+        # Check all positions against soft limits before the first move
+        trajectory=pvscan.Trajectory()
+        trajectory.addAxis('x1',positions1,pv1.scanpv)
+        if zLockFlag:
+            trajectory.addAxis('z',positions3,pv3.scanpv)
+        if yLockFlag:
+            trajectory.addAxis('y',positions4,pv4.scanpv)
+        trajectory.validate()
+        if exp.scanmode==2 and pv2.scanpv:
+            trajectory2=pvscan.Trajectory()
+            trajectory2.addAxis('x2',pv2.scanpv.start + inc2*np.arange(pv2.scanpv.nsteps),pv2.scanpv)
+            trajectory2.validate()
         pvscan.printMsg('Scanning %s from %f to %f in %d steps' % (pv1.scanpv.pvname,pv1.scanpv.start,pv1.scanpv.stop,pv1.scanpv.nsteps))
         for i in range(pv1.scanpv.nsteps):
-            newPos1=pv1.scanpv.start + i*inc1
+            newPos1=positions1[i]
             pvscan.printMsg('Setting %s to %f' % (pv1.scanpv.pvname,newPos1))
             pv1.scanpv.move(newPos1, delta=delta)
             if zLockFlag:
-                newPos3=zSlope*newPos1 + zIntercept
+                newPos3=positions3[i]
                 pvscan.printMsg('Setting %s to %f' % (pv3.scanpv.pvname,newPos3))
                 pv3.scanpv.move(newPos3, delta=delta)
             if yLockFlag:
-                newPos4=ySlope*newPos1 + yIntercept
+                newPos4=positions4[i]
                 pvscan.printMsg('Setting %s to %f' % (pv4.scanpv.pvname,newPos4))
                 pv4.scanpv.move(newPos4, delta=delta)
             pvscan.printSleep(pv1.scanpv.settletime,'Settling')
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# Tests of modules/elog.py against a local stand-in for the elog web service
+
+from __future__ import print_function
+import json
+import logging
+import os
+import subprocess
+import sys
+from threading import Thread, Lock
+from time import sleep
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+requests = pytest.importorskip('requests')
+try:
+    import epics
+    simulated = False
+except ImportError:
+    # Run params are fetched over CA; use the simulated IOC if pyepics is missing
+    pytest.importorskip('numpy')
+    import simioc
+    simioc.install()
+    simulated = True
+import elog
+
+
+class ElogStandIn():
+    """Local HTTP stand-in for the elog web service, e.g.
+       Elog(None, 'user', 'pw', ElogStandIn().url).  Each request is recorded in
+       requests as (method, path, JSON data); the first nFail posts get a failStatus
+       response, the first nFailLookup experiment lookups a 503 response, and every 
+       response is delayed by delay seconds."""
+    def __init__(self, port=0, nFail=0, failStatus=500, nFailLookup=0, delay=0.0, expname='TestExp1',
+            samplename='TestSample'):
+        self.requests = []
+        self.nFail = nFail
+        self.nFailLookup = nFailLookup
+        self.failStatus = failStatus
+        self.delay = delay
+        self.expname = expname
+        self.samplename = samplename
+        self._lock = Lock()
+        standIn = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            def do_GET(self):
+                standIn._handle(self, 'GET')
+            def do_POST(self):
+                standIn._handle(self, 'POST')
+            def log_message(self, format, *args):
+                logging.debug('ElogStandIn: ' + format % args)
+        self.server = HTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        sleep(self.delay)
+        with self._lock:
+            self.requests.append((method, handler.path, json.loads(body.decode()) if body else None))
+            status = 200
+            if method == 'POST' and self.nFail > 0:
+                self.nFail -= 1
+                status = self.failStatus
+            elif method == 'GET' and self.nFailLookup > 0:
+                self.nFailLookup -= 1
+                status = 503
+        if handler.path.endswith('activeexperiments'):
+            payload = {'success': True, 'value': [{'name': self.expname, 'current_sample': self.samplename}]}
+        else:
+            payload = {'success': status == 200}
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def posts(self, path=False):
+        """Endpoints (or paths) of the posts received, in order."""
+        return [p if path else p.split('?')[0].split('/')[-1] for method, p, data in self.requests 
+                if method == 'POST']
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def standIn(request):
+    kws = getattr(request, 'param', {})
+    server = ElogStandIn(**kws)
+    yield server
+    server.close()
+
+
+def test_posts_in_order(standIn):
+    log = elog.Elog(None, 'user', 'pw', standIn.url, retryDelay=0.01)
+    assert log.expname == 'TestExp1'
+    log.start()
+    log.add_params(pvnamelist=[])
+    log.end()
+    assert log.close(timeout=10.0)
+    assert standIn.posts() == ['start_run', 'add_run_params', 'end_run']
+    assert all(['/run_control/TestExp1/ws/' in path for path in standIn.posts(path=True)])
+
+
+@pytest.mark.parametrize('standIn', [{'nFail': 2, 'failStatus': 500}], indirect=True)
+def test_retries_server_errors(standIn):
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, retries=3, retryDelay=0.01)
+    log.start()
+    log.end()
+    assert log.close(timeout=10.0)
+    assert standIn.posts() == ['start_run']*3 + ['end_run']
+    assert log.failed == []
+
+
+@pytest.mark.parametrize('standIn', [{'nFail': 1, 'failStatus': 404}], indirect=True)
+def test_no_retries_client_errors(standIn):
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, retries=3, retryDelay=0.01)
+    log.start()
+    log.end()
+    assert not log.close(timeout=10.0)
+    assert standIn.posts() == ['start_run', 'end_run']
+    assert log.failed == ['start_run']
+
+
+@pytest.mark.parametrize('standIn', [{'delay': 0.2}], indirect=True)
+def test_params_snapshot_at_add_params(standIn):
+    values = {'A': '1'}
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url)
+    log._set_params = lambda: dict(values)
+    log.start()  # Keeps the background thread busy
+    log.add_params(pvnamelist=['A'])
+    values['A'] = '2'
+    assert log.close(timeout=10.0)
+    assert [data for method, path, data in standIn.requests 
+            if path.split('?')[0].endswith('add_run_params')] == [{'A': '1'}]
+
+
+
+@pytest.mark.parametrize('standIn', [{'nFailLookup': 1}], indirect=True)
+@pytest.mark.parametrize('spool', [False, True])
+def test_experiment_looked_up_when_sending(standIn, spool, tmpdir):
+    log = elog.Elog(None, 'user', 'pw', standIn.url, retryDelay=0.01, replay=False,
+            spool=str(tmpdir.join('spool.jsonl')) if spool else None)
+    assert log.expname == 'TestExp0'  # Placeholder
+    log.start()
+    log.end()
+    assert log.close(timeout=10.0)
+    assert [path.split('?')[0] for path in standIn.posts(path=True)] == [
+            '/run_control/TestExp1/ws/start_run', '/run_control/TestExp1/ws/end_run']
+
+
+def test_spool_sends_journaled_time(standIn, tmpdir):
+    filename = str(tmpdir.join('spool.jsonl'))
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, spool=filename, replay=False)
+    log.start()
+    assert log.close(timeout=10.0)
+    with open(filename) as fh:
+        t = json.loads(fh.readline())['time']
+    assert standIn.posts(path=True)[0].endswith('?time=' + elog.strftime('%Y-%m-%dT%H%%3A%M%%3A%SZ', 
+            elog.gmtime(t)))
+
+
+@pytest.mark.parametrize('standIn', [{'nFail': 1000}], indirect=True)
+def test_spool_keeps_order_across_runs(standIn, tmpdir):
+    filename = str(tmpdir.join('spool.jsonl'))
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, retryDelay=0.01, spool=filename, replay=False)
+    log.start()
+    log.add_params(pvnamelist=[])
+    log.end()
+    assert not log.close(timeout=0.2)
+    assert log.failed == []
+    standIn.nFail = 0
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, spool=filename, replay=False)
+    log.start()
+    assert log.close(timeout=10.0)
+    assert standIn.posts()[-4:] == ['start_run', 'add_run_params', 'end_run', 'start_run']
+
+
+@pytest.mark.skipif(simulated, reason='the replayer process needs pyepics')
+@pytest.mark.parametrize('standIn', [{'nFail': 1000}], indirect=True)
+def test_background_replayer(standIn, tmpdir):
+    filename = str(tmpdir.join('spool.jsonl'))
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, spool=filename)
+    log.start()
+    log.end()
+    assert not log.close(timeout=0.2)
+    assert log.replayer is not None
+    standIn.nFail = 0
+    assert log.replayer.wait(30.0) == 0
+    assert standIn.posts()[-2:] == ['start_run', 'end_run']
+
+
+
+@pytest.mark.skipif(simulated, reason='the replayer process needs pyepics')
+@pytest.mark.parametrize('standIn', [{'nFail': 1000}], indirect=True)
+def test_next_run_stops_replayer(standIn, tmpdir):
+    filename = str(tmpdir.join('spool.jsonl'))
+    log = elog.Elog('TestExp1', 'user', 'pw', standIn.url, spool=filename)
+    log.start()
+    assert not log.close(timeout=0.2)
+    sleep(1.0)  # Let the replayer take the journal
+    log2 = elog.Elog('TestExp1', 'user', 'pw', standIn.url, spool=filename, replay=False)
+    assert log.replayer.wait(10.0) != 0
+    standIn.nFail = 0
+    log2.end()
+    assert log2.close(timeout=10.0)
+    assert standIn.posts()[-2:] == ['start_run', 'end_run']
+
+
+@pytest.mark.parametrize('holder', ['{0}', 'replay:{0}'])
+def test_spool_in_use_not_stopped(tmpdir, holder):
+    # Only a replayer is stopped; anything else holding the lock is waited for
+    filename = str(tmpdir.join('spool.jsonl'))
+    locker = subprocess.Popen([sys.executable, '-c', 'import fcntl, os, sys, time; '
+            'fh = open(sys.argv[1], "a+"); fcntl.flock(fh, fcntl.LOCK_EX); '
+            'fh.write(sys.argv[2].format(os.getpid())); fh.flush(); print("locked"); '
+            'sys.stdout.flush(); time.sleep(30)', filename + '.lock', holder], stdout=subprocess.PIPE)
+    try:
+        assert locker.stdout.readline().strip() == b'locked'
+        with pytest.raises(IOError, match='in use'):
+            elog.ElogSpool(filename, requests.Session(), lockTimeout=0.5)
+        assert locker.poll() is None
+    finally:
+        locker.kill()
+        locker.wait()
+
+
+##################################################################################################################
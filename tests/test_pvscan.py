@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# Tests of the hardware-independent parts of modules/pvscan.py, on the simulated IOC
+
+from __future__ import print_function
+import os
+import signal
+import subprocess
+import sys
+from time import sleep
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+np = pytest.importorskip('numpy')
+pytest.importorskip('matplotlib')
+pytest.importorskip('scipy')
+import simioc
+if 'pvscan' not in sys.modules:
+    ioc = simioc.install()
+else:
+    ioc = simioc._ioc
+import pvscan
+
+
+@pytest.fixture
+def settings():
+    """Function to set pvScan IOC records (names after the prefix) for a test; the 
+       records are restored afterwards."""
+    saved = {}
+    def configure(values):
+        for name, value in values.items():
+            saved.setdefault(name, ioc.get(ioc.pvPrefix + name))
+        ioc.configure(values)
+    yield configure
+    ioc.configure(saved)
+
+
+##################################################################################################################
+# ImageReducer
+
+def test_reducer_roi_sums_and_centroids(tmpdir):
+    reducer = pvscan.ImageReducer(str(tmpdir) + '/', 'SIM:CAM1', rois=[(0, 0, 4, 4), (2, 1, 2, 2)])
+    frames = np.zeros((2, 4, 4))
+    frames[0, 1, 3] = 2.0
+    frames[1, 2, 2] = 4.0
+    reducer.reduce(frames, step=3, tag='PumpProbe', key='_PumpProbe_x1')
+    assert np.allclose(reducer.results[('3', 'PumpProbe')], [3.0, 3.0])
+    with open(reducer.filename) as fh:
+        lines = [line.split() for line in fh if not line.startswith('#')]
+    assert lines[0][:3] == ['Step', 'Tag', 'Frame']
+    # Step Tag Frame ROI1_sum ROI1_cx ROI1_cy ROI2_sum ROI2_cx ROI2_cy Extras
+    assert lines[1][:9] == ['3', 'PumpProbe', '1', '2', '3', '1', '2', '3', '1']
+    assert lines[2][:9] == ['3', 'PumpProbe', '2', '4', '2', '2', '4', '2', '2']
+    assert lines[1][-1] == 'PumpProbe_x1'
+
+
+def test_reducer_full_frame_untagged(tmpdir):
+    reducer = pvscan.ImageReducer(str(tmpdir) + '/', 'SIM:CAM1', rois=[])
+    reducer.reduce(np.ones((3, 2, 5)))
+    assert list(reducer.results) == [('-', '-')]
+    assert np.allclose(reducer.results[('-', '-')], [10.0])
+    with open(reducer.filename) as fh:
+        assert fh.readline().startswith('# ROI1: x=0 y=0 width=5 height=2')
+
+
+def test_reducer_no_frames(tmpdir):
+    reducer = pvscan.ImageReducer(str(tmpdir) + '/', 'SIM:CAM1', rois=[])
+    reducer.reduce(np.zeros((0, 4, 4)), step=1)
+    assert reducer.results == {}
+    assert not os.path.exists(reducer.filename)
+
+
+def test_reducer_projections(tmpdir):
+    ioc.configure({':GRABIMAGES:REDUCE:PROJ': 1})
+    try:
+        reducer = pvscan.ImageReducer(str(tmpdir) + '/', 'SIM:CAM1', rois=[(0, 0, 3, 2)])
+    finally:
+        ioc.configure({':GRABIMAGES:REDUCE:PROJ': 0})
+    frames = np.arange(12, dtype=float).reshape((1, 3, 4))
+    reducer.reduce(frames, step='2:1', tag='Static')
+    projections = np.load(reducer.projFilename % ('2_1-Static'))
+    assert np.allclose(projections['ROI1_x'], [[4, 6, 8]])
+    assert np.allclose(projections['ROI1_y'], [[3, 15]])
+
+
+def test_parse_rois():
+    assert pvscan.parseRois('0,0,10,20; 5 5 2 2\n1,2,3') == [(0, 0, 10, 20), (5, 5, 2, 2)]
+    assert pvscan.parseRois('') == []
+    assert pvscan.parseRois(None) == []
+
+
+##################################################################################################################
+# Acquisition sequences
+
+def test_parse_acq_table():
+    entries = pvscan.parseAcqTable('PumpProbe 11 0 0.5; Static 10  # comment\n# Only a comment\n\nProbe 1x 3')
+    assert entries == [pvscan.AcqEntry((1, 1), 'PumpProbe', 0, 0.5), pvscan.AcqEntry((1, 0), 'Static', 0, 0),
+            pvscan.AcqEntry((1, None), 'Probe', 3, 0)]
+    assert pvscan.parseAcqTable('') == []
+    assert pvscan.parseAcqTable(' ; # nothing') == []
+
+
+@pytest.mark.parametrize('table', ['PumpProbe', 'PumpProbe 12', 'PumpProbe open', 'Static 10 n'])
+def test_parse_acq_table_invalid(table):
+    with pytest.raises(ValueError):
+        pvscan.parseAcqTable(table)
+
+
+def entries(*tags):
+    return [pvscan.AcqEntry(pvscan.ACQ_STATES[tag], tag, 0, 0) for tag in tags]
+
+
+def test_plan_acq_sequence_restore():
+    order, n, nFixed = pvscan.planAcqSequence(entries('PumpProbe', 'Static', 'PumpBG', 'DarkCurrent'), 
+            (0, 0), restore=True)
+    # One shutter transition per acquisition, instead of opening and closing for each
+    assert [entry.tag for entry in order] == ['Static', 'PumpProbe', 'PumpBG', 'DarkCurrent']
+    assert (n, nFixed) == (4, 8)
+
+
+def test_plan_acq_sequence_no_restore():
+    order, n, nFixed = pvscan.planAcqSequence(entries('PumpProbe', 'Static', 'PumpBG', 'DarkCurrent'), 
+            (0, 0), restore=False)
+    assert sorted([entry.tag for entry in order]) == ['DarkCurrent', 'PumpBG', 'PumpProbe', 'Static']
+    assert (n, nFixed) == (3, 6)
+
+
+def test_plan_acq_sequence_keeps_order_on_ties():
+    order, n, nFixed = pvscan.planAcqSequence(entries('Static', 'PumpProbe'), (0, 0))
+    assert [entry.tag for entry in order] == ['Static', 'PumpProbe']
+    assert (n, nFixed) == (4, 6)
+    order, n, nFixed = pvscan.planAcqSequence(entries('PumpProbe', 'Static'), (0, 0))
+    assert [entry.tag for entry in order] == ['PumpProbe', 'Static']
+
+
+def test_plan_acq_sequence_leave_as_is():
+    # 'x' states leave a shutter as it is, so cost nothing
+    sequence = [pvscan.AcqEntry((1, None), 'A', 0, 0), pvscan.AcqEntry((None, 1), 'B', 0, 0)]
+    order, n, nFixed = pvscan.planAcqSequence(sequence, (0, 0), restore=False)
+    assert n == 2
+
+
+def test_plan_acq_sequence_empty_and_long():
+    assert pvscan.planAcqSequence([], (0, 0)) == ([], 0, 0)
+    # More than 7 entries are not searched
+    sequence = entries('PumpProbe', 'DarkCurrent')*4
+    order, n, nFixed = pvscan.planAcqSequence(sequence, (0, 0))
+    assert order == sequence
+    assert n == nFixed == 16
+
+
+##################################################################################################################
+# Scan checkpoints
+
+def test_checkpoint_save_load(tmpdir):
+    filepath = str(tmpdir) + '/'
+    assert pvscan.ScanCheckpoint(filepath).load() is None
+    checkpoint = pvscan.ScanCheckpoint(filepath)
+    checkpoint.save(pvnames=['SIM:MOTR1'], scanPos1=[0.0, 0.5, 1.0], step1=2, step2=0)
+    checkpoint.save(pvnames=['SIM:MOTR1'], scanPos1=[0.0, 0.5, 1.0], step1=3, step2=0)
+    assert os.listdir(filepath) == [pvscan.ScanCheckpoint.filename]
+    state = pvscan.ScanCheckpoint(filepath).load()
+    assert state['step1'] == 3
+    assert state['scanPos1'] == [0.0, 0.5, 1.0]
+    assert 'time' in state
+
+
+def test_checkpoint_failed_save_keeps_last(tmpdir):
+    filepath = str(tmpdir) + '/'
+    checkpoint = pvscan.ScanCheckpoint(filepath)
+    checkpoint.save(step1=1)
+    with pytest.raises(TypeError):
+        checkpoint.save(step1=2, scanPos1=object())
+    assert pvscan.ScanCheckpoint(filepath).load()['step1'] == 1
+
+
+def test_checkpoint_unreadable(tmpdir):
+    tmpdir.join(pvscan.ScanCheckpoint.filename).write('{"step1": 2, ')
+    assert pvscan.ScanCheckpoint(str(tmpdir) + '/').load() is None
+
+
+##################################################################################################################
+# Abort
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='needs /proc')
+def test_stop_scan_process():
+    inProcess = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', 'pvScan-multiScan.py'])
+    script = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', 'pvScan-ued-2pv.py'])
+    try:
+        assert pvscan.stopScanProcess(inProcess.pid)
+        assert not pvscan.stopScanProcess(script.pid)
+        assert inProcess.wait(10) == -signal.SIGTERM
+        assert script.wait(10) == -signal.SIGKILL
+    finally:
+        for process in (inProcess, script):
+            if process.poll() is None:
+                process.kill()
+
+
+##################################################################################################################
+# Coupled axis expressions and trajectories
+
+def test_eval_expression():
+    x1 = np.array([0.0, 1.0, 2.0])
+    namespace = dict(pvscan.Trajectory.namespace, x1=x1, r=2.0)
+    assert np.allclose(pvscan.evalExpression('0.5*x1 + 1.2', namespace), [1.2, 1.7, 2.2])
+    assert np.allclose(pvscan.evalExpression('r*cos(radians(90*x1))', namespace), [2.0, 0.0, -2.0])
+    assert np.allclose(pvscan.evalExpression('-x1 % 2 + x1**2', namespace), [0.0, 2.0, 4.0])
+    assert list(pvscan.evalExpression('x1 > 0.5', namespace)) == [False, True, True]
+    assert pvscan.evalExpression('2**10 - 1e3', {}) == 24.0
+
+
+@pytest.mark.parametrize('expression', ['x1.real', 'x1[0]', 'clip(x1, a_min=0)', 'lambda: 1', 
+        '[x for x in x1]', "'a'", '__import__("os")', 'open("f")', 'x1 if x1 else 0', '0 < x1 < 1',
+        'x1 << 2', '1 +'])
+def test_eval_expression_rejected(expression):
+    with pytest.raises(ValueError):
+        pvscan.evalExpression(expression, dict(pvscan.Trajectory.namespace, x1=np.ones(3)))
+
+
+def test_eval_expression_unknown_name():
+    with pytest.raises(ValueError, match='unknown name y'):
+        pvscan.evalExpression('2*y', {'x1': 1.0})
+
+
+@pytest.mark.parametrize('expression', ['9**9**9', '2**101', 'x1**-200', 'x1**x1', 'sin**2', '2**sin'])
+def test_eval_expression_power_bounded(expression):
+    with pytest.raises(ValueError):
+        pvscan.evalExpression(expression, dict(pvscan.Trajectory.namespace, x1=np.array([1.0, 200.0])))
+
+
+def trajectoryPvs():
+    ioc.addMotor('SIM:TRAJ:MOTR1', llm=-1.0, hlm=1.0)
+    ioc.addRecord('SIM:TRAJ:AO1', 0.0)
+    ioc.addRecord('SIM:TRAJ:AO1.DRVL', 5.0)
+    ioc.addRecord('SIM:TRAJ:AO1.DRVH', 0.0)
+    return pvscan.Motor('SIM:TRAJ:MOTR1'), pvscan.BasePv('SIM:TRAJ:AO1')
+
+
+def test_trajectory_coupled_axis():
+    trajectory = pvscan.Trajectory()
+    trajectory.addAxis('x1', [0.0, 1.0, 2.0])
+    trajectory.addCoupledAxis('c1', 'slope*x1 + 1', slope=2.0)
+    trajectory.addCoupledAxis('c2', '3')
+    assert np.allclose(trajectory.positions, [[0, 1, 3], [1, 3, 3], [2, 5, 3]])
+    assert trajectory.coupled == [1, 2]
+    with pytest.raises(ValueError, match='invalid expression for c3'):
+        trajectory.addCoupledAxis('c3', 'x1.real')
+    with pytest.raises(ValueError):
+        trajectory.addAxis('x2', [0.0, 1.0])
+
+
+def test_trajectory_soft_limits():
+    motor, ao = trajectoryPvs()
+    trajectory = pvscan.Trajectory()
+    trajectory.addAxis('x1', [0.0, 0.5], motor)
+    trajectory.addAxis('x2', [1.0, 2.0], ao)
+    trajectory.addAxis('x3', [1.0, 2.0])
+    # Motor records use LLM/HLM, other records DRVL/DRVH (in either order)
+    assert trajectory.softLimits() == {'x1': (-1.0, 1.0), 'x2': (0.0, 5.0)}
+    assert trajectory.softLimits({'SIM:TRAJ:MOTR1.LLM': 0.0, 'SIM:TRAJ:MOTR1.HLM': 0.0, 
+            'SIM:TRAJ:AO1.DRVL': None, 'SIM:TRAJ:AO1.DRVH': 1.0}) == {}
+    trajectory.validate()
+
+
+def test_trajectory_validate():
+    trajectory = pvscan.Trajectory()
+    trajectory.addAxis('x1', [0.0, 0.5, 1.5, 2.0])
+    trajectory.validate({'x1': (0.0, 2.0)})
+    with pytest.raises(ValueError, match='at step 3 outside soft limits'):
+        trajectory.validate({'x1': (0.0, 1.0)})
+    with np.errstate(all='ignore'):
+        trajectory.addCoupledAxis('c1', 'log(x1 - 0.5)')
+    with pytest.raises(ValueError, match='c1 position at step 1 is not a number'):
+        trajectory.validate({})
+
+
+##################################################################################################################
+# Pre-flight duration estimate
+
+class Namespace():
+    def __init__(self, **kws):
+        self.__dict__.update(kws)
+
+
+def test_preflight_estimate(settings, tmpdir):
+    ioc.addMotor('SIM:PF:MOTR1', velo=1.0, llm=-10.0, hlm=10.0)
+    ioc.addCamera('SIM:PF:CAM1', acquireTime=0.01, acquirePeriod=0.02)
+    settings({':GRABIMAGES:ENABLE': 1, ':GRABIMAGES:N': 2, ':SCAN:MODE': 1})
+    grabber = pvscan.ADGrabber('SIM:PF:CAM1', str(tmpdir) + '/')
+    motor = pvscan.Motor('SIM:PF:MOTR1')
+    motor.settletime = 0.1
+    trajectory = pvscan.Trajectory()
+    trajectory.addAxis('x1', np.linspace(0.0, 1.0, 5), motor)
+    exp = Namespace(acqFixed=1, acqSequence=None)
+    duration = pvscan.preflight(exp, trajectory, motor, grabObject=grabber)
+    # 4 moves of 0.25 s, waited for in 0.2 s readback polls; 5 settles; 
+    # 5 grabs of 2 frames (0.02 s) and the pause after each grab
+    assert duration == pytest.approx(4*0.4 + 5*0.1 + 5*(2*0.02 + pvscan.GRAB_PAUSE))
+    assert ioc.get(ioc.pvPrefix + ':SCAN:EST_DURATION') == pytest.approx(duration)
+    # Resuming at row 3: from the current position (0) to 0.75, then one more move
+    duration = pvscan.preflight(exp, trajectory, motor, grabObject=grabber, startRow=3)
+    assert duration == pytest.approx(0.8 + 0.4 + 2*0.1 + 2*(2*0.02 + pvscan.GRAB_PAUSE))
+
+
+def test_acq_sequence_estimate():
+    sequence = pvscan.AcqSequence([pvscan.AcqEntry((1, 1), 'PumpProbe', 0, 1.0), 
+            pvscan.AcqEntry((1, 0), 'Static', 4, 2.0)], [], restore=True, settleTime=0.5)
+    # Settling, grab, pause after the grab, and the delay between entries; restoring after each
+    assert sequence.estimate(2, 0.1, pause=0.5) == pytest.approx((0.5 + 0.2 + 0.5 + 1.0) 
+            + (0.5 + 0.4 + 0.5) + 2*0.5)
+    sequence.optimize = True
+    assert sequence.estimate(2, 0.1, pause=0.5) == pytest.approx(3.6 + 0.5)
+    assert pvscan.AcqSequence([], []).estimate(2, 0.1) == 0.0
+
+
+##################################################################################################################
+# Adaptive scan
+
+def adaptiveScan(settings, nPoints=None):
+    """AdaptiveScan with ADAPTIVE:NPOINTS nPoints, whose figure of merit is a PV."""
+    ioc.addRecord('SIM:ADAPT:FOM', 0.0)
+    settings({':SCANPV1:ADAPTIVE:FOMPV': 'SIM:ADAPT:FOM'})
+    pv = Namespace(pvnumber=1, pvname='SIM:ADAPT:X', desc='x', adaptiveNPoints=nPoints)
+    exp = Namespace(acqFixed=1, acqSequence=None, filepath=None)
+    return pvscan.AdaptiveScan(exp, pv)
+
+
+def measureWith(scan, function):
+    """Replace scan steps by recording function(x) as the figure of merit."""
+    def measure(x):
+        scan.points.append((x, function(x)))
+    scan.measure = measure
+
+
+def test_adaptive_next_point(settings):
+    scan = adaptiveScan(settings)
+    assert scan.nextPoint() is None
+    scan.points = [(0.0, 0.0), (1.0, 1.0), (2.0, 5.0), (3.0, 5.0)]
+    assert scan.nextPoint() == 1.5
+    # Intervals without change are not refined
+    scan.points = [(0.0, 1.0), (1.0, 1.0)]
+    assert scan.nextPoint() is None
+    # An interval whose midpoint gave no figure of merit is not split again
+    scan.points = [(0.0, 0.0), (2.0, 4.0), (3.0, 5.0), (1.0, None)]
+    assert scan.nextPoint() == 2.5
+
+
+def test_adaptive_min_step(settings):
+    scan = adaptiveScan(settings)
+    scan.minStep = 0.5
+    scan.points = [(0.0, 0.0), (0.25, 10.0), (1.0, 11.0)]
+    assert scan.nextPoint() == 0.625
+
+
+def test_adaptive_run(settings):
+    scan = adaptiveScan(settings, nPoints=6)
+    measureWith(scan, lambda x: float(x >= 1.3))
+    points = scan.run([0.0, 1.0, 2.0, 3.0])
+    assert [x for x, fom in points] == [0.0, 1.0, 2.0, 3.0, 1.5, 1.25]
+
+
+def test_adaptive_run_without_fom(settings):
+    scan = adaptiveScan(settings, nPoints=20)
+    measureWith(scan, lambda x: None if 0.0 < x < 1.0 else x**2)
+    points = scan.run([0.0, 1.0, 2.0])
+    # Each midpoint without figure of merit is measured once
+    xs = [x for x, fom in points]
+    assert len(xs) == len(set(xs)) == 20
+    assert xs[:4] == [0.0, 1.0, 2.0, 1.5]
+
+
+def test_adaptive_run_default_npoints(settings):
+    scan = adaptiveScan(settings)
+    measureWith(scan, lambda x: x**2)
+    assert len(scan.run([0.0, 1.0, 2.0])) == 3
+
+
+##################################################################################################################
+# Simulated IOC
+
+def test_sim_shutdown():
+    camera = ioc.addCamera('SIM:SHUT:CAM1', acquireTime=0.01, acquirePeriod=0.01)
+    motor = ioc.addMotor('SIM:SHUT:MOTR1', velo=1.0)
+    camera.acquire.put(1)
+    motor.val.put(100.0)
+    assert camera._thread.daemon and camera._thread.is_alive()
+    ioc.shutdown()
+    assert not camera._thread.is_alive() and not ioc.get('SIM:SHUT:CAM1:cam1:Acquire_RBV')
+    sleep(0.1)
+    assert ioc.get('SIM:SHUT:MOTR1.DMOV') == 1 and ioc.get('SIM:SHUT:MOTR1.RBV') < 100.0
+
+
+##################################################################################################################
+# Optional IOC records
+
+def test_optional_records(monkeypatch):
+    pool = pvscan.ChannelPool()
+    monkeypatch.setattr(pvscan, 'channelPool', pool)
+    monkeypatch.setattr(ioc, 'missing', set([':TEST:OPTIONAL1', ':TEST:OPTIONAL2']))
+    prefix = ioc.pvPrefix
+    pool.connectAll([prefix + ':TEST:OPTIONAL1', prefix + ':SCAN:MODE'])
+    assert pool.missing == set([prefix + ':TEST:OPTIONAL1'])
+    assert pool.optional(prefix + ':SCAN:MODE') is not None
+    # Missing records are only looked for once
+    connects = ioc.counts['connect']
+    assert pool.optional(prefix + ':TEST:OPTIONAL1') is None
+    assert pvscan.getOptional(prefix + ':TEST:OPTIONAL2', 7) == 7
+    assert pvscan.getOptional(prefix + ':TEST:OPTIONAL2', 7) == 7
+    pvscan.putOptional(prefix + ':TEST:OPTIONAL2', 1)
+    assert ioc.counts['connect'] == connects + 1
+    assert pool.missing == set([prefix + ':TEST:OPTIONAL1', prefix + ':TEST:OPTIONAL2'])
+    ioc.set(prefix + ':TEST:OPTIONAL3', 'x')
+    assert pvscan.getOptional(prefix + ':TEST:OPTIONAL3', as_string=True) == 'x'
+
+
+##################################################################################################################
@@ -3,12 +3,16 @@
 from __future__ import print_function
 import datetime
 import os
+import signal
 import subprocess
 import sys
+import traceback
 from time import sleep
 from epics import PV, caput
 import argparse
 import getpass
+import threading
+import requests
 sys.path.append('/afs/slac/g/testfac/extras/scripts/pvScan/prod/modules/')
 from elog import Elog
 
@@ -17,6 +21,10 @@ from elog import Elog
 parser = argparse.ArgumentParser()
 parser.add_argument('pv_prefix', help='PV prefix of the DAQ IOC, e.g. ASTA:PV01')
 parser.add_argument('n_scans', nargs='?', default=0, help="Number of scans per run")
+parser.add_argument('--in-process', action='store_true', help="Run all scans in this process "
+        "with pvscan.pvNDScan, instead of running the scan script once per scan")
+parser.add_argument('--npvs', type=int, default=2, help="Number of scan PVs (in-process mode)")
+parser.add_argument('--nshutters', type=int, default=3, help="Number of shutters (in-process mode)")
 args = parser.parse_args()
 #
 pv_prefix = args.pv_prefix
@@ -60,6 +68,16 @@ scantype = PV(pv_prefix + ':SCAN:TYPE').get(as_string=True)
 scan_id_pv = PV(pv_prefix + ':SCAN:ID')
 run_id_pv = PV(pv_prefix + ':RUN:ID')
 elogFlag = PV(pv_prefix + ':ELOG:ENABLE').get()
+# MULTISCAN:INPROCESS is optional: older IOC databases don't have it
+in_process_pv = PV(pv_prefix + ':MULTISCAN:INPROCESS')
+in_process = args.in_process or (in_process_pv.wait_for_connection(timeout=1.0) and in_process_pv.get())
+
+# Scan scripts that only run pvscan.pvNDScan, so can be run in-process
+IN_PROCESS_SCRIPTS = ('pvScan-ued-2pv.py', 'pvScan-nlcta-2pv.py')
+if in_process and os.path.basename(script) not in IN_PROCESS_SCRIPTS:
+    print('*** Warning: in-process mode is only supported for {0}, running {1} '
+            'once per scan ***'.format(', '.join(IN_PROCESS_SCRIPTS), script))
+    in_process = False
 
 
 # Validate n_scans
@@ -70,21 +88,30 @@ if n_scans is None:
     n_scans = 1
 
 # Configure elog
+elog = None
 if elogFlag:
     username = getpass.getuser()
-    elog = Elog(exp_name, username, password='testfac',
-            url='https://pswww.slac.stanford.edu/ws-auth/uedlgbk/')
-    if exp_name_autoget:
-        exp_name = elog.expname
-        sample_name = elog.samplename
-    pvfile = os.environ['NFSHOME'] + '/pvScan/elog/elog_pvlist-' + pv_prefix.replace(':','_')
-    if os.path.isfile(pvfile):
-        with open(pvfile, 'r') as f:
-            pvlist = [line.strip() for line in f if not line.startswith('#')]
-            pvlist = [line for line in pvlist if line]
+    # Posts are journaled here and sent from the journal, so they survive an unreachable server
+    elog_spool = (os.environ['NFSHOME'] + '/pvScan/elog/elog_spool-' + pv_prefix.replace(':','_') 
+            + '.jsonl')
+    try:
+        elog = Elog(exp_name, username, password='testfac',
+                url='https://pswww.slac.stanford.edu/ws-auth/uedlgbk/', spool=elog_spool)
+    except (requests.exceptions.RequestException, EnvironmentError) as e:
+        print(e)
+        print('--> Failed to start elog...continuing scan')
     else:
-        pvlist = []
-else:
+        if exp_name_autoget:
+            exp_name = elog.expname
+            sample_name = elog.samplename
+        pvfile = os.environ['NFSHOME'] + '/pvScan/elog/elog_pvlist-' + pv_prefix.replace(':','_')
+        if os.path.isfile(pvfile):
+            with open(pvfile, 'r') as f:
+                pvlist = [line.strip() for line in f if not line.startswith('#')]
+                pvlist = [line for line in pvlist if line]
+        else:
+            pvlist = []
+if elog is None:
     exp_name = exp_name_pv.get(as_string=True)
     sample_name = sample_name_pv.get(as_string=True)
 
@@ -124,65 +151,150 @@ if DEBUG:
     print('run ID: {0}'.format(run_id))
     print('Auto elog: {0}'.format(elogFlag))
     print('Autoget exp name: {0}'.format(exp_name_autoget))
+    print('In-process: {0}'.format(in_process))
     if elogFlag:
         print('username: {0}'.format(username))
     print('++++++++++++++++++++++')
 
 
+def on_abort(signum, frame):
+    """SIGTERM handler in in-process mode: the abort scripts send SIGTERM (see 
+    pvscan.stopScanProcess), which aborts the scans, so the cleanup still runs."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt('Aborted')
+
+
+def run_scans_in_process(filepaths, scan_ids):
+    """Run one pvNDScan per filepath in this process, like the 2-PV scan scripts, keeping 
+    the Experiment (scan PVs, shutters) and CA channels alive between scans.  A failed 
+    scan is reported and the next one is run, as for scan scripts."""
+    os.environ['PVSCAN_PVPREFIX'] = pv_prefix
+    import pvscan
+    pvscan.loggingConfig()
+    signal.signal(signal.SIGTERM, on_abort)
+    pvscan.pidPV.put(os.getpid())
+    print_lock = threading.Lock()
+    exp = None
+    try:
+        for i, (filepath_new, scan_id) in enumerate(zip(filepaths, scan_ids)):
+            if not run_pv.get():
+                break
+            if len(filepaths) > 1:
+                print('{0} Scan {1:03}/{2:03} {3}'.format('*'*15, i+1, len(filepaths), '*'*15))
+            if DEBUG: print('filepath_new:', filepath_new)
+            filepath_pv.put(filepath_new + '\0')
+            scan_count_pv.put(i+1)
+            scan_id_pv.put(scan_id)
+            if not filepath_new.endswith('/'):
+                filepath_new += '/'
+            try:
+                if exp is None:
+                    exp = pvscan.Experiment(npvs=args.npvs, nshutters=args.nshutters, 
+                            filepath=filepath_new, mutex=print_lock)
+                else:
+                    exp.new_scan(filepath_new)
+                try:
+                    if exp.dataLog.dataEnable:
+                        exp.dataLog.start()
+                    pvscan.printScanInfo(exp, exp.scanpvs)
+                    pvscan.printMsg('Starting')
+                    sleep(0.5) # Collect some initial data first
+                    pvscan.pvNDScan(exp, exp.scanpvs, exp.grabber, exp.shutters)
+                    sleep(0.5) # Log data for a little longer
+                    pvscan.printMsg('Done')
+                finally:
+                    exp.dataLog.stop()
+                    if exp.dataLog.is_alive():
+                        exp.dataLog.join()
+            except Exception:
+                traceback.print_exc()
+                print('--> Scan {0} failed'.format(i+1))
+            print('')
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if exp is not None:
+            exp.logFile.close()
+
+
 # Start Scan
 run_pv.put(1)
-if elogFlag:
-    # Start elog entry
+if elog:
+    # Start elog entry; the posts are sent in the background, so the scan doesn't wait
     print('Creating elog entry...')
     try:
         elog.start()
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, EnvironmentError) as e:
         print(e)
         print('--> Failed to start elog...continuing scan')
+        elog = None
     else:
-        elogSuccess = True
         try:
-            elog.add_params(pvnamelist=pvlist if pvlist else [])
-        except requests.exceptions.RequestException as e:
+            elog.add_params(pvnamelist=pvlist)
+        except (requests.exceptions.RequestException, EnvironmentError) as e:
             print(e)
             print('--> Failed to add elog parameters...continuing scan')
 sleep(0.2)
-if n_scans == 1:
-    scan_count_pv.put(1)
-    scan_id_pv.put('{0}_{1}_{2:03}'.format(sample_name, NOW, 1))
-    subprocess.call([script, pv_prefix])
-    run_pv.put(0)
-elif n_scans > 1:
-    try:
-        for i in range(n_scans): 
-            if run_pv.get():
-                print('{0} Scan {1:03}/{2:03} {3}'.format('*'*15, i+1, n_scans, '*'*15))
-                if filepath.endswith('/'):
-                    filepath_new = filepath.rstrip('/')
-                else:
-                    filepath_new = filepath
-                filepath_new += '/scan%03d' % (i+1)
-                if DEBUG: print('filepath_new:', filepath_new)
-                filepath_pv.put(filepath_new + '\0')
-                scan_count_pv.put(i+1)
-                scan_id_pv.put('{0}_{1}_{2:03}'.format(exp_name, NOW, i+1))
-                sleep(0.5)
-                subprocess.call([script, pv_prefix])
-                print('')
-    finally:
-        filepath_pv.put(filepath + '\0')
+try:
+    if in_process and n_scans >= 1:
+        if n_scans == 1:
+            filepaths = [filepath]
+            scan_ids = ['{0}_{1}_{2:03}'.format(sample_name, NOW, 1)]
+        else:
+            filepaths = [filepath.rstrip('/') + '/scan%03d' % (i+1) for i in range(n_scans)]
+            scan_ids = ['{0}_{1}_{2:03}'.format(exp_name, NOW, i+1) for i in range(n_scans)]
+        try:
+            run_scans_in_process(filepaths, scan_ids)
+            if n_scans > 1:
+                print('*'*15 + ' All scans done. ' + '*'*15)
+        except KeyboardInterrupt:
+            print('*'*15 + ' Aborted. ' + '*'*15)
+        finally:
+            filepath_pv.put(filepath + '\0')
+            run_pv.put(0)
+            sleep(0.2)
+    elif n_scans == 1:
+        scan_count_pv.put(1)
+        scan_id_pv.put('{0}_{1}_{2:03}'.format(sample_name, NOW, 1))
+        subprocess.call([script, pv_prefix])
         run_pv.put(0)
-        sleep(0.2)
-    print('*'*15 + ' All scans done. ' + '*'*15)
-else:
-    raise ValueError('Error: n_scans must be > 0')
-if elogFlag and elogSuccess:
-    # End elog entry
-    try:
-        elog.end()
-    except requests.exceptions.RequestException as e:
-        print(e)
-        print('--> Failed to end elog')
+    elif n_scans > 1:
+        try:
+            for i in range(n_scans): 
+                if run_pv.get():
+                    print('{0} Scan {1:03}/{2:03} {3}'.format('*'*15, i+1, n_scans, '*'*15))
+                    if filepath.endswith('/'):
+                        filepath_new = filepath.rstrip('/')
+                    else:
+                        filepath_new = filepath
+                    filepath_new += '/scan%03d' % (i+1)
+                    if DEBUG: print('filepath_new:', filepath_new)
+                    filepath_pv.put(filepath_new + '\0')
+                    scan_count_pv.put(i+1)
+                    scan_id_pv.put('{0}_{1}_{2:03}'.format(exp_name, NOW, i+1))
+                    sleep(0.5)
+                    subprocess.call([script, pv_prefix])
+                    print('')
+        finally:
+            filepath_pv.put(filepath + '\0')
+            run_pv.put(0)
+            sleep(0.2)
+        print('*'*15 + ' All scans done. ' + '*'*15)
+    else:
+        raise ValueError('Error: n_scans must be > 0')
+finally:
+    if elog:
+        # End elog entry and wait for the queued posts
+        try:
+            elog.end()
+        except (requests.exceptions.RequestException, EnvironmentError) as e:
+            print(e)
+            print('--> Failed to end elog')
+        if not elog.close(timeout=60.0):
+            if elog.failed:
+                print('--> Elog server rejected: {0}'.format(', '.join(elog.failed)))
+            else:
+                print('--> Elog server not responding; the entry is kept in {0} and is being sent '
+                        'in the background (log: {0}.log)'.format(elog_spool))
 sys.exit(0)
 
 